@@ -1,62 +1,476 @@
+import asyncio
+import copy
 import gzip
-import shutil
+import hashlib
+import json
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from pathlib import Path
 
 import httpx
 import polars as pl
 import yaml
+from polars.io.plugins import register_io_source
 from tqdm import tqdm
 
+from lse_diss.data.schemas import get_schema
 
-def download_file(url, path=Path("data", "misc", "bulk_downloads")):
-    path.mkdir(parents=True, exist_ok=True)
 
+def _state_path(file_path):
+    return file_path.with_name(f"{file_path.name}.state.json")
+
+
+def _write_state(file_path, state):
+    state_path = _state_path(file_path)
+    temp_path = state_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(state, indent=2))
+    temp_path.replace(state_path)
+
+
+async def _save_state(file_path, state, lock):
+    # NOTE: segments write from worker threads, the lock keeps two of them
+    # from replacing the state file at once and the copy from a state that
+    # changes while it is written
+    async with lock:
+        await asyncio.to_thread(_write_state, file_path, copy.deepcopy(state))
+
+
+def _allocate(part_path, size):
+    with open(part_path, "wb") as f:
+        if size:
+            f.truncate(size)
+
+
+def _read_state(file_path, url, size, etag):
+    state_path = _state_path(file_path)
+    part_path = file_path.with_name(f"{file_path.name}.part")
+
+    if state_path.exists() and part_path.exists():
+        state = json.loads(state_path.read_text())
+
+        # NOTE: a changed file on the server invalidates the partial download,
+        # the state is kept under the configured url, redirect targets may be
+        # signed and expire between runs
+        if (state["url"], state["size"], state["etag"]) == (url, size, etag):
+            return state
+
+        print(f"{file_path.name} changed on the server, starting again")
+
+    state_path.unlink(missing_ok=True)
+    part_path.unlink(missing_ok=True)
+
+    return None
+
+
+async def _probe(client, url):
+    # NOTE: a one byte range request gives the size and whether ranges work,
+    # servers without range support answer 200 and the body is not read
+    async with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as r:
+        r.raise_for_status()
+
+        if r.status_code == 206 and "content-range" in r.headers:
+            total = r.headers["content-range"].split("/")[-1]
+            size = int(total) if total != "*" else None
+            ranges = size is not None
+        else:
+            size = r.headers.get("content-length")
+            size = int(size) if size is not None else None
+            ranges = False
+
+        return size, ranges, r.headers.get("etag")
+
+
+async def _fetch_segment(
+    client, url, part_path, file_path, state, lock, segment, pbar, ranges, retries
+):
+    for attempt in range(retries + 1):
+        # NOTE: without ranges a retry or resume has to begin at the start
+        if not ranges and segment["done"]:
+            pbar.update(-segment["done"])
+            segment["done"] = 0
+
+        start = segment["start"] + segment["done"]
+
+        if segment["end"] is not None and start > segment["end"]:
+            return
+
+        headers = {}
+        if ranges:
+            end = "" if segment["end"] is None else segment["end"]
+            headers["Range"] = f"bytes={start}-{end}"
+
+        try:
+            async with client.stream("GET", url, headers=headers) as r:
+                r.raise_for_status()
+
+                if ranges and r.status_code != 206:
+                    raise httpx.HTTPError(f"range request ignored for {url}")
+
+                # NOTE: file calls run in threads so the event loop keeps
+                # serving the other segments, data is buffered between writes
+                f = await asyncio.to_thread(open, part_path, "r+b")
+
+                try:
+                    await asyncio.to_thread(f.seek, start)
+                    buffer = bytearray()
+                    unsaved = 0
+
+                    async for data in r.aiter_bytes():
+                        buffer += data
+
+                        if len(buffer) < 2**22:
+                            continue
+
+                        await asyncio.to_thread(f.write, buffer)
+                        segment["done"] += len(buffer)
+                        unsaved += len(buffer)
+                        pbar.update(len(buffer))
+                        buffer = bytearray()
+
+                        # NOTE: flushed before the state so it never claims
+                        # bytes that are not on disk
+                        if unsaved >= 2**26:
+                            await asyncio.to_thread(f.flush)
+                            await _save_state(file_path, state, lock)
+                            unsaved = 0
+
+                    await asyncio.to_thread(f.write, buffer)
+                    segment["done"] += len(buffer)
+                    pbar.update(len(buffer))
+                finally:
+                    await asyncio.to_thread(f.close)
+
+            return
+
+        except httpx.TransportError as e:
+            if attempt == retries:
+                raise
+
+            print(
+                f"{file_path.name}: {e!r}, retrying from byte "
+                f"{segment['start'] + segment['done'] if ranges else 0}"
+            )
+            await asyncio.sleep(2**attempt)
+
+        finally:
+            # NOTE: the file is closed by now, so an interrupted segment
+            # resumes from the last byte written
+            await _save_state(file_path, state, lock)
+
+
+def _checksum(file_path, algorithm):
+    digest = hashlib.new(algorithm)
+
+    with open(file_path, "rb") as f:
+        while data := f.read(2**24):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+async def _download(
+    client, url, path, segment_size, max_segments, checksum, retries, position
+):
     file_name = url.split("/")[-1]
     file_path = path / file_name
+    part_path = file_path.with_name(f"{file_name}.part")
 
-    with open(file_path, "wb") as f:
-        with httpx.stream("GET", url, follow_redirects=True) as r:
-            r.raise_for_status()
-            size = int(r.headers.get("content-length", 0))
-            with tqdm(total=size, unit="iB", unit_scale=True) as pbar:
-                for data in r.iter_bytes():
-                    pbar.update(len(data))
-                    f.write(data)
+    size, ranges, etag = await _probe(client, url)
+    state = _read_state(file_path, url, size, etag)
 
-        # Try to unpack with shutil.unpack_archive
-    try:
-        shutil.unpack_archive(file_path, path)
-        file_path.unlink()
-        return
-
-    except Exception:
-        # If that fails, check if it's a .gz file and try gzip unpacking
-        if file_path.suffix == ".gz":
-            try:
-                with gzip.open(file_path, "rb") as f_in:
-                    output_path = file_path.with_suffix("")
-                    with open(output_path, "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                file_path.unlink()
-                return
-            except Exception as e:
-                print(f"Failed to unpack gzipped file {file_name}: {e}")
-
-    # If we reach here, both unpacking methods failed
-    print(f"Keeping original file {file_name}")
-
-
-def convert_files():
-    tsv_path = Path("data", "misc", "bulk_downloads")
-    parquet_path = Path("data", "raw", "bulk_downloads")
+    if state is None:
+        n_segments = (
+            min(max(-(-size // segment_size), 1), max_segments) if ranges else 1
+        )
+        bounds = [size * i // n_segments for i in range(n_segments + 1)] if size else []
+
+        state = {
+            "url": url,
+            "size": size,
+            "etag": etag,
+            "segments": [
+                {"start": bounds[i], "end": bounds[i + 1] - 1, "done": 0}
+                for i in range(n_segments)
+            ]
+            if size
+            else [{"start": 0, "end": None, "done": 0}],
+        }
+
+        await asyncio.to_thread(_allocate, part_path, size)
+        await asyncio.to_thread(_write_state, file_path, state)
+    else:
+        print(f"resuming {file_name}")
+
+    lock = asyncio.Lock()
+
+    done = sum(segment["done"] for segment in state["segments"])
+
+    with tqdm(
+        total=size,
+        initial=done,
+        unit="iB",
+        unit_scale=True,
+        desc=file_name,
+        position=position,
+        leave=True,
+    ) as pbar:
+        await asyncio.gather(
+            *(
+                _fetch_segment(
+                    client,
+                    url,
+                    part_path,
+                    file_path,
+                    state,
+                    lock,
+                    segment,
+                    pbar,
+                    ranges,
+                    retries,
+                )
+                for segment in state["segments"]
+            )
+        )
+
+    received = part_path.stat().st_size
+
+    if size is not None and (
+        received != size or sum(s["done"] for s in state["segments"]) != size
+    ):
+        _state_path(file_path).unlink()
+        part_path.unlink()
+        raise ValueError(f"{file_name} is {received} bytes, expected {size}")
+
+    # NOTE: checksums are given as "algorithm:hex", e.g. "sha256:ab12..."
+    if checksum is not None:
+        algorithm, expected = checksum.split(":", 1)
+        found = await asyncio.to_thread(_checksum, part_path, algorithm)
+
+        if found != expected.lower():
+            _state_path(file_path).unlink()
+            part_path.unlink()
+            raise ValueError(
+                f"{file_name} {algorithm} must be {expected}, got {found!r}"
+            )
+
+    part_path.replace(file_path)
+    _state_path(file_path).unlink()
+
+    return file_path
+
+
+async def download_files(
+    urls,
+    path=Path("data", "misc", "bulk_downloads"),
+    checksums=None,
+    segment_size=2**28,
+    max_segments=8,
+    max_connections=16,
+    retries=3,
+):
+    path.mkdir(parents=True, exist_ok=True)
+    checksums = checksums or {}
+
+    # NOTE: one pooled client for every file, the connection limit caps the
+    # segments in flight across all downloads
+    limits = httpx.Limits(
+        max_connections=max_connections, max_keepalive_connections=max_connections
+    )
+    timeout = httpx.Timeout(60, pool=None)
+
+    async with httpx.AsyncClient(
+        follow_redirects=True, limits=limits, timeout=timeout
+    ) as client:
+        file_paths = await asyncio.gather(
+            *(
+                _download(
+                    client,
+                    url,
+                    path,
+                    segment_size,
+                    max_segments,
+                    checksums.get(name),
+                    retries,
+                    position,
+                )
+                for position, (name, url) in enumerate(urls.items())
+            )
+        )
+
+    return dict(zip(urls, file_paths))
+
+
+def download_file(url, path=Path("data", "misc", "bulk_downloads"), checksum=None):
+    name = url.split("/")[-1]
+
+    return asyncio.run(download_files({name: url}, path, checksums={name: checksum}))[
+        name
+    ]
+
+
+def _open_table(archive_path):
+    # NOTE: the tsv is read straight out of the archive, never unpacked
+    if zipfile.is_zipfile(archive_path):
+        archive = zipfile.ZipFile(archive_path)
+        members = [name for name in archive.namelist() if name.endswith(".tsv")]
+
+        if len(members) != 1:
+            raise ValueError(
+                f"{archive_path.name} must hold one tsv file, got {members}"
+            )
+
+        return Path(members[0]).stem, archive.open(members[0])
+
+    if archive_path.suffix == ".gz":
+        return Path(archive_path.stem).stem, gzip.open(archive_path, "rb")
+
+    return archive_path.stem, open(archive_path, "rb")
+
+
+def _read_blocks(stream, block_size, quote_char):
+    quote = quote_char.encode() if quote_char else None
+    rest = b""
+
+    while data := stream.read(block_size):
+        block = rest + data
+        cut = block.rfind(b"\n")
+
+        # NOTE: a newline inside quotes does not end a row, quotes are
+        # doubled when escaped so an odd count means the cut is inside one
+        while quote and cut != -1 and block.count(quote, 0, cut) % 2:
+            cut = block.rfind(b"\n", 0, cut)
+
+        if cut == -1:
+            rest = block
+            continue
+
+        yield block[: cut + 1]
+        rest = block[cut + 1 :]
+
+    if rest.strip():
+        yield rest
+
+
+def _scan_table(archive_path, block_size):
+    table, stream = _open_table(archive_path)
+    schema = get_schema(table)
+
+    header = stream.readline().decode().rstrip("\r\n").split("\t")
+    header = [column.strip(schema.quote_char or "") for column in header]
+
+    if header != list(schema.columns):
+        raise ValueError(
+            f"{table} columns must be {list(schema.columns)} for schema version "
+            f"{schema.version}, got {header}"
+        )
+
+    def source(with_columns, predicate, n_rows, batch_size):
+        with stream:
+            for block in _read_blocks(stream, block_size, schema.quote_char):
+                df = pl.read_csv(
+                    block,
+                    has_header=False,
+                    separator="\t",
+                    schema=schema.columns,
+                    quote_char=schema.quote_char,
+                )
+
+                if with_columns is not None:
+                    df = df.select(with_columns)
+                if predicate is not None:
+                    df = df.filter(predicate)
+                if n_rows is not None:
+                    df = df.head(n_rows)
+                    n_rows -= df.height
+
+                yield df
+
+                if n_rows == 0:
+                    return
+
+    return table, register_io_source(source, schema=schema.columns)
+
+
+def convert_archive(
+    archive_path,
+    save_path=Path("data", "raw", "bulk_downloads"),
+    block_size=2**26,
+    row_group_size=500_000,
+    compression="zstd",
+):
+    table, lf = _scan_table(archive_path, block_size)
+
+    file_path = save_path / f"{table}.parquet"
+    temp_path = file_path.with_suffix(".tmp")
+
+    # NOTE: rows stream from the archive into the parquet file a block at a
+    # time, so neither the tsv nor the full table is ever held on disk or in
+    # memory
+    lf.sink_parquet(temp_path, row_group_size=row_group_size, compression=compression)
+    temp_path.replace(file_path)
+
+    return table, get_schema(table).version
+
+
+def convert_files(
+    archive_paths=None,
+    tsv_path=Path("data", "misc", "bulk_downloads"),
+    parquet_path=Path("data", "raw", "bulk_downloads"),
+    n_workers=4,
+    block_size=2**26,
+    row_group_size=500_000,
+    compression="zstd",
+    remove_archives=True,
+):
     parquet_path.mkdir(parents=True, exist_ok=True)
 
-    for file_path in tsv_path.iterdir():
-        if file_path.is_file():
-            save_path = parquet_path / file_path.with_suffix(".parquet").name
-            pl.scan_csv(
-                file_path, separator="\t", infer_schema_length=None
-            ).sink_parquet(save_path)
+    if archive_paths is None:
+        archive_paths = sorted(
+            file_path
+            for file_path in tsv_path.iterdir()
+            if file_path.is_file() and ".tsv" in file_path.suffixes
+        )
+
+    manifest_path = parquet_path.with_name(f"{parquet_path.name}_manifest.json")
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    arguments = (parquet_path, block_size, row_group_size, compression)
+
+    # NOTE: one file per worker, the polars threads are split between them
+    threads = max(os.cpu_count() // n_workers, 1)
+    previous_threads = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(threads)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(convert_archive, archive_path, *arguments): archive_path
+                for archive_path in archive_paths
+            }
+
+            for future in as_completed(futures):
+                table, version = future.result()
+                manifest[table] = {
+                    "schema_version": version,
+                    "source": futures[future].name,
+                }
+                print(f"converted {table} (schema version {version})")
+
+                if remove_archives:
+                    futures[future].unlink()
+    finally:
+        if previous_threads is None:
+            os.environ.pop("POLARS_MAX_THREADS")
+        else:
+            os.environ["POLARS_MAX_THREADS"] = previous_threads
+
+    temp_path = manifest_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest, indent=2))
+    temp_path.replace(manifest_path)
 
 
 if __name__ == "__main__":
@@ -68,11 +482,12 @@ if __name__ == "__main__":
 
     urls = config["bulk_urls"]
 
-    # Extract URLs from the polars Series and download each file
-    for name, url in urls.items():
-        print(f"Downloading {name}...")
-        download_file(url)
-        print(f"Downloaded and extracted {name}")
+    # Download every file at once, checksums are optional in the config
+    print(f"Downloading {', '.join(urls)}...")
+    file_paths = asyncio.run(
+        download_files(urls, checksums=config.get("bulk_checksums"))
+    )
+    print(f"Downloaded {len(urls)} files")
 
-    # Conversion to parquet
-    convert_files()
+    # Conversion to parquet, straight from the archives
+    convert_files(list(file_paths.values()))
@@ -1,26 +1,25 @@
 from pathlib import Path
 
-import polars as pl
-
-from lse_diss.data.bulk_data import download_file
+from lse_diss.data.bulk_data import convert_archive, download_file
 
 
 def extract_names(
-    path=Path("data", "misc", "OSMNames", "planet-latest_geonames.tsv"),
+    path=Path("data", "misc", "OSMNames", "planet-latest_geonames.tsv.gz"),
+    row_group_size=500_000,
+    compression="zstd",
 ):
-    save_path = path.with_suffix("").with_suffix(".parquet")
-
-    pl.scan_csv(
-        path.with_suffix(""), separator="\t", infer_schema_length=None
-    ).sink_parquet(save_path)
+    # NOTE: converted straight from the gzip, the planet tsv is never unpacked
+    convert_archive(
+        path, path.parent, row_group_size=row_group_size, compression=compression
+    )
 
-    save_path.unlink()
+    path.unlink()
 
 
 if __name__ == "__main__":
-    download_file(
+    archive_path = download_file(
         "https://github.com/OSMNames/OSMNames/releases/download/v2.0.4/planet-latest_geonames.tsv.gz",
         Path("data", "misc", "OSMNames"),
     )
 
-    extract_names()
+    extract_names(archive_path)
@@ -0,0 +1,108 @@
+from typing import NamedTuple
+
+import polars as pl
+
+
+class TableSchema(NamedTuple):
+    version: int
+    columns: dict
+    quote_char: str | None
+
+
+# NOTE: bump a table's version whenever its columns or dtypes change, the
+# version is recorded next to the converted files. Ids and codes stay strings
+# (design patent ids and FIPS codes are not numbers) and PatentsView dates
+# stay strings since some of them are not valid dates
+SCHEMAS = {
+    "g_cpc_current": TableSchema(
+        version=1,
+        columns={
+            "patent_id": pl.String,
+            "cpc_sequence": pl.Int64,
+            "cpc_section": pl.String,
+            "cpc_class": pl.String,
+            "cpc_subclass": pl.String,
+            "cpc_group": pl.String,
+            "cpc_type": pl.String,
+        },
+        quote_char='"',
+    ),
+    "g_cpc_title": TableSchema(
+        version=1,
+        columns={
+            "cpc_subclass": pl.String,
+            "cpc_subclass_title": pl.String,
+            "cpc_group": pl.String,
+            "cpc_group_title": pl.String,
+            "cpc_class": pl.String,
+            "cpc_class_title": pl.String,
+        },
+        quote_char='"',
+    ),
+    "g_location_disambiguated": TableSchema(
+        version=1,
+        columns={
+            "location_id": pl.String,
+            "disambig_city": pl.String,
+            "disambig_state": pl.String,
+            "disambig_country": pl.String,
+            "latitude": pl.Float64,
+            "longitude": pl.Float64,
+            "county": pl.String,
+            "state_fips": pl.String,
+            "county_fips": pl.String,
+        },
+        quote_char='"',
+    ),
+    "g_us_patent_citation": TableSchema(
+        version=1,
+        columns={
+            "patent_id": pl.String,
+            "citation_sequence": pl.Int64,
+            "citation_patent_id": pl.String,
+            "citation_date": pl.String,
+            "record_name": pl.String,
+            "wipo_kind": pl.String,
+            "citation_category": pl.String,
+        },
+        quote_char='"',
+    ),
+    # NOTE: OSMNames is not quoted, names can contain stray quote marks
+    "planet-latest_geonames": TableSchema(
+        version=1,
+        columns={
+            "name": pl.String,
+            "alternative_names": pl.String,
+            "osm_type": pl.String,
+            "osm_id": pl.Int64,
+            "class": pl.String,
+            "type": pl.String,
+            "lon": pl.Float64,
+            "lat": pl.Float64,
+            "place_rank": pl.Int64,
+            "importance": pl.Float64,
+            "street": pl.String,
+            "city": pl.String,
+            "county": pl.String,
+            "state": pl.String,
+            "country": pl.String,
+            "country_code": pl.String,
+            "display_name": pl.String,
+            "west": pl.Float64,
+            "south": pl.Float64,
+            "east": pl.Float64,
+            "north": pl.Float64,
+            "wikidata": pl.String,
+            "wikipedia": pl.String,
+            "housenumbers": pl.String,
+        },
+        quote_char=None,
+    ),
+}
+
+
+def get_schema(table):
+    if table not in SCHEMAS:
+        raise ValueError(f"table must be one of {list(SCHEMAS)}, got {table!r}")
+
+    return SCHEMAS[table]
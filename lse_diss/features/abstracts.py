@@ -9,19 +9,21 @@ def filter_abstracts(
     save_path=Path("data", "interim", "abstracts.parquet"),
 ):
     patents = (
-        pl.scan_parquet(patents_path).select("patent_id", "patent_abstract").unique()
+        pl.scan_parquet(patents_path)
+        .select("patent_key", "patent_id", "patent_abstract")
+        .unique("patent_key")
     )
 
     controls = (
         pl.scan_parquet(controls_path)
-        .select("citing_patent_id", "control_patent_id")
+        .select("citing_patent_key", "control_patent_key")
         .unpivot()
         .select("value")
         .unique()
     )
 
     abstracts = patents.join(
-        controls, left_on="patent_id", right_on="value", how="inner"
+        controls, left_on="patent_key", right_on="value", how="inner"
     )
 
     abstracts.sink_parquet(save_path)
@@ -38,14 +40,14 @@ def filter_embeddings(
 
     controls = (
         pl.scan_parquet(controls_path)
-        .select("citing_patent_id", "control_patent_id")
+        .select("citing_patent_key", "control_patent_key")
         .unpivot()
         .select("value")
         .unique()
     )
 
     abstracts = embeddings.join(
-        controls, left_on="patent_id", right_on="value", how="inner"
+        controls, left_on="patent_key", right_on="value", how="inner"
     )
 
     abstracts.sink_parquet(
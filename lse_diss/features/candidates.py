@@ -0,0 +1,153 @@
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+from lse_diss.features.inventors import InventorSets, encode_inventors, sets_disjoint
+
+
+class SortedControls(NamedTuple):
+    controls: pl.DataFrame
+    dates: np.ndarray
+    patent_keys: np.ndarray
+    assignee_codes: np.ndarray
+    assignee_keys: pl.DataFrame
+    inventor_sets: InventorSets
+
+
+def _make_keys(patents, column):
+    return (
+        patents.select(column)
+        .unique()
+        .drop_nulls()
+        .sort(column)
+        .with_row_index("code")
+        .collect()
+    )
+
+
+def _lookup(df, keys, column):
+    # NOTE: missing keys become -1 so they never equal a control code
+    return (
+        df.select(column)
+        .join(
+            keys,
+            left_on=column,
+            right_on=keys.columns[1],
+            how="left",
+            maintain_order="left",
+        )
+        .get_column("code")
+        .cast(pl.Int64)
+        .fill_null(-1)
+        .to_numpy()
+    )
+
+
+def _keys(df, column):
+    return df.get_column(column).cast(pl.Int64).to_numpy()
+
+
+def sort_controls(patents, base_year=2005, duration=3, inventor_sets=None):
+    start_date = pl.date(base_year, 1, 1)
+    end_date = pl.date(base_year + duration, 1, 1)
+
+    assignee_keys = _make_keys(patents, "assignee_id")
+
+    # NOTE: sorted once so every citing patent's window is a contiguous slice
+    controls = (
+        patents.filter(pl.col("grant_date").is_between(start_date, end_date))
+        .select(pl.exclude(["grant_date", "originating_dummy"]))
+        .select(pl.all().name.prefix("control_"))
+        .sort("control_application_date", "control_patent_key", maintain_order=True)
+        .collect()
+    )
+
+    return SortedControls(
+        controls=controls.select(pl.exclude("control_inventor_id")),
+        dates=controls.get_column("control_application_date").to_physical().to_numpy(),
+        patent_keys=_keys(controls, "control_patent_key"),
+        assignee_codes=_lookup(controls, assignee_keys, "control_assignee_id"),
+        assignee_keys=assignee_keys,
+        inventor_sets=(
+            encode_inventors(patents) if inventor_sets is None else inventor_sets
+        ),
+    )
+
+
+def _windows(sorted_controls, citing):
+    lower = np.searchsorted(
+        sorted_controls.dates,
+        citing.get_column("min_date").to_physical().to_numpy(),
+        side="left",
+    )
+    upper = np.searchsorted(
+        sorted_controls.dates,
+        citing.get_column("max_date").to_physical().to_numpy(),
+        side="right",
+    )
+
+    return lower, upper
+
+
+def count_candidates(sorted_controls, citing):
+    lower, upper = _windows(sorted_controls, citing)
+
+    return np.maximum(upper - lower, 0)
+
+
+def find_candidates(sorted_controls, citing):
+    citing = citing.collect() if isinstance(citing, pl.LazyFrame) else citing
+
+    lower, upper = _windows(sorted_controls, citing)
+
+    counts = np.maximum(upper - lower, 0)
+    offsets = np.cumsum(counts) - counts
+
+    # NOTE: one (citing row, control row) pair per control inside the window
+    citing_rows = np.repeat(np.arange(citing.height), counts)
+    control_rows = lower[citing_rows] + np.arange(counts.sum()) - offsets[citing_rows]
+
+    citing_keys = _keys(citing, "citing_patent_key")[citing_rows]
+    cited_keys = _keys(citing, "cited_patent_key")[citing_rows]
+    control_keys = sorted_controls.patent_keys[control_rows]
+
+    cited_assignees = _lookup(
+        citing, sorted_controls.assignee_keys, "cited_assignee_id"
+    )[citing_rows]
+    control_assignees = sorted_controls.assignee_codes[control_rows]
+
+    keep = (
+        (control_keys != citing_keys)
+        & (control_keys != cited_keys)
+        & (control_assignees != cited_assignees)
+        # NOTE: null assignees never compare unequal in the join either
+        & (control_assignees >= 0)
+        & (cited_assignees >= 0)
+    )
+
+    keep[keep] = sets_disjoint(
+        sorted_controls.inventor_sets, cited_keys[keep], control_keys[keep]
+    )
+
+    candidates = pl.DataFrame(
+        {
+            "citing_patent_key": citing_keys[keep],
+            "cited_patent_key": cited_keys[keep],
+            "control_patent_key": control_keys[keep],
+        },
+        schema=dict.fromkeys(
+            ["citing_patent_key", "cited_patent_key", "control_patent_key"],
+            pl.UInt32,
+        ),
+    )
+
+    # NOTE: only repeated pairs or repeated controls can produce duplicates
+    repeated = (
+        citing.select("citing_patent_key", "cited_patent_key").is_duplicated().any()
+        or sorted_controls.controls.get_column("control_patent_key")
+        .is_duplicated()
+        .any()
+    )
+
+    return candidates.unique() if repeated else candidates
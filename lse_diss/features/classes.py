@@ -8,17 +8,19 @@ def filter_classes(
     patents_path=Path("data", "processed", "controls.parquet"),
     save_path=Path("data", "processed", "classes.parquet"),
 ):
+    # NOTE: utility patent ids are numeric, so the join runs on integers
     classes = (
         pl.scan_parquet(classes_path)
-        .select(pl.col("patent_id").cast(pl.Utf8), pl.col("cpc_section"))
+        .select(pl.col("patent_id").cast(pl.Int64, strict=False), pl.col("cpc_section"))
         .unique()
     )
 
     patents = (
         pl.scan_parquet(patents_path)
-        .unpivot()
+        .unpivot(["cited_patent_id", "citing_patent_id", "control_patent_id"])
         .unique()
-        .join(classes, left_on="value", right_on="patent_id", how="left")
+        .with_columns(pl.col("value").cast(pl.Int64, strict=False).alias("number"))
+        .join(classes, left_on="number", right_on="patent_id", how="left")
         .with_columns(
             pl.when(pl.col("variable") == "cited_patent_id")
             .then(1)
@@ -1,9 +1,31 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from math import ceil
+from multiprocessing import get_context
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 from tqdm import tqdm
 
+from lse_diss.features.candidates import (
+    count_candidates,
+    find_candidates,
+    sort_controls,
+)
+from lse_diss.features.graph import citing_patents, has_citation, open_graph
+from lse_diss.features.inventors import encode_inventors, sets_disjoint
+from lse_diss.features.layout import scan_keys
+
+# NOTE: approximate peak bytes per candidate row while a batch is expanded.
+# find_candidates measured about 140 bytes of numpy arrays and 12 of output per
+# row with tracemalloc on the 20k synthetic cohort, the rest is headroom for
+# the remove_cited join and for inventor sets too large for the padded path
+CANDIDATE_ROW_BYTES = 256
+
+_worker_state = {}
+
 
 def make_originating(
     patents_path=Path("data", "interim", "patents"),
@@ -16,7 +38,7 @@ def make_originating(
 
     patents = (
         pl.scan_parquet(patents_path)
-        .group_by("patent_id", "assignee_id", "grant_date", "application_date")
+        .group_by("patent_key", "assignee_id", "grant_date", "application_date")
         .agg(pl.col("inventor_id"))
         .with_columns(
             pl.when(pl.col("grant_date").is_between(start_date, end_date))
@@ -34,61 +56,74 @@ def make_treated(
     citations_path=Path("data", "interim", "citations.parquet"),
     base_year=2005,
     duration=3,
+    graph_path=None,
+    inventor_sets=None,
 ):
     start_date = pl.date(base_year, 1, 1)
     end_date = pl.date(base_year + duration, 1, 1)
 
     # NOTE: potential treatment members
-    patents = df.filter(pl.col("grant_date").is_between(start_date, end_date)).select(
-        "patent_id", "assignee_id", "inventor_id"
-    )
+    patents = df.filter(pl.col("grant_date").is_between(start_date, end_date))
 
-    citations = pl.scan_parquet(citations_path).select(
-        ["cited_patent_id", "citing_patent_id"]
+    originating = (
+        df.filter(originating_dummy=1)
+        .select("patent_key", "assignee_id")
+        .rename({"patent_key": "cited_patent_key"})
     )
 
+    if graph_path is None:
+        # NOTE: a pair cited under several categories is one edge, as in the
+        # graph, so both paths give the same pairs
+        citations = (
+            pl.scan_parquet(citations_path)
+            .select(["cited_patent_key", "citing_patent_key"])
+            .unique()
+        )
+    else:
+        # NOTE: the patents citing the originating ones are read off the graph
+        originating = originating.collect()
+        cited, citing = citing_patents(
+            open_graph(graph_path, citations_path),
+            originating.get_column("cited_patent_key").to_numpy(),
+        )
+        citations = pl.LazyFrame(
+            {"cited_patent_key": cited, "citing_patent_key": citing}
+        )
+        originating = originating.lazy()
+
     pairs = (
-        df.filter(originating_dummy=1)
-        .select("patent_id", "assignee_id", "inventor_id")
-        .rename({"patent_id": "cited_patent_id"})
-        .join(citations, on="cited_patent_id", validate="1:m")
-        .join(patents, left_on="citing_patent_id", right_on="patent_id")
-        # NOTE: removes self-cites
-        .filter(
-            pl.col("assignee_id") != pl.col("assignee_id_right"),
-            pl.col("inventor_id")
-            .list.set_intersection("inventor_id_right")
-            .list.len()
-            .eq(0),
+        originating.join(citations, on="cited_patent_key", validate="1:m")
+        .join(
+            patents.select("patent_key", "assignee_id"),
+            left_on="citing_patent_key",
+            right_on="patent_key",
         )
-        .select("citing_patent_id", "cited_patent_id")
+        # NOTE: removes self-cites
+        .filter(pl.col("assignee_id") != pl.col("assignee_id_right"))
+        .select("citing_patent_key", "cited_patent_key")
+        .collect()
     )
 
-    return pairs
+    # NOTE: encoded by the caller when save_controls reuses the same sets
+    if inventor_sets is None:
+        inventor_sets = encode_inventors(df)
 
+    distinct = sets_disjoint(
+        inventor_sets,
+        pairs.get_column("cited_patent_key").to_numpy(),
+        pairs.get_column("citing_patent_key").to_numpy(),
+    )
 
-def make_controls(
-    patents,
-    treated,
-    base_year=2005,
-    duration=3,
-    search_range=30,
-):
-    start_date = pl.date(base_year, 1, 1)
-    end_date = pl.date(base_year + duration, 1, 1)
+    return pairs.filter(distinct).lazy()
 
-    potential_controls = (
-        patents.filter(pl.col("grant_date").is_between(start_date, end_date))
-        .select(pl.exclude(["grant_date", "originating_dummy"]))
-        .select(pl.all().name.prefix("control_"))
-    )
 
+def make_citing(patents, treated, search_range=30):
     citing = (
         treated.join(
             patents.select(
-                pl.col(["patent_id", "application_date"]).name.prefix("citing_")
+                pl.col(["patent_key", "application_date"]).name.prefix("citing_")
             ),
-            on="citing_patent_id",
+            on="citing_patent_key",
         )
         .with_columns(
             (pl.col("citing_application_date") - pl.duration(days=search_range)).alias(
@@ -103,18 +138,39 @@ def make_controls(
 
     cited = citing.join(
         patents.select(
-            pl.col(["patent_id", "assignee_id", "inventor_id"]).name.prefix("cited_")
+            pl.col(["patent_key", "assignee_id", "inventor_id"]).name.prefix("cited_")
         ),
-        on="cited_patent_id",
+        on="cited_patent_key",
     )
 
+    return cited
+
+
+def make_controls(
+    patents,
+    treated,
+    base_year=2005,
+    duration=3,
+    search_range=30,
+):
+    start_date = pl.date(base_year, 1, 1)
+    end_date = pl.date(base_year + duration, 1, 1)
+
+    potential_controls = (
+        patents.filter(pl.col("grant_date").is_between(start_date, end_date))
+        .select(pl.exclude(["grant_date", "originating_dummy"]))
+        .select(pl.all().name.prefix("control_"))
+    )
+
+    cited = make_citing(patents, treated, search_range=search_range)
+
     joined = cited.join_where(
         potential_controls,
         pl.col("control_application_date").is_between(
             pl.col("min_date"), pl.col("max_date")
         ),
-        pl.col("citing_patent_id") != pl.col("control_patent_id"),
-        pl.col("cited_patent_id") != pl.col("control_patent_id"),
+        pl.col("citing_patent_key") != pl.col("control_patent_key"),
+        pl.col("cited_patent_key") != pl.col("control_patent_key"),
         pl.col("cited_assignee_id") != pl.col("control_assignee_id"),
     )
 
@@ -124,55 +180,283 @@ def make_controls(
             pl.col("control_application_date").is_between(
                 pl.col("min_date"), pl.col("max_date")
             ),
-            pl.col("citing_patent_id") != pl.col("control_patent_id"),
-            pl.col("cited_patent_id") != pl.col("control_patent_id"),
+            pl.col("citing_patent_key") != pl.col("control_patent_key"),
+            pl.col("cited_patent_key") != pl.col("control_patent_key"),
             pl.col("cited_assignee_id") != pl.col("control_assignee_id"),
             pl.col("cited_inventor_id")
             .list.set_intersection(pl.col("control_inventor_id"))
             .list.len()
             .eq(0),
         )
-        .select(["citing_patent_id", "cited_patent_id", "control_patent_id"])
+        .select(["citing_patent_key", "cited_patent_key", "control_patent_key"])
         .unique()
     )
 
     return result
 
 
-def remove_cited(df, citations_path=Path("data", "interim", "citations.parquet")):
-    citations = pl.scan_parquet(citations_path).select(
-        pl.col("cited_patent_id"), pl.col("citing_patent_id").alias("control_patent_id")
+def remove_cited(
+    df, citations_path=Path("data", "interim", "citations.parquet"), graph_path=None
+):
+    if graph_path is not None:
+        controls = df.collect()
+
+        # NOTE: a pair lookup in the graph for every row instead of a join
+        cited = has_citation(
+            open_graph(graph_path, citations_path),
+            controls.get_column("control_patent_key").to_numpy(),
+            controls.get_column("cited_patent_key").to_numpy(),
+        )
+
+        return controls.filter(~cited).lazy()
+
+    cited = df.select("cited_patent_key").unique().collect()
+
+    # NOTE: only the citations of this batch's cited patents are read, which
+    # skips most of the file once it is sorted by relayout_tables
+    citations = scan_keys(
+        citations_path, "cited_patent_key", cited.get_column("cited_patent_key")
+    ).select(
+        pl.col("cited_patent_key"),
+        pl.col("citing_patent_key").alias("control_patent_key"),
     )
 
     controls = df.join(
-        citations, on=["cited_patent_id", "control_patent_id"], how="anti"
+        citations, on=["cited_patent_key", "control_patent_key"], how="anti"
     )
 
     return controls
 
 
+def make_batch(
+    patents,
+    pairs,
+    sorted_controls=None,
+    base_year=2005,
+    duration=3,
+    search_range=30,
+    memory_budget=None,
+    graph_path=None,
+):
+    if sorted_controls is None:
+        potential_controls = make_controls(
+            patents.lazy(),
+            pairs.lazy(),
+            base_year=base_year,
+            duration=duration,
+            search_range=search_range,
+        ).collect()
+    else:
+        citing = make_citing(
+            patents.lazy(), pairs.lazy(), search_range=search_range
+        ).collect()
+
+        # NOTE: window sizes are known before expanding, so the batch is split
+        # into chunks whose candidate rows fit in the memory budget
+        counts = count_candidates(sorted_controls, citing)
+        max_rows = (
+            max(memory_budget // CANDIDATE_ROW_BYTES, 1)
+            if memory_budget
+            else max(counts.sum(), 1)
+        )
+        chunk_ids = np.cumsum(counts) // max_rows
+
+        chunks = [
+            find_candidates(sorted_controls, citing.filter(chunk_ids == chunk_id))
+            for chunk_id in np.unique(chunk_ids)
+        ]
+
+        if len(chunks) == 1:
+            potential_controls = chunks[0]
+        elif chunks:
+            potential_controls = pl.concat(chunks).unique()
+        else:
+            potential_controls = find_candidates(sorted_controls, citing)
+
+    # NOTE: sorted so that files are identical whatever the worker count
+    controls = (
+        remove_cited(potential_controls.lazy(), graph_path=graph_path)
+        .collect()
+        .sort(["citing_patent_key", "cited_patent_key", "control_patent_key"])
+    )
+
+    return controls
+
+
+def _write_batch(state, i, pairs, file_name):
+    controls = make_batch(pairs=pairs, **state)
+
+    temp_name = file_name.with_suffix(".tmp")
+    controls.write_parquet(temp_name)
+    temp_name.replace(file_name)
+
+    return i, controls.height
+
+
+def _start_worker(state):
+    _worker_state.update(state)
+
+
+def _write_worker_batch(i, pairs, file_name):
+    return _write_batch(_worker_state, i, pairs, file_name)
+
+
+def _manifest_path(path):
+    # NOTE: kept beside the directory so scans of it only see parquet files
+    return path.with_name(f"{path.name}_manifest.json")
+
+
+def _read_manifest(path, parameters):
+    manifest_path = _manifest_path(path)
+
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+
+        if manifest["parameters"] == parameters:
+            return manifest
+
+        print("controls parameters changed, discarding previous batches")
+
+    for file_path in path.glob("controls_*.parquet"):
+        file_path.unlink()
+
+    return {"parameters": parameters, "batches": {}}
+
+
+def _write_manifest(path, manifest):
+    manifest_path = _manifest_path(path)
+    temp_path = manifest_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest, indent=2))
+    temp_path.replace(manifest_path)
+
+
 def save_controls(
     patents,
     pairs,
+    base_year=2005,
     duration=3,
     search_range=30,
     path=Path("data", "interim", "controls"),
     batch_size=500,
+    engine="sorted",
+    n_workers=1,
+    memory_budget=None,
+    graph_path=None,
+    inventor_sets=None,
 ):
     path.mkdir(parents=True, exist_ok=True)
 
-    total_pairs = pairs.select(pl.len()).collect().item(0, 0)
+    if engine not in ["sorted", "join"]:
+        raise ValueError(f"engine must be 'sorted' or 'join', got {engine!r}")
+
+    # NOTE: pairs are materialised in a fixed order, slicing a lazy join would
+    # give batches that change from run to run
+    pairs = pairs.collect().sort(pl.all())
+    patents = patents.collect()
+
+    total_pairs = pairs.height
     total_batches = ceil(total_pairs / batch_size)
 
-    for i in tqdm(range(total_batches), desc="Processing batches", unit="batch"):
-        file_name = path / (f"controls_{i}" + ".parquet")
+    parameters = {
+        "base_year": base_year,
+        "duration": duration,
+        "search_range": search_range,
+        "batch_size": batch_size,
+        "engine": engine,
+        "total_pairs": total_pairs,
+        "pairs_hash": str(pairs.hash_rows(seed=0).sum()),
+        # NOTE: rows hash lists only as strings, inventors are sorted first
+        # since their order comes from the scan
+        "patents_hash": str(
+            patents.with_columns(pl.col("inventor_id").list.sort().list.join("\x1f"))
+            .hash_rows(seed=0)
+            .sum()
+        ),
+    }
 
-        start = i * batch_size
-        length = min(batch_size, total_pairs - start)
+    # NOTE: partial files left behind by an interrupted run
+    for file_path in path.glob("controls_*.tmp"):
+        file_path.unlink()
 
-        sliced_pairs = pairs.slice(start, length)
-        potential_controls = make_controls(
-            patents, sliced_pairs, duration=duration, search_range=search_range
+    manifest = _read_manifest(path, parameters)
+
+    remaining = [
+        i
+        for i in range(total_batches)
+        if str(i) not in manifest["batches"]
+        or not (path / f"controls_{i}.parquet").exists()
+    ]
+
+    if len(remaining) < total_batches:
+        print(f"resuming controls, {total_batches - len(remaining)} batches done")
+
+    state = {
+        "patents": patents,
+        "sorted_controls": (
+            # NOTE: potential controls are sorted once instead of joined per batch
+            sort_controls(
+                patents.lazy(),
+                base_year=base_year,
+                duration=duration,
+                inventor_sets=inventor_sets,
+            )
+            if engine == "sorted"
+            else None
+        ),
+        "base_year": base_year,
+        "duration": duration,
+        "search_range": search_range,
+        "memory_budget": memory_budget,
+        "graph_path": graph_path,
+    }
+
+    batches = (
+        (
+            i,
+            pairs.slice(i * batch_size, batch_size),
+            path / (f"controls_{i}" + ".parquet"),
         )
-        controls = remove_cited(potential_controls)
-        controls.sink_parquet(file_name)
+        for i in remaining
+    )
+
+    progress = tqdm(total=len(remaining), desc="Processing batches", unit="batch")
+
+    def record(i, rows):
+        manifest["batches"][str(i)] = {
+            "pairs": min(batch_size, total_pairs - i * batch_size),
+            "rows": rows,
+        }
+        _write_manifest(path, manifest)
+        progress.update()
+
+    _write_manifest(path, manifest)
+
+    if n_workers == 1:
+        for batch in batches:
+            record(*_write_batch(state, *batch))
+    else:
+        # NOTE: polars threads are split between workers instead of oversubscribed
+        threads = max(os.cpu_count() // n_workers, 1)
+        previous_threads = os.environ.get("POLARS_MAX_THREADS")
+        os.environ["POLARS_MAX_THREADS"] = str(threads)
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=get_context("spawn"),
+                initializer=_start_worker,
+                initargs=(state,),
+            ) as executor:
+                futures = [
+                    executor.submit(_write_worker_batch, *batch) for batch in batches
+                ]
+
+                for future in as_completed(futures):
+                    record(*future.result())
+        finally:
+            if previous_threads is None:
+                os.environ.pop("POLARS_MAX_THREADS")
+            else:
+                os.environ["POLARS_MAX_THREADS"] = previous_threads
+
+    progress.close()
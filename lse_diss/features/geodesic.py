@@ -0,0 +1,147 @@
+import numpy as np
+from geopy import distance
+from geopy.distance import EARTH_RADIUS, ELLIPSOIDS
+
+# NOTE: Vincenty's inverse formula on WGS-84 agrees with geopy's Karney solver
+# to well under a millimetre whenever it converges, so TOLERANCE_KM is loose
+TOLERANCE_KM = 1e-6
+
+
+def _as_array(values):
+    # NOTE: polars float64 columns without nulls are zero-copy views here
+    if hasattr(values, "to_numpy"):
+        values = values.to_numpy()
+
+    return np.asarray(values, dtype=np.float64)
+
+
+def great_circle(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS):
+    lat1, lon1, lat2, lon2 = (
+        np.radians(_as_array(x)) for x in (lat1, lon1, lat2, lon2)
+    )
+
+    # NOTE: haversine form, stable for the short distances we mostly have
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def vincenty(
+    lat1,
+    lon1,
+    lat2,
+    lon2,
+    ellipsoid=ELLIPSOIDS["WGS-84"],
+    max_iterations=200,
+    tolerance=1e-12,
+):
+    major, minor, f = ellipsoid
+
+    lat1, lon1, lat2, lon2 = (
+        np.radians(_as_array(x)) for x in (lat1, lon1, lat2, lon2)
+    )
+
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lon_diff = lon2 - lon1
+    lambda_lon = lon_diff.copy()
+
+    sin_sigma = np.zeros_like(lambda_lon)
+    cos_sigma = np.ones_like(lambda_lon)
+    sigma = np.zeros_like(lambda_lon)
+    cos_sq_alpha = np.ones_like(lambda_lon)
+    cos2_sigma_m = np.zeros_like(lambda_lon)
+
+    # NOTE: rows drop out of the iteration as they converge
+    active = np.ones(lambda_lon.shape, dtype=bool)
+
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+
+        lam = lambda_lon[active]
+        su1, cu1, su2, cu2 = (
+            sin_u1[active],
+            cos_u1[active],
+            sin_u2[active],
+            cos_u2[active],
+        )
+
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        s_sigma = np.sqrt((cu2 * sin_lam) ** 2 + (cu1 * su2 - su1 * cu2 * cos_lam) ** 2)
+        c_sigma = su1 * su2 + cu1 * cu2 * cos_lam
+        sig = np.arctan2(s_sigma, c_sigma)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin_alpha = np.where(s_sigma == 0, 0.0, cu1 * cu2 * sin_lam / s_sigma)
+            csa = 1 - sin_alpha**2
+            # NOTE: equatorial lines have cos_sq_alpha == 0
+            c2sm = np.where(csa == 0, 0.0, c_sigma - 2 * su1 * su2 / csa)
+
+        c = f / 16 * csa * (4 + f * (4 - 3 * csa))
+        lam_next = lon_diff[active] + (1 - c) * f * sin_alpha * (
+            sig + c * s_sigma * (c2sm + c * c_sigma * (-1 + 2 * c2sm**2))
+        )
+
+        sin_sigma[active] = s_sigma
+        cos_sigma[active] = c_sigma
+        sigma[active] = sig
+        cos_sq_alpha[active] = csa
+        cos2_sigma_m[active] = c2sm
+        lambda_lon[active] = lam_next
+
+        converged = np.abs(lam_next - lam) <= tolerance
+        active[np.flatnonzero(active)[converged]] = False
+
+    u_sq = cos_sq_alpha * (major**2 - minor**2) / minor**2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = (
+        b
+        * sin_sigma
+        * (
+            cos2_sigma_m
+            + b
+            / 4
+            * (
+                cos_sigma * (-1 + 2 * cos2_sigma_m**2)
+                - b
+                / 6
+                * cos2_sigma_m
+                * (-3 + 4 * sin_sigma**2)
+                * (-3 + 4 * cos2_sigma_m**2)
+            )
+        )
+    )
+
+    distances = minor * a * (sigma - delta_sigma)
+
+    return distances, active
+
+
+def geodesic(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (_as_array(x) for x in (lat1, lon1, lat2, lon2))
+
+    distances, failed = vincenty(lat1, lon1, lat2, lon2)
+
+    # NOTE: Vincenty does not converge for nearly antipodal points, so those
+    # few rows go through geopy's Karney solver instead
+    for i in np.flatnonzero(failed):
+        distances[i] = distance.geodesic((lat1[i], lon1[i]), (lat2[i], lon2[i])).km
+
+    return distances
+
+
+def measure(lat1, lon1, lat2, lon2, method="geodesic"):
+    methods = {"geodesic": geodesic, "great_circle": great_circle}
+
+    if method not in methods:
+        raise ValueError(f"method must be one of {list(methods)}, got {method!r}")
+
+    return methods[method](lat1, lon1, lat2, lon2)
@@ -0,0 +1,177 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+from lse_diss.features.keys import n_keys
+
+
+class CitationGraph(NamedTuple):
+    cites_offsets: np.ndarray
+    cites: np.ndarray
+    cited_by_offsets: np.ndarray
+    cited_by: np.ndarray
+
+
+def _write_array(path, array):
+    temp_path = path.with_suffix(".tmp")
+    matrix = np.lib.format.open_memmap(
+        temp_path, mode="w+", dtype=array.dtype, shape=array.shape
+    )
+    matrix[:] = array
+    matrix.flush()
+    del matrix
+    temp_path.replace(path)
+
+
+def _hash_citations(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while data := f.read(2**24):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def _compress(sources, targets, n_nodes):
+    # NOTE: rows in key order with targets sorted within each row, so pair
+    # lookups are a binary search inside one row
+    order = np.lexsort((targets, sources))
+    offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_nodes), out=offsets[1:])
+
+    return offsets, targets[order]
+
+
+def make_graph(
+    citations_path=Path("data", "interim", "citations.parquet"),
+    save_path=Path("data", "interim", "citation_graph"),
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
+):
+    save_path.mkdir(parents=True, exist_ok=True)
+
+    edges = (
+        pl.scan_parquet(citations_path)
+        .select("citing_patent_key", "cited_patent_key")
+        .unique()
+        .collect()
+    )
+
+    citing = edges.get_column("citing_patent_key").to_numpy().astype(np.uint32)
+    cited = edges.get_column("cited_patent_key").to_numpy().astype(np.uint32)
+    del edges
+
+    n_nodes = n_keys(keys_path)
+
+    for name, (sources, targets) in {
+        "cites": (citing, cited),
+        "cited_by": (cited, citing),
+    }.items():
+        offsets, neighbours = _compress(sources, targets, n_nodes)
+        _write_array(save_path / f"{name}_offsets.npy", offsets)
+        _write_array(save_path / f"{name}.npy", neighbours)
+
+    # NOTE: the size, mtime and hash of the citations tie the graph to them
+    stat = citations_path.stat()
+    (save_path / "metadata.json").write_text(
+        json.dumps(
+            {
+                "nodes": n_nodes,
+                "edges": len(citing),
+                "citations_size": stat.st_size,
+                "citations_mtime_ns": stat.st_mtime_ns,
+                "citations_hash": _hash_citations(citations_path),
+            },
+            indent=2,
+        )
+    )
+
+    print(f"citation graph: {n_nodes} patents, {len(citing)} citations")
+
+
+def open_graph(
+    path=Path("data", "interim", "citation_graph"),
+    citations_path=None,
+):
+    # NOTE: also called from R with the path as a string
+    path = Path(path)
+
+    if citations_path is not None:
+        metadata = json.loads((path / "metadata.json").read_text())
+        stat = citations_path.stat()
+
+        # NOTE: a copy of the data keeps the size but not the mtime, the file
+        # is only read to compare hashes when the mtime alone differs
+        if metadata["citations_size"] != stat.st_size or (
+            metadata["citations_mtime_ns"] != stat.st_mtime_ns
+            and metadata.get("citations_hash") != _hash_citations(citations_path)
+        ):
+            raise ValueError(
+                f"citation graph in {path} is out of date with {citations_path}, "
+                "rebuild it with make_graph"
+            )
+
+    return CitationGraph(
+        *(
+            np.load(path / f"{name}.npy", mmap_mode="r")
+            for name in ["cites_offsets", "cites", "cited_by_offsets", "cited_by"]
+        )
+    )
+
+
+def _neighbours(offsets, targets, nodes):
+    nodes = np.asarray(nodes, dtype=np.int64)
+    starts = offsets[nodes]
+    lengths = offsets[nodes + 1] - starts
+
+    # NOTE: positions of every neighbour of every node, without a python loop
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(
+        lengths.sum()
+    )
+
+    return np.repeat(nodes, lengths).astype(np.uint32), targets[positions]
+
+
+def citing_patents(graph, cited):
+    return _neighbours(graph.cited_by_offsets, graph.cited_by, cited)
+
+
+def cited_patents(graph, citing):
+    return _neighbours(graph.cites_offsets, graph.cites, citing)
+
+
+def has_citation(graph, citing, cited):
+    citing = np.asarray(citing, dtype=np.int64)
+    cited = np.asarray(cited, dtype=np.uint32)
+
+    if len(graph.cites) == 0:
+        return np.zeros(len(citing), dtype=bool)
+
+    low = graph.cites_offsets[citing]
+    high = graph.cites_offsets[citing + 1]
+
+    # NOTE: one binary search per pair, run over all pairs at once
+    while True:
+        searching = low < high
+        if not searching.any():
+            break
+
+        middle = (low + high) // 2
+        below = searching & (
+            graph.cites[np.minimum(middle, len(graph.cites) - 1)] < cited
+        )
+
+        low = np.where(below, middle + 1, low)
+        high = np.where(searching & ~below, middle, high)
+
+    found = low < graph.cites_offsets[citing + 1]
+    found[found] = graph.cites[low[found]] == cited[found]
+
+    return found
+
+
+if __name__ == "__main__":
+    make_graph()
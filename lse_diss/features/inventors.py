@@ -0,0 +1,151 @@
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+# NOTE: most patents have only a few inventors, pairs of sets up to this size
+# are compared slot by slot without expanding them
+PADDED_WIDTH = 4
+EMPTY = np.iinfo(np.uint32).max
+
+
+class InventorSets(NamedTuple):
+    offsets: np.ndarray
+    values: np.ndarray
+
+
+def encode_inventors(patents):
+    patents = patents.lazy().select("patent_key", "inventor_id")
+
+    if isinstance(patents.collect_schema()["inventor_id"], pl.List):
+        patents = patents.explode("inventor_id")
+
+    inventors = patents.drop_nulls().unique()
+
+    inventor_keys = (
+        inventors.select("inventor_id")
+        .unique()
+        .sort("inventor_id")
+        .with_row_index("inventor_code")
+    )
+
+    sets = (
+        inventors.join(inventor_keys, on="inventor_id")
+        .group_by("patent_key")
+        .agg(pl.col("inventor_code").sort())
+        .sort("patent_key")
+        .collect()
+    )
+
+    # NOTE: row i of the CSR arrays holds the sorted codes of patent_key i,
+    # the extra last row is an empty set for patents without inventors
+    patent_keys = sets.get_column("patent_key").to_numpy()
+    n_rows = int(patent_keys.max()) + 1 if len(patent_keys) else 0
+
+    lengths = np.zeros(n_rows + 1, dtype=np.uint32)
+    lengths[patent_keys] = sets.get_column("inventor_code").list.len().to_numpy()
+
+    values = (
+        sets.get_column("inventor_code").explode().cast(pl.UInt32).to_numpy().copy()
+    )
+
+    offsets = np.zeros(
+        n_rows + 2, dtype=np.uint32 if len(values) <= EMPTY else np.int64
+    )
+    np.cumsum(lengths, out=offsets[1:])
+
+    string_size = (
+        inventors.group_by("patent_key")
+        .agg("inventor_id")
+        .select(pl.col("inventor_id"))
+        .collect()
+        .estimated_size("mb")
+    )
+    encoded_size = (offsets.nbytes + values.nbytes) / 1024**2
+
+    print(
+        f"inventor sets: {string_size:.1f} MB as string lists, "
+        f"{encoded_size:.1f} MB encoded"
+    )
+
+    return InventorSets(offsets=offsets, values=values)
+
+
+def _rows(inventor_sets, rows):
+    # NOTE: keys past the last patent with inventors get the empty last row
+    rows = np.asarray(rows, dtype=np.int64)
+    empty = len(inventor_sets.offsets) - 2
+
+    return np.where((rows >= 0) & (rows < empty), rows, empty)
+
+
+def _bounds(inventor_sets, rows):
+    starts = inventor_sets.offsets[rows].astype(np.int64)
+
+    return starts, inventor_sets.offsets[rows + 1].astype(np.int64) - starts
+
+
+def _expand(inventor_sets, rows):
+    starts, lengths = _bounds(inventor_sets, rows)
+
+    pairs = np.repeat(np.arange(len(rows), dtype=np.uint64), lengths)
+    positions = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+
+    values = inventor_sets.values[starts[pairs.astype(np.int64)] + positions]
+
+    # NOTE: sorted by pair then inventor, since each set is stored sorted
+    return pairs, (pairs << np.uint64(32)) | values.astype(np.uint64)
+
+
+def _padded(inventor_sets, rows):
+    # NOTE: built per batch from the CSR arrays, a padded copy of every set
+    # would be larger than the sets themselves
+    starts, lengths = _bounds(inventor_sets, rows)
+
+    padded = np.full((len(rows), PADDED_WIDTH), EMPTY, dtype=np.uint32)
+    for i in range(PADDED_WIDTH):
+        has_value = lengths > i
+        padded[has_value, i] = inventor_sets.values[starts[has_value] + i]
+
+    return padded
+
+
+def _shared_padded(inventor_sets, rows_a, rows_b):
+    a = _padded(inventor_sets, rows_a)
+    b = _padded(inventor_sets, rows_b)
+
+    shared = np.zeros(len(rows_a), dtype=bool)
+    for i in range(PADDED_WIDTH):
+        shared |= (a[:, [i]] == b).any(axis=1) & (a[:, i] != EMPTY)
+
+    return shared
+
+
+def _shared_expanded(inventor_sets, rows_a, rows_b):
+    _, keys_a = _expand(inventor_sets, rows_a)
+    pairs_b, keys_b = _expand(inventor_sets, rows_b)
+
+    shared = np.zeros(len(rows_a), dtype=bool)
+
+    if len(keys_a) and len(keys_b):
+        index = np.minimum(np.searchsorted(keys_a, keys_b), len(keys_a) - 1)
+        shared[pairs_b[keys_a[index] == keys_b].astype(np.int64)] = True
+
+    return shared
+
+
+def sets_disjoint(inventor_sets, rows_a, rows_b):
+    rows_a = _rows(inventor_sets, rows_a)
+    rows_b = _rows(inventor_sets, rows_b)
+
+    small = (_bounds(inventor_sets, rows_a)[1] <= PADDED_WIDTH) & (
+        _bounds(inventor_sets, rows_b)[1] <= PADDED_WIDTH
+    )
+
+    shared = np.zeros(len(rows_a), dtype=bool)
+    shared[small] = _shared_padded(inventor_sets, rows_a[small], rows_b[small])
+    shared[~small] = _shared_expanded(inventor_sets, rows_a[~small], rows_b[~small])
+
+    return ~shared
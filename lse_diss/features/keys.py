@@ -0,0 +1,90 @@
+from pathlib import Path
+
+import polars as pl
+
+
+def _history_path(path):
+    return path.with_name(f"{path.stem}_history.parquet")
+
+
+def _write(df, path):
+    temp_path = path.with_suffix(".tmp")
+    df.write_parquet(temp_path)
+    temp_path.replace(path)
+
+
+def make_keys(patents, save_path=Path("data", "interim", "patent_keys.parquet")):
+    patent_ids = patents.lazy().select("patent_id").unique()
+
+    # NOTE: keys are persisted in embedding shards and the embedding store, so
+    # every patent ever keyed keeps its key in an append-only history and new
+    # patents get keys after all earlier ones
+    history_path = _history_path(save_path)
+    if history_path.exists():
+        history = pl.read_parquet(history_path)
+    else:
+        history = pl.DataFrame(schema={"patent_key": pl.UInt32, "patent_id": pl.String})
+
+    added = (
+        patent_ids.join(history.lazy(), on="patent_id", how="anti")
+        .sort("patent_id")
+        .with_row_index("patent_key", offset=history.height)
+        .collect()
+    )
+    history = pl.concat([history, added])
+
+    # NOTE: the keys file holds the current cohort only, patents that left it
+    # leave gaps in the keys
+    keys = history.join(patent_ids.collect(), on="patent_id", how="semi")
+
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    _write(history, history_path)
+    _write(keys, save_path)
+
+    print(
+        f"patent keys: {keys.height - added.height} kept, {added.height} added, "
+        f"{history.height - keys.height} not in the cohort"
+    )
+
+    return keys
+
+
+def n_keys(keys_path=Path("data", "interim", "patent_keys.parquet")):
+    # NOTE: arrays indexed by key need room for every key ever handed out,
+    # not only the current cohort
+    return pl.scan_parquet(_history_path(keys_path)).select(pl.len()).collect().item()
+
+
+def _load_keys(df, keys_path):
+    keys = pl.scan_parquet(keys_path)
+
+    return keys.collect() if isinstance(df, pl.DataFrame) else keys
+
+
+def encode_keys(df, columns, keys_path=Path("data", "interim", "patent_keys.parquet")):
+    keys = _load_keys(df, keys_path)
+
+    for column in columns:
+        df = df.join(
+            keys.rename(
+                {"patent_id": column, "patent_key": column.replace("_id", "_key")}
+            ),
+            on=column,
+        )
+
+    return df
+
+
+def decode_keys(df, columns, keys_path=Path("data", "interim", "patent_keys.parquet")):
+    keys = _load_keys(df, keys_path)
+
+    for column in columns:
+        df = df.join(
+            keys.rename(
+                {"patent_key": column, "patent_id": column.replace("_key", "_id")}
+            ),
+            on=column,
+            how="left",
+        )
+
+    return df
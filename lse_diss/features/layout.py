@@ -0,0 +1,133 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+
+def _index_path(path):
+    return path.with_name(f"{path.stem}_index.json")
+
+
+def relayout_table(path, key, sort_by=None, row_group_size=100_000):
+    sort_by = [key] if sort_by is None else sort_by
+
+    # NOTE: sorted by the join key, each row group then covers a narrow range
+    # of keys and its statistics let scans skip it
+    temp_path = path.with_suffix(".tmp")
+    pl.scan_parquet(path).sort(sort_by).sink_parquet(
+        temp_path, row_group_size=row_group_size, statistics=True
+    )
+    temp_path.replace(path)
+
+    blocks = (
+        pl.scan_parquet(path)
+        .select(key)
+        .with_row_index("offset")
+        .group_by(pl.col("offset") // row_group_size)
+        .agg(
+            pl.col("offset").min().alias("start"),
+            pl.len().alias("rows"),
+            pl.col(key).min().alias("min"),
+            pl.col(key).max().alias("max"),
+        )
+        .select("start", "rows", "min", "max")
+        .sort("start")
+        .collect()
+    )
+
+    # NOTE: the size and mtime tie the index to this file, a table written
+    # again afterwards is scanned without it
+    stat = path.stat()
+    index = {
+        "key": key,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "blocks": blocks.rows(),
+    }
+
+    temp_index = _index_path(path).with_suffix(".tmp")
+    temp_index.write_text(json.dumps(index, default=str))
+    temp_index.replace(_index_path(path))
+
+    print(
+        f"{path.name}: {blocks.get_column('rows').sum()} rows sorted by {key}, "
+        f"{blocks.height} blocks of {row_group_size}"
+    )
+
+
+def _read_index(path, key):
+    index_path = _index_path(path)
+
+    if not index_path.exists():
+        return None
+
+    index = json.loads(index_path.read_text())
+    stat = path.stat()
+
+    if (index["key"], index["size"], index["mtime_ns"]) != (
+        key,
+        stat.st_size,
+        stat.st_mtime_ns,
+    ):
+        return None
+
+    return index
+
+
+def scan_keys(path, key, keys):
+    keys = pl.Series(keys).unique().sort()
+    table = pl.scan_parquet(path)
+    index = _read_index(path, key)
+
+    if index is None:
+        return table.filter(pl.col(key).is_in(keys))
+
+    blocks = pl.DataFrame(
+        index["blocks"], schema=["start", "rows", "min", "max"], orient="row"
+    ).with_columns(pl.col("min", "max").cast(keys.dtype))
+
+    # NOTE: a block is read if any key falls inside its range
+    values = keys.to_numpy()
+    hits = np.searchsorted(
+        values, blocks.get_column("max").to_numpy(), side="right"
+    ) > np.searchsorted(values, blocks.get_column("min").to_numpy(), side="left")
+
+    blocks = blocks.filter(hits)
+
+    if blocks.is_empty():
+        return table.filter(pl.col(key).is_in(keys)).clear()
+
+    # NOTE: neighbouring blocks are merged into one slice of the file
+    ranges = (
+        blocks.with_columns(
+            run=(pl.col("start") != (pl.col("start") + pl.col("rows")).shift())
+            .fill_null(True)
+            .cum_sum()
+        )
+        .group_by("run", maintain_order=True)
+        .agg(pl.col("start").first(), pl.col("rows").sum())
+    )
+
+    return pl.concat(
+        table.slice(start, rows)
+        for start, rows in ranges.select("start", "rows").rows()
+    ).filter(pl.col(key).is_in(keys))
+
+
+def relayout_tables(
+    citations_path=Path("data", "interim", "citations.parquet"),
+    row_group_size=100_000,
+):
+    # NOTE: only the citations are read by key ranges, classes are joined
+    # whole by filter_classes and the raw downloads are left as they are
+    relayout_table(
+        citations_path,
+        "cited_patent_key",
+        ["cited_patent_key", "citing_patent_key"],
+        row_group_size,
+    )
+
+
+if __name__ == "__main__":
+    relayout_tables()
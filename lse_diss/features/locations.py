@@ -1,7 +1,17 @@
+import uuid
 from pathlib import Path
 
 import polars as pl
-from geopy import distance
+
+from lse_diss.features.geodesic import measure
+from lse_diss.features.keys import encode_keys
+
+# NOTE: bump when the distance kernel changes to invalidate cached distances
+DISTANCE_CACHE_VERSION = 1
+
+# NOTE: cached coordinates are matched after rounding, about 0.1m, so the
+# float representation of a re-read release does not miss the cache
+COORDINATE_DECIMALS = 6
 
 
 def make_locations(
@@ -10,35 +20,46 @@ def make_locations(
         "data", "raw", "bulk_downloads", "g_location_disambiguated.parquet"
     ),
     save_path=Path("data", "interim", "locations.parquet"),
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
 ):
     locations = pl.scan_parquet(locations_path).select(
         ["location_id", "latitude", "longitude"]
     )
 
+    # NOTE: the keys also restrict the raw patents to the cohort
     patents = (
-        pl.scan_parquet(patents_path)
-        .filter(inventor_country="US")
+        encode_keys(
+            pl.scan_parquet(patents_path).filter(inventor_country="US"),
+            ["patent_id"],
+            keys_path=keys_path,
+        )
         .select(
-            ["patent_id", "inventor_id", "inventor_sequence", "inventor_location_id"]
+            [
+                "patent_key",
+                "patent_id",
+                "inventor_id",
+                "inventor_sequence",
+                "inventor_location_id",
+            ]
         )
         # NOTE: this remove duplicate inventors with different sequence values
-        .sort(["patent_id", "inventor_sequence"])
-        .unique(["patent_id", "inventor_id", "inventor_location_id"], keep="first")
+        .sort(["patent_key", "inventor_sequence"])
+        .unique(["patent_key", "inventor_id", "inventor_location_id"], keep="first")
     )
 
     patent_locations = (
         patents.with_columns(
-            pl.len().over("patent_id", "inventor_location_id").alias("count")
+            pl.len().over("patent_key", "inventor_location_id").alias("count")
         )
         # NOTE: location rule 1
-        .filter(pl.col("count").eq(pl.max("count").over("patent_id")))
+        .filter(pl.col("count").eq(pl.max("count").over("patent_key")))
         # NOTE: location rule 2
         .filter(
             pl.col("inventor_sequence").eq(
-                pl.min("inventor_sequence").over("patent_id")
+                pl.min("inventor_sequence").over("patent_key")
             )
         )
-        .select(["patent_id", "inventor_location_id"])
+        .select(["patent_key", "patent_id", "inventor_location_id"])
         .rename({"inventor_location_id": "location_id"})
     )
 
@@ -49,27 +70,103 @@ def make_locations(
     joined_locations.sink_parquet(save_path, mkdir=True)
 
 
+def cache_distances(
+    pairs,
+    cache_path=Path("data", "interim", "distance_cache"),
+    method="geodesic",
+):
+    keys = ["location_id", "latitude", "longitude"]
+    columns = [f"{side}_{key}" for side in ["first", "second"] for key in keys]
+    coordinates = [column for column in columns if not column.endswith("_id")]
+    join_columns = [column for column in columns if column.endswith("_id")] + [
+        f"{column}_key" for column in coordinates
+    ]
+
+    def with_keys(frame):
+        return frame.with_columns(
+            pl.col(coordinates).round(COORDINATE_DECIMALS).name.suffix("_key")
+        )
+
+    # NOTE: entries are only reused for the same kernel and the same
+    # coordinates, so a new locations release or method gets fresh distances
+    version_path = cache_path / f"{method}_v{DISTANCE_CACHE_VERSION}"
+    version_path.mkdir(parents=True, exist_ok=True)
+
+    parts = sorted(version_path.glob("part_*.parquet"))
+
+    if parts:
+        cached = (
+            with_keys(pl.scan_parquet(parts))
+            .unique(join_columns)
+            .select(*join_columns, "distance")
+            .collect()
+        )
+    else:
+        cached = with_keys(
+            pl.DataFrame(schema={column: pairs.schema[column] for column in columns})
+        ).select(*join_columns, distance=pl.lit(None, pl.Float64))
+
+    found = (
+        with_keys(pairs)
+        .join(cached, on=join_columns, how="left")
+        .drop(join_columns[2:])
+    )
+    missing = found.filter(pl.col("distance").is_null()).drop("distance")
+
+    print(
+        f"distance cache: {found.height - missing.height} hits, "
+        f"{missing.height} misses out of {found.height} location pairs"
+    )
+
+    if missing.is_empty():
+        return found
+
+    computed = missing.with_columns(
+        distance=measure(
+            *missing.select(
+                "first_latitude",
+                "first_longitude",
+                "second_latitude",
+                "second_longitude",
+            ).iter_columns(),
+            method=method,
+        )
+    )
+
+    # NOTE: named by uuid, runs writing at the same time never collide
+    part_path = version_path / f"part_{uuid.uuid4().hex}.parquet"
+    temp_path = part_path.with_suffix(".tmp")
+    computed.write_parquet(temp_path)
+    temp_path.replace(part_path)
+
+    return pl.concat([found.filter(pl.col("distance").is_not_null()), computed])
+
+
 def make_distances(
     controls_path=Path("data", "processed", "controls.parquet"),
     locations_path=Path("data", "interim", "locations.parquet"),
     save_path=Path("data", "processed", "distances.parquet"),
+    cache_path=Path("data", "interim", "distance_cache"),
+    method="geodesic",
 ):
     controls = pl.scan_parquet(controls_path)
     locations = pl.scan_parquet(locations_path)
 
     matched_patents = (
         controls.unpivot(
-            pl.col(["citing_patent_id", "control_patent_id"]),
-            index=pl.col("cited_patent_id"),
+            pl.col(["citing_patent_key", "control_patent_key"]),
+            index=pl.col("cited_patent_key"),
         )
         .join(
-            locations, left_on="cited_patent_id", right_on="patent_id", validate="m:1"
+            locations, left_on="cited_patent_key", right_on="patent_key", validate="m:1"
         )
-        .join(locations, left_on="value", right_on="patent_id", validate="m:1")
+        .join(locations, left_on="value", right_on="patent_key", validate="m:1")
         .rename(
             {
-                "cited_patent_id": "parent_patent_id",
-                "value": "child_patent_id",
+                "cited_patent_key": "parent_patent_key",
+                "value": "child_patent_key",
+                "patent_id": "parent_patent_id",
+                "patent_id_right": "child_patent_id",
                 "location_id": "parent_location_id",
                 "location_id_right": "child_location_id",
                 "latitude": "parent_latitude",
@@ -79,28 +176,58 @@ def make_distances(
             }
         )
         .select(
-            pl.col("parent_patent_id"),
-            pl.concat_list("parent_latitude", "parent_longitude").alias(
-                "parent_location"
+            pl.col(
+                [
+                    "parent_patent_key",
+                    "child_patent_key",
+                    "parent_patent_id",
+                    "child_patent_id",
+                    "parent_location_id",
+                    "child_location_id",
+                ]
             ),
-            pl.col("child_patent_id"),
-            pl.concat_list("child_latitude", "child_longitude").alias("child_location"),
+            pl.col(
+                [
+                    "parent_latitude",
+                    "parent_longitude",
+                    "child_latitude",
+                    "child_longitude",
+                ]
+            ).cast(pl.Float64),
+        )
+        .unique(["parent_patent_key", "child_patent_key"])
+        # NOTE: distances are symmetric, so each pair is stored in id order
+        .with_columns(
+            pl.when(pl.col("parent_location_id") <= pl.col("child_location_id"))
+            .then(pl.col(f"parent_{key}"))
+            .otherwise(pl.col(f"child_{key}"))
+            .alias(f"first_{key}")
+            for key in ["location_id", "latitude", "longitude"]
+        )
+        .with_columns(
+            pl.when(pl.col("parent_location_id") <= pl.col("child_location_id"))
+            .then(pl.col(f"child_{key}"))
+            .otherwise(pl.col(f"parent_{key}"))
+            .alias(f"second_{key}")
+            for key in ["location_id", "latitude", "longitude"]
         )
         .collect()
     )
 
-    distances = []
+    location_pairs = matched_patents.select(pl.col("^(first|second)_.*$")).unique()
 
-    for row in matched_patents.iter_rows():
-        parent = tuple(row[1])
-        child = tuple(row[3])
-        dist = distance.distance(parent, child).km
-        distances.append(dist)
-
-    patents_with_distances = (
-        matched_patents.with_columns(distance=pl.Series(distances))
-        .select(["parent_patent_id", "child_patent_id", "distance"])
-        .unique()
+    print(
+        f"{matched_patents.height} patent pairs share "
+        f"{location_pairs.height} location pairs"
     )
 
+    distances = cache_distances(location_pairs, cache_path, method)
+
+    # NOTE: one set of coordinates per location id, the ids alone are the key
+    patents_with_distances = matched_patents.join(
+        distances.select("first_location_id", "second_location_id", "distance"),
+        on=["first_location_id", "second_location_id"],
+        how="left",
+    ).select(["parent_patent_id", "child_patent_id", "distance"])
+
     patents_with_distances.write_parquet(save_path)
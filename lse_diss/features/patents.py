@@ -2,6 +2,8 @@ from pathlib import Path
 
 import polars as pl
 
+from lse_diss.features.keys import encode_keys, make_keys
+
 
 def load_patents(path=Path("data", "raw", "patents")):
     patents = pl.scan_parquet(path)
@@ -67,27 +69,33 @@ def trim_abstracts(df):
     return patents
 
 
-def save_patents(df, path=Path("data", "interim", "patents")):
+def save_patents(
+    df,
+    path=Path("data", "interim", "patents"),
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
+):
     path.mkdir(parents=True, exist_ok=True)
 
-    df.sink_parquet(
+    keys = make_keys(df, keys_path)
+
+    df.join(keys.lazy(), on="patent_id").sink_parquet(
         pl.PartitionMaxSize(path / "patent_{part}.parquet", max_size=512_000)
     )
 
 
 def filter_citations(
-    patents_path=Path("data", "interim", "patents"),
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
     citations_path=Path(
         "data", "raw", "bulk_downloads", "g_us_patent_citation.parquet"
     ),
     save_path=Path("data", "interim", "citations.parquet"),
 ):
-    patents = pl.scan_parquet(patents_path).select("patent_id").unique()
-
     citations = (
         pl.scan_parquet(citations_path)
-        .join(patents, on="patent_id")
-        .join(patents, left_on="citation_patent_id", right_on="patent_id")
+        .select("patent_id", "citation_patent_id", "citation_category")
+        .rename(
+            {"patent_id": "citing_patent_id", "citation_patent_id": "cited_patent_id"}
+        )
         # NOTE: other categories most likely do not reflect spillovers
         # TODO: check again for empty strings
         .filter(
@@ -95,11 +103,11 @@ def filter_citations(
                 ["cite by examiner", "cited by applicant", "cited by other"]
             )
         )
-        .select("patent_id", "citation_patent_id", "citation_category")
-        .rename(
-            {"patent_id": "citing_patent_id", "citation_patent_id": "cited_patent_id"}
-        )
-        .unique()
     )
 
-    citations.sink_parquet(save_path)
+    # NOTE: the inner joins on the keys keep only citations within the cohort
+    keyed_citations = encode_keys(
+        citations, ["citing_patent_id", "cited_patent_id"], keys_path=keys_path
+    ).unique(["citing_patent_key", "cited_patent_key", "citation_category"])
+
+    keyed_citations.sink_parquet(save_path)
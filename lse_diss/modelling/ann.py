@@ -1,84 +1,439 @@
 from math import ceil
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 from voyager import Index, Space, StorageDataType
 
+from lse_diss.features.keys import decode_keys
+from lse_diss.modelling.neighbours import query_neighbours
+from lse_diss.modelling.partitions import PartitionedIndex, query_partitions
+from lse_diss.modelling.store import check_keys, iter_chunks, make_store, open_store
+
+
+def _ids_path(path):
+    return path.with_name(f"{path.stem}_ids.parquet")
+
+
+def check_index(
+    index,
+    ids,
+    store,
+    n_checks=100,
+    seed=42,
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
+):
+    if len(index) != ids.height or set(index.ids) != set(ids.get_column("index_id")):
+        raise ValueError("index ids do not match its id mapping, rebuild the index")
+
+    # NOTE: every index id must still be the store row of the same patent
+    mismatched = ids.join(
+        store.rows.select("row", pl.col("patent_id").alias("store_patent_id")),
+        left_on="index_id",
+        right_on="row",
+        how="left",
+    ).filter(pl.col("store_patent_id").ne_missing(pl.col("patent_id")))
+
+    if not mismatched.is_empty():
+        raise ValueError(
+            f"{mismatched.height} index ids point at other patents in the "
+            "embedding store, rebuild the index"
+        )
+
+    check_keys(store, keys_path)
+
+    rng = np.random.default_rng(seed)
+    sample = np.sort(
+        rng.choice(
+            ids.get_column("index_id").to_numpy(),
+            min(n_checks, ids.height),
+            replace=False,
+        )
+    )
+
+    # NOTE: stored vectors are normalised and low precision, so they are
+    # compared by cosine rather than for equality
+    if len(sample):
+        cosine = (
+            _normalise(np.asarray(index.get_vectors(sample.tolist())))
+            * _normalise(np.asarray(store.embeddings[sample], dtype=np.float32))
+        ).sum(axis=1)
+
+        if cosine.min() < 0.95:
+            raise ValueError(
+                "index vectors differ from the embedding store, rebuild the index"
+            )
+
 
 def create_index(
-    embeddings_path=Path("data", "processed", "embeddings"),
+    store_path=Path("data", "interim", "embedding_store"),
     save_path=Path("data", "interim"),
+    chunk_size=100_000,
+    M=12,
+    ef_construction=200,
+    storage_data_type=StorageDataType.E4M3,
 ):
-    file_path = str(save_path / "index.voy")
+    file_path = save_path / "index.voy"
+    ids_path = _ids_path(file_path)
+
+    store = open_store(store_path)
 
-    df = pl.scan_parquet(embeddings_path).collect()
-    embeddings = df.get_column("embedding").to_numpy()
+    # NOTE: an existing index is extended with the store rows it is missing,
+    # ids are store rows and the sidecar ties each one to its patent_id
+    if file_path.exists():
+        if not ids_path.exists():
+            raise ValueError(f"{file_path} has no id mapping, remove it to rebuild")
 
-    dimension = embeddings.shape[1]
-    index = Index(
-        Space.Cosine, num_dimensions=dimension, storage_data_type=StorageDataType.E4M3
+        index = open_index(file_path, store_path)
+        ids = pl.read_parquet(ids_path)
+    else:
+        dimension = store.embeddings.shape[1]
+        # NOTE: see utils/ann_tuning.py for how these trade recall for speed
+        index = Index(
+            Space.Cosine,
+            num_dimensions=dimension,
+            M=M,
+            ef_construction=ef_construction,
+            storage_data_type=storage_data_type,
+        )
+        ids = pl.DataFrame(schema={"patent_id": pl.String, "index_id": pl.UInt32})
+
+    new_rows = store.rows.join(ids, left_on="row", right_on="index_id", how="anti")
+
+    print(f"index: {ids.height} patents kept, {new_rows.height} added")
+
+    if new_rows.is_empty():
+        return index
+
+    for rows, embeddings in iter_chunks(store, chunk_size, new_rows.get_column("row")):
+        index.add_items(embeddings, ids=rows.tolist())
+
+    ids = pl.concat(
+        [
+            ids,
+            new_rows.select(
+                "patent_id", pl.col("row").cast(pl.UInt32).alias("index_id")
+            ),
+        ]
     )
-    index.add_items(embeddings)
 
-    index.save(str(file_path))
+    temp_path = file_path.with_suffix(".tmp")
+    index.save(str(temp_path))
+    temp_path.replace(file_path)
+
+    temp_ids = ids_path.with_suffix(".tmp")
+    ids.write_parquet(temp_ids)
+    temp_ids.replace(ids_path)
+
+    return index
 
 
-def open_index(path=Path("data", "interim", "index.voy")):
+def open_index(
+    path=Path("data", "interim", "index.voy"),
+    store_path=Path("data", "interim", "embedding_store"),
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
+):
     path_str = str(path)
     with open(path_str, "rb") as f:
         index = Index.load(f)
+
+    ids_path = _ids_path(path)
+    if not ids_path.exists():
+        raise ValueError(f"{path} has no id mapping, rebuild it with create_index")
+
+    check_index(
+        index, pl.read_parquet(ids_path), open_store(store_path), keys_path=keys_path
+    )
+
     return index
 
 
-def match_controls(
-    voyager_index,
-    embeddings_path=Path("data", "processed", "embeddings"),
-    controls_path=Path("data", "interim", "controls"),
-    save_path=Path("data", "processed", "controls.parquet"),
-    match_quality=1000,
+# NOTE: thresholds come from a matmul and pair scores from an elementwise sum,
+# which round differently in float32, so a k-th neighbour scored a hair under
+# its own threshold would otherwise be dropped
+SIMILARITY_TOLERANCE = 1e-6
+
+
+def _normalise(embeddings):
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def estimate_thresholds(
+    store, query_rows, n_neighbours, sample_size=100_000, chunk_size=1_000, seed=42
 ):
-    patents_with_embeddings = pl.scan_parquet(embeddings_path).with_row_index(
-        "voyager_index"
+    # NOTE: the population is the cohort, one row per patent key, as in
+    # count_neighbours, not every row of the store
+    cohort_rows = (
+        store.rows.filter(pl.col("patent_key").is_not_null())
+        .unique("patent_key", keep="first")
+        .get_column("row")
+        .to_numpy()
     )
-    raw_controls = pl.scan_parquet(controls_path)
+    n_rows = len(cohort_rows)
 
-    n_neighbours = (
-        patents_with_embeddings.unique("patent_id")
-        # NOTE: this is where the top 0.1% is defined
-        .select(pl.len() / match_quality)
-        .collect()
-        .item(0, 0)
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(
+        rng.choice(cohort_rows, min(sample_size, n_rows), replace=False)
+    )
+    sample = _normalise(np.asarray(store.embeddings[sample_rows], dtype=np.float32))
+
+    # NOTE: the k-th neighbour of N rows sits at the 1 - k / N quantile of a
+    # query's similarities, which a random sample of rows estimates
+    position = min(
+        int(len(sample_rows) * (1 - n_neighbours / n_rows)), len(sample_rows) - 1
+    )
+
+    thresholds = np.empty(len(query_rows), dtype=np.float32)
+    start = 0
+
+    for rows, queries in iter_chunks(store, chunk_size, query_rows):
+        similarities = _normalise(queries) @ sample.T
+        thresholds[start : start + len(rows)] = np.partition(
+            similarities, position, axis=1
+        )[:, position]
+        start += len(rows)
+
+    return thresholds
+
+
+def score_pairs(store, rows_a, rows_b, chunk_size=1_000_000):
+    similarities = np.empty(len(rows_a), dtype=np.float32)
+
+    for start in range(0, len(rows_a), chunk_size):
+        a = _normalise(np.asarray(store.embeddings[rows_a[start : start + chunk_size]]))
+        b = _normalise(np.asarray(store.embeddings[rows_b[start : start + chunk_size]]))
+        similarities[start : start + chunk_size] = (a * b).sum(axis=1)
+
+    return similarities
+
+
+def _exhaustive_matches(
+    voyager_index,
+    store,
+    raw_controls,
+    n_neighbours,
+    chunk_size,
+    neighbours_path,
+    n_threads,
+    query_ef,
+):
+    rows = store.rows.lazy().select("patent_key", "row")
+
+    print("querying NNs")
+
+    neighbours = query_neighbours(
+        voyager_index,
+        store,
+        n_neighbours,
+        save_path=neighbours_path,
+        batch_size=chunk_size,
+        n_threads=n_threads,
+        query_ef=query_ef,
     )
 
-    print("neighbours: ", ceil(n_neighbours))
+    # NOTE: the neighbour dataset is joined lazily, it is never held in memory
+    patents_with_neighbours = neighbours.join(
+        rows.rename({"patent_key": "citing_patent_key", "row": "query_row"}),
+        on="query_row",
+    ).select("citing_patent_key", pl.col("neighbour_row").alias("voyager_index"))
 
-    embeddings = (
-        patents_with_embeddings.select("embedding")
+    return raw_controls.join(
+        rows.rename({"row": "voyager_index"}),
+        left_on="control_patent_key",
+        right_on="patent_key",
+    ).join(patents_with_neighbours, on=["citing_patent_key", "voyager_index"])
+
+
+def _partitioned_matches(
+    partitioned,
+    store,
+    raw_controls,
+    n_neighbours,
+    search_range,
+    chunk_size,
+    n_threads,
+    share,
+):
+    rows = partitioned.partitions.lazy().select("patent_key", "row")
+
+    citing_rows = (
+        raw_controls.select(pl.col("citing_patent_key").alias("patent_key"))
+        .unique()
+        .join(rows, on="patent_key")
+        .select("row")
         .collect()
-        .get_column("embedding")
+        .get_column("row")
         .to_numpy()
     )
 
-    print("querying NNs")
+    print(f"querying partitions for {len(citing_rows)} citing patents")
 
-    neighbours, _ = voyager_index.query(embeddings, ceil(n_neighbours))
+    neighbours = query_partitions(
+        partitioned,
+        store,
+        citing_rows,
+        n_neighbours,
+        search_range=search_range,
+        batch_size=chunk_size,
+        n_threads=n_threads,
+        share=share,
+    )
 
     patents_with_neighbours = (
-        patents_with_embeddings.select("patent_id")
-        .with_columns(neighbours=neighbours)
-        .explode(pl.col("neighbours"))
-        .rename({"patent_id": "citing_patent_id", "neighbours": "voyager_index"})
+        neighbours.lazy()
+        .join(
+            rows.rename({"patent_key": "citing_patent_key", "row": "query_row"}),
+            on="query_row",
+        )
+        .select("citing_patent_key", pl.col("neighbour_row").alias("voyager_index"))
     )
 
-    controls = (
-        raw_controls.join(
-            patents_with_embeddings.select(["patent_id", "voyager_index"]),
-            left_on="control_patent_id",
-            right_on="patent_id",
-        )
-        .join(patents_with_neighbours, on=["citing_patent_id", "voyager_index"])
-        .select(["citing_patent_id", "cited_patent_id", "control_patent_id"])
+    return raw_controls.join(
+        rows.rename({"row": "voyager_index"}),
+        left_on="control_patent_key",
+        right_on="patent_key",
+    ).join(patents_with_neighbours, on=["citing_patent_key", "voyager_index"])
+
+
+def _targeted_matches(store, raw_controls, n_neighbours, sample_size, seed):
+    rows = store.rows.unique("patent_key", keep="first").select("patent_key", "row")
+
+    # NOTE: only the (citing, control) pairs we have are scored, against an
+    # estimate of each citing patent's k-th neighbour similarity
+    pairs = (
+        raw_controls.select("citing_patent_key", "control_patent_key")
         .unique()
+        .join(
+            rows.lazy().rename(
+                {"patent_key": "citing_patent_key", "row": "citing_row"}
+            ),
+            on="citing_patent_key",
+        )
+        .join(
+            rows.lazy().rename(
+                {"patent_key": "control_patent_key", "row": "control_row"}
+            ),
+            on="control_patent_key",
+        )
+        .collect()
+    )
+
+    citing = pairs.select("citing_row").unique().sort("citing_row")
+
+    print(f"estimating thresholds for {citing.height} citing patents")
+
+    thresholds = estimate_thresholds(
+        store,
+        citing.get_column("citing_row").to_numpy(),
+        n_neighbours,
+        sample_size=sample_size,
+        seed=seed,
+    )
+
+    print(f"scoring {pairs.height} pairs")
+
+    pairs = pairs.with_columns(
+        similarity=score_pairs(
+            store,
+            pairs.get_column("citing_row").to_numpy(),
+            pairs.get_column("control_row").to_numpy(),
+        )
+    ).join(citing.with_columns(threshold=thresholds), on="citing_row")
+
+    return raw_controls.join(
+        pairs.lazy()
+        .filter(pl.col("similarity") >= pl.col("threshold") - SIMILARITY_TOLERANCE)
+        .select("citing_patent_key", "control_patent_key"),
+        on=["citing_patent_key", "control_patent_key"],
+    )
+
+
+def count_neighbours(store, match_quality=1000):
+    return ceil(
+        store.rows.lazy()
+        .drop_nulls("patent_key")
+        .unique("patent_key")
+        # NOTE: this is where the top 0.1% is defined
+        .select(pl.len() / match_quality)
+        .collect()
+        .item(0, 0)
+    )
+
+
+def match_controls(
+    voyager_index=None,
+    store_path=Path("data", "interim", "embedding_store"),
+    controls_path=Path("data", "interim", "controls"),
+    save_path=Path("data", "processed", "controls.parquet"),
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
+    match_quality=1000,
+    chunk_size=100_000,
+    engine="exhaustive",
+    neighbours_path=Path("data", "interim", "neighbours"),
+    n_threads=4,
+    query_ef=-1,
+    sample_size=100_000,
+    seed=42,
+    search_range=30,
+    scale_neighbours=False,
+):
+    engines = ["targeted", "exhaustive", "partitioned"]
+    if engine not in engines:
+        raise ValueError(f"engine must be one of {engines}, got {engine!r}")
+
+    if engine == "exhaustive" and not isinstance(voyager_index, Index):
+        raise ValueError("the exhaustive engine needs a voyager index")
+
+    if engine == "partitioned" and not isinstance(voyager_index, PartitionedIndex):
+        raise ValueError("the partitioned engine needs open_partitioned_index()")
+
+    store = open_store(store_path)
+    check_keys(store, keys_path)
+    raw_controls = pl.scan_parquet(controls_path)
+
+    n_neighbours = count_neighbours(store, match_quality)
+
+    print("neighbours: ", n_neighbours)
+
+    if engine == "exhaustive":
+        matched = _exhaustive_matches(
+            voyager_index,
+            store,
+            raw_controls,
+            n_neighbours,
+            chunk_size,
+            neighbours_path,
+            n_threads,
+            query_ef,
+        )
+    elif engine == "partitioned":
+        matched = _partitioned_matches(
+            voyager_index,
+            store,
+            raw_controls,
+            n_neighbours,
+            search_range,
+            chunk_size,
+            n_threads,
+            1 / match_quality if scale_neighbours else None,
+        )
+    else:
+        matched = _targeted_matches(
+            store, raw_controls, n_neighbours, sample_size, seed
+        )
+
+    matched_controls = matched.select(
+        ["citing_patent_key", "cited_patent_key", "control_patent_key"]
+    ).unique()
+
+    # NOTE: patent ids are restored for the analysis in R
+    controls = decode_keys(
+        matched_controls,
+        ["citing_patent_key", "cited_patent_key", "control_patent_key"],
+        keys_path=keys_path,
+    ).select(
+        pl.col(["citing_patent_id", "cited_patent_id", "control_patent_id"]),
+        pl.col(["citing_patent_key", "cited_patent_key", "control_patent_key"]),
     )
 
     print("sinking data")
@@ -86,15 +441,40 @@ def match_controls(
     controls.sink_parquet(save_path)
 
 
-if __name__ == "__main__":
-    if Path("data", "interim", "index.voy").exists():
-        print("index exists")
-    else:
-        print("creating index")
-        create_index()
+def compare_matches(
+    reference_path=Path("data", "processed", "controls_exhaustive.parquet"),
+    candidate_path=Path("data", "processed", "controls.parquet"),
+):
+    columns = ["citing_patent_key", "cited_patent_key", "control_patent_key"]
+
+    reference = pl.read_parquet(reference_path, columns=columns)
+    candidate = pl.read_parquet(candidate_path, columns=columns)
 
-    print("loading index")
-    index = open_index()
+    shared = reference.join(candidate, on=columns).height
+
+    report = {
+        "reference": reference.height,
+        "candidate": candidate.height,
+        "shared": shared,
+        "precision": shared / max(candidate.height, 1),
+        "recall": shared / max(reference.height, 1),
+    }
+
+    print(
+        f"{shared} shared matches, {report['candidate']} candidate vs "
+        f"{report['reference']} reference: precision {report['precision']:.3f}, "
+        f"recall {report['recall']:.3f}"
+    )
+
+    return report
+
+
+if __name__ == "__main__":
+    # NOTE: only patents embedded since the last run are added to the store
+    print("updating embedding store")
+    make_store()
 
+    # NOTE: exhaustive stays the default until compare_matches() shows the
+    # targeted engine at parity, match_controls(engine="targeted") needs no index
     print("finding neighbours")
-    match_controls(index)
+    match_controls(create_index())
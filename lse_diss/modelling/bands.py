@@ -0,0 +1,469 @@
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+# NOTE: R's density() evaluates the kernel on 512 points and bw.SJ bins the
+# pairwise distances into 1000 bins, the same values are kept here
+N_POINTS = 512
+N_BINS = 1000
+DELMAX = 1000
+
+_worker_state = {}
+
+
+def _pair_counts(x):
+    # NOTE: bins as in R's bw_pair_cnts, which truncates towards zero
+    d = (x.max() - x.min()) * 1.01 / N_BINS
+    bins = np.trunc(np.abs(x) / d) * np.sign(x)
+    counts = np.bincount((bins - bins.min()).astype(np.int64), minlength=N_BINS)
+    counts = counts.astype(np.float64)
+
+    # NOTE: pairs of bins at each distance apart, same bin pairs counted once
+    pairs = np.correlate(counts, counts, mode="full")[len(counts) - 1 :]
+    pairs[0] = (counts * (counts - 1)).sum() / 2
+
+    return d, pairs[:N_BINS]
+
+
+def _phi(n, d, pairs, h, order):
+    delta = (np.arange(len(pairs)) * d / h) ** 2
+    keep = delta < DELMAX
+
+    if order == 4:
+        terms = np.exp(-delta[keep] / 2) * (delta[keep] ** 2 - 6 * delta[keep] + 3)
+        total = 2 * (terms * pairs[keep]).sum() + n * 3
+    else:
+        terms = np.exp(-delta[keep] / 2) * (
+            delta[keep] ** 3 - 15 * delta[keep] ** 2 + 45 * delta[keep] - 15
+        )
+        total = 2 * (terms * pairs[keep]).sum() - 15 * n
+
+    return total / (n * (n - 1) * h ** (order + 1) * math.sqrt(2 * math.pi))
+
+
+def _zeroin(f, a, b, fa, fb, tol, max_iterations=1000):
+    # NOTE: Brent's method as in R's uniroot, so roots agree to the tolerance
+    c, fc = a, fa
+
+    if fa == 0:
+        return a
+    if fb == 0:
+        return b
+
+    for _ in range(max_iterations + 1):
+        previous_step = b - a
+
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+
+        tolerance = 2 * np.finfo(float).eps * abs(b) + tol / 2
+        step = (c - b) / 2
+
+        if abs(step) <= tolerance or fb == 0:
+            return b
+
+        if abs(previous_step) >= tolerance and abs(fa) > abs(fb):
+            cb = c - b
+
+            if a == c:
+                t1 = fb / fa
+                p = cb * t1
+                q = 1 - t1
+            else:
+                q = fa / fc
+                t1 = fb / fc
+                t2 = fb / fa
+                p = t2 * (cb * q * (q - t1) - (b - a) * (t1 - 1))
+                q = (q - 1) * (t1 - 1) * (t2 - 1)
+
+            if p > 0:
+                q = -q
+            else:
+                p = -p
+
+            if p < 0.75 * cb * q - abs(tolerance * q) / 2 and p < abs(
+                previous_step * q / 2
+            ):
+                step = p / q
+
+        if abs(step) < tolerance:
+            step = tolerance if step > 0 else -tolerance
+
+        a, fa = b, fb
+        b += step
+        fb = f(b)
+
+        if (fb > 0 and fc > 0) or (fb < 0 and fc < 0):
+            c, fc = a, fa
+
+    return b
+
+
+def sheather_jones(x):
+    n = len(x)
+    d, pairs = _pair_counts(x)
+
+    quartiles = np.quantile(x, [0.25, 0.75])
+    scale = min(x.std(ddof=1), (quartiles[1] - quartiles[0]) / 1.349)
+    a = 1.24 * scale * n ** (-1 / 7)
+    b = 1.23 * scale * n ** (-1 / 9)
+    c1 = 1 / (2 * math.sqrt(math.pi) * n)
+
+    td = -_phi(n, d, pairs, b, 6)
+    if not np.isfinite(td) or td <= 0:
+        raise ValueError("sample is too sparse to find TD")
+
+    alpha = 1.357 * (_phi(n, d, pairs, a, 4) / td) ** (1 / 7)
+    if not np.isfinite(alpha):
+        raise ValueError("sample is too sparse to find alph2")
+
+    def equation(h):
+        return (c1 / _phi(n, d, pairs, alpha * h ** (5 / 7), 4)) ** (1 / 5) - h
+
+    upper = 1.144 * scale * n ** (-1 / 5)
+    lower = 0.1 * upper
+    tol = 0.1 * lower
+
+    # NOTE: the search range widens until it brackets a root, like bw.SJ
+    for i in range(1, 100):
+        f_lower = equation(lower)
+        f_upper = equation(upper)
+        if f_lower * f_upper <= 0:
+            break
+        if i % 2:
+            upper *= 1.2
+        else:
+            lower /= 1.2
+    else:
+        raise ValueError("no solution in the specified range of bandwidths")
+
+    return _zeroin(equation, lower, upper, f_lower, f_upper, tol)
+
+
+def reflected_density(distances, value_range):
+    # NOTE: Silverman's reflection, the Gaussian KDE of the distances and
+    # their negatives doubled on the positive half, like calculate_density
+    x = np.concatenate([distances, -distances])
+    bw = sheather_jones(x)
+
+    low = -value_range - 4 * bw
+    high = value_range + 4 * bw
+    delta = (high - low) / (N_POINTS - 1)
+
+    # NOTE: linear binning onto twice the grid, the upper half is padding
+    # so the circular convolution does not wrap around
+    position = (x - low) / delta
+    index = np.floor(position).astype(np.int64)
+    fraction = position - index
+    weight = 1 / len(x)
+
+    inside = (index >= 0) & (index <= N_POINTS - 2)
+    binned = np.bincount(
+        np.concatenate([index[inside], index[inside] + 1]),
+        np.concatenate([(1 - fraction[inside]), fraction[inside]]) * weight,
+        minlength=2 * N_POINTS,
+    )
+    binned[0] += (fraction[index == -1] * weight).sum()
+    binned[N_POINTS - 1] += ((1 - fraction[index == N_POINTS - 1]) * weight).sum()
+
+    # NOTE: the kernel is evaluated at the bin spacing, as density() does
+    # since R 4.4 with old.coords = FALSE
+    kernel = np.arange(2 * N_POINTS) * delta
+    kernel[N_POINTS + 1 :] = -kernel[N_POINTS - 1 : 0 : -1]
+    kernel = np.exp(-0.5 * (kernel / bw) ** 2) / (bw * math.sqrt(2 * math.pi))
+
+    smoothed = np.maximum(
+        np.fft.irfft(np.fft.rfft(binned) * np.conj(np.fft.rfft(kernel)))[:N_POINTS], 0
+    )
+
+    grid = np.linspace(-value_range, value_range, N_POINTS)
+    density = np.interp(grid, np.linspace(low, high, N_POINTS), smoothed)
+
+    positive = grid >= 0
+
+    return grid[positive], 2 * density[positive]
+
+
+def check_reference(
+    reference_path=Path("data", "interim", "bands_reference.parquet"),
+    bandwidth_tolerance=1e-6,
+    density_tolerance=1e-4,
+):
+    # NOTE: the reference comes from make_reference in bands_reference.R,
+    # errors are relative, the density one to the peak of R's density
+    reference = pl.read_parquet(reference_path)
+    reports = []
+
+    for (sample,), values in reference.group_by("sample", maintain_order=True):
+        arrays = {
+            kind: group.sort("position").get_column("value").to_numpy()
+            for (kind,), group in values.group_by("kind")
+        }
+
+        bandwidth = sheather_jones(np.concatenate([arrays["input"], -arrays["input"]]))
+        grid, density = reflected_density(arrays["input"], arrays["range"][0])
+
+        reports.append(
+            {
+                "sample": sample,
+                "n": len(arrays["input"]),
+                "bandwidth_error": abs(bandwidth / arrays["bandwidth"][0] - 1),
+                "grid_error": np.abs(grid - arrays["distance"]).max() / grid.max(),
+                "density_error": np.abs(density - arrays["density"]).max()
+                / arrays["density"].max(),
+            }
+        )
+
+    report = pl.DataFrame(reports).with_columns(
+        passed=(pl.col("bandwidth_error") <= bandwidth_tolerance)
+        & (pl.col("grid_error") <= density_tolerance)
+        & (pl.col("density_error") <= density_tolerance)
+    )
+
+    print(f"bw.SJ and density() reference from {reference.item(0, 'r_version')}")
+    with pl.Config(tbl_rows=-1, tbl_width_chars=200):
+        print(report)
+
+    return bool(report.get_column("passed").all())
+
+
+def _draw_densities(state, seed, n_draws):
+    rng = np.random.default_rng(seed)
+    offsets = state["offsets"]
+    sizes = np.diff(offsets)
+
+    # NOTE: one control per treated pair and draw, all drawn at once as
+    # random positions inside each pair's block of controls
+    rows = offsets[:-1] + (rng.random((n_draws, len(sizes))) * sizes).astype(np.int64)
+
+    densities = []
+    for draw in rows:
+        distances = np.repeat(state["distances"][draw], state["copies"][draw])
+        densities.append(reflected_density(distances, state["range"])[1])
+
+    return np.stack(densities)
+
+
+def _start_worker(state):
+    _worker_state.update(state)
+
+
+def _draw_worker_densities(seed, n_draws):
+    return seed, _draw_densities(_worker_state, seed, n_draws)
+
+
+def load_sections(processed_path=Path("data", "processed")):
+    distances = pl.read_parquet(processed_path / "distances.parquet")
+
+    # NOTE: every cited patent also counts towards "All", once per section
+    # it has, as in load_data
+    classes = (
+        pl.read_parquet(processed_path / "classes.parquet")
+        .filter(pl.col("cited_dummy") == 1)
+        .select("patent_id", "cpc_section")
+    )
+    # NOTE: intended to match R, load_data left joins the classes and keeps a
+    # missing section as its own NA group, which filter(cpc_section != "D")
+    # then drops, so those rows are dropped here before the joins instead.
+    # Their "All" rows are kept in both
+    classes = pl.concat(
+        [classes, classes.with_columns(cpc_section=pl.lit("All"))]
+    ).filter(pl.col("cpc_section").is_not_null())
+
+    median_distance = distances.get_column("distance").median()
+
+    section_distances = distances.filter(pl.col("distance") <= median_distance).join(
+        classes, left_on="parent_patent_id", right_on="patent_id"
+    )
+
+    def control_distance(column, name):
+        return distances.select(
+            pl.col("parent_patent_id").alias("cited_patent_id"),
+            pl.col("child_patent_id").alias(column),
+            pl.col("distance").alias(name),
+        )
+
+    controls = (
+        pl.read_parquet(processed_path / "controls.parquet")
+        .select("cited_patent_id", "citing_patent_id", "control_patent_id")
+        .join(
+            control_distance("citing_patent_id", "treatment"),
+            on=["cited_patent_id", "citing_patent_id"],
+        )
+        .join(
+            control_distance("control_patent_id", "control"),
+            on=["cited_patent_id", "control_patent_id"],
+        )
+        .filter(
+            pl.col("treatment") <= median_distance,
+            pl.col("control") <= median_distance,
+        )
+        .join(classes, left_on="cited_patent_id", right_on="patent_id")
+        .drop("treatment", "control")
+    )
+
+    sections = (
+        section_distances.select(pl.col("cpc_section").unique())
+        .join(controls.select(pl.col("cpc_section").unique()), on="cpc_section")
+        .filter(pl.col("cpc_section") != "D")
+        .sort("cpc_section")
+        .get_column("cpc_section")
+    )
+
+    return {
+        section: (
+            controls.filter(pl.col("cpc_section") == section).drop("cpc_section"),
+            section_distances.filter(pl.col("cpc_section") == section).drop(
+                "cpc_section"
+            ),
+        )
+        for section in sections
+    }
+
+
+def _section_state(controls, distances):
+    distances = distances.select("parent_patent_id", "child_patent_id", "distance")
+
+    # NOTE: controls are grouped by treated pair once, a draw is then an
+    # index into each group's block of rows
+    controls = (
+        controls.sort("cited_patent_id", "citing_patent_id")
+        .with_row_index("row")
+        .join(
+            distances.group_by("parent_patent_id", "child_patent_id").agg(
+                pl.col("distance").first(), pl.len().alias("copies")
+            ),
+            left_on=["cited_patent_id", "control_patent_id"],
+            right_on=["parent_patent_id", "child_patent_id"],
+            how="left",
+        )
+        .sort("row")
+    )
+
+    group_starts = (
+        controls.select(
+            pl.struct("cited_patent_id", "citing_patent_id").is_first_distinct()
+        )
+        .to_series()
+        .arg_true()
+        .to_numpy()
+    )
+
+    return {
+        "offsets": np.append(group_starts, controls.height).astype(np.int64),
+        "distances": controls.get_column("distance").fill_null(0).to_numpy(),
+        # NOTE: the left join in R repeats a distance once per matching row
+        # and drops controls without one
+        "copies": controls.get_column("copies").fill_null(0).to_numpy(),
+        "range": distances.get_column("distance").max() * 1.1,
+    }
+
+
+def create_bands(
+    controls, distances, n_draws=1000, n_workers=4, seed=42, chunk_size=50
+):
+    state = _section_state(controls, distances)
+
+    # NOTE: draws are split into fixed chunks with their own seeds, so the
+    # bands do not depend on the number of workers
+    seeds = np.random.SeedSequence(seed).spawn(math.ceil(n_draws / chunk_size))
+    chunks = [
+        (chunk_seed, min(chunk_size, n_draws - i * chunk_size))
+        for i, chunk_seed in enumerate(seeds)
+    ]
+
+    results = {}
+    progress = tqdm(total=n_draws, desc="Bootstrap draws", unit="draw")
+
+    if n_workers == 1:
+        for chunk_seed, size in chunks:
+            results[chunk_seed.spawn_key] = _draw_densities(state, chunk_seed, size)
+            progress.update(size)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=get_context("spawn"),
+            initializer=_start_worker,
+            initargs=(state,),
+        ) as executor:
+            futures = [
+                executor.submit(_draw_worker_densities, *chunk) for chunk in chunks
+            ]
+
+            for future in as_completed(futures):
+                chunk_seed, densities = future.result()
+                results[chunk_seed.spawn_key] = densities
+                progress.update(len(densities))
+
+    progress.close()
+
+    simulated = np.concatenate(
+        [results[chunk_seed.spawn_key] for chunk_seed, _ in chunks]
+    )
+
+    # NOTE: local bands are pointwise quantiles, global bands shift the median
+    # by quantiles of each draw's largest deviation from it
+    median = np.median(simulated, axis=0)
+    lower_local, upper_local = np.quantile(simulated, [0.05, 0.95], axis=0)
+    deviation = simulated - median
+    upper_threshold = np.quantile(deviation.max(axis=1), 0.95)
+    lower_threshold = np.quantile(deviation.min(axis=1), 0.05)
+
+    treated = (
+        controls.select("cited_patent_id", "citing_patent_id")
+        .unique()
+        .join(
+            distances,
+            left_on=["cited_patent_id", "citing_patent_id"],
+            right_on=["parent_patent_id", "child_patent_id"],
+        )
+        .get_column("distance")
+        .to_numpy()
+    )
+    grid, density = reflected_density(treated, state["range"])
+
+    return pl.DataFrame(
+        {
+            "distance": grid,
+            "density": density,
+            "upper_band": median + upper_threshold,
+            "lower_band": median + lower_threshold,
+            "lower_local": lower_local,
+            "upper_local": upper_local,
+        }
+    )
+
+
+def make_bands(
+    processed_path=Path("data", "processed"),
+    save_path=Path("data", "processed", "results.parquet"),
+    n_draws=1000,
+    n_workers=4,
+    seed=42,
+):
+    # NOTE: called from main.R, counts arrive as doubles
+    n_draws = int(n_draws)
+    n_workers = int(n_workers)
+
+    results = pl.concat(
+        create_bands(controls, distances, n_draws, n_workers, seed).select(
+            pl.lit(section).alias("cpc_section"), pl.all()
+        )
+        for section, (controls, distances) in load_sections(processed_path).items()
+    )
+
+    temp_path = save_path.with_suffix(".tmp")
+    results.write_parquet(temp_path)
+    temp_path.replace(save_path)
+
+    return results
+
+
+if __name__ == "__main__":
+    make_bands()
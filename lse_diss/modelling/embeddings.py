@@ -1,18 +1,291 @@
-from math import ceil
+import hashlib
+import os
+import time
+import unicodedata
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from pathlib import Path
 import re
 
+import numpy as np
 import polars as pl
+import torch
 from sentence_transformers import SentenceTransformer
+from tqdm import tqdm
+
+MODEL_NAME = "nomic-ai/nomic-embed-text-v2-moe"
+TRUNCATE_DIM = 256
+EMBEDDING_CACHE_VERSION = 1
+# NOTE: the int8 onnx encoder in quantized.py is not offered here until
+# check_quantized has been run against the real model and its figures recorded
+BACKENDS = ["torch"]
+
+_worker_state = {}
+
+
+def count_tokens(model, abstracts, prompt_name="passage"):
+    prompt = model.prompts.get(prompt_name, "")
+
+    tokens = model.tokenizer(
+        [prompt + abstract for abstract in abstracts],
+        truncation=True,
+        max_length=model.max_seq_length,
+    )["input_ids"]
+
+    return np.array([len(ids) for ids in tokens])
+
+
+def make_token_batches(lengths, max_tokens=16384):
+    # NOTE: longest first, so the first abstract sets the padded batch length
+    order = np.argsort(-lengths, kind="stable")
+
+    batches = []
+    start = 0
+    while start < len(order):
+        size = max(max_tokens // lengths[order[start]], 1)
+        batches.append(order[start : start + size])
+        start += size
+
+    return batches
+
+
+def padded_tokens(lengths, batches):
+    return sum(len(batch) * lengths[batch].max() for batch in batches)
+
+
+def encode_abstracts(model, abstracts, max_tokens=16384, prompt_name="passage"):
+    lengths = count_tokens(model, abstracts, prompt_name)
+    batches = make_token_batches(lengths, max_tokens)
+
+    embeddings = None
+    start_time = time.perf_counter()
+
+    for batch in tqdm(batches, desc="Encoding batches", unit="batch"):
+        batch_embeddings = model.encode(
+            [abstracts[k] for k in batch],
+            prompt_name=prompt_name,
+            batch_size=len(batch),
+        )
+
+        if embeddings is None:
+            embeddings = np.empty(
+                (len(abstracts), batch_embeddings.shape[1]),
+                dtype=batch_embeddings.dtype,
+            )
+
+        # NOTE: rows go back to their original position in the chunk
+        embeddings[batch] = batch_embeddings
+
+    elapsed = time.perf_counter() - start_time
+
+    # NOTE: SentenceTransformer.encode sorts by characters in batches of 64
+    char_order = np.argsort([-len(abstract) for abstract in abstracts], kind="stable")
+    fixed_batches = [
+        char_order[start : start + 64] for start in range(0, len(char_order), 64)
+    ]
+    overhead = padded_tokens(lengths, batches) / lengths.sum() - 1
+    fixed_overhead = padded_tokens(lengths, fixed_batches) / lengths.sum() - 1
+
+    print(
+        f"{len(abstracts) / elapsed:.1f} sentences/s, "
+        f"padding overhead {overhead:.1%} "
+        f"(batches of 64: {fixed_overhead:.1%})"
+    )
+
+    return embeddings
+
+
+def load_model(backend="torch"):
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
+
+    return SentenceTransformer(
+        MODEL_NAME, trust_remote_code=True, truncate_dim=TRUNCATE_DIM
+    )
+
+
+def _cache_name(backend):
+    # NOTE: int8 embeddings are close to but not equal to the float32 ones, so
+    # they are cached under their own key
+    return MODEL_NAME if backend == "torch" else f"{MODEL_NAME}#{backend}"
+
+
+def _normalise(abstract):
+    return " ".join(unicodedata.normalize("NFKC", abstract).split())
+
+
+def hash_abstracts(abstracts, model_name, truncate_dim, prompt_name):
+    prefix = f"{model_name}\0{truncate_dim}\0{prompt_name}\0"
+
+    return [
+        hashlib.blake2b(
+            (prefix + _normalise(abstract)).encode(), digest_size=16
+        ).hexdigest()
+        for abstract in abstracts
+    ]
+
+
+def cache_embeddings(
+    model,
+    abstracts,
+    cache_path=Path("data", "interim", "embedding_cache"),
+    prompt_name="passage",
+    max_tokens=16384,
+    model_name=MODEL_NAME,
+):
+    # NOTE: keys cover the model, the truncation and the prompt, so one cache
+    # can hold embeddings from several models without mixing them up
+    version_path = cache_path / f"v{EMBEDDING_CACHE_VERSION}"
+    version_path.mkdir(parents=True, exist_ok=True)
+
+    requested = pl.DataFrame(
+        {
+            "text_hash": hash_abstracts(
+                abstracts, model_name, model.truncate_dim, prompt_name
+            )
+        }
+    ).with_row_index("position")
+    texts = requested.unique("text_hash", keep="first", maintain_order=True)
+
+    parts = sorted(version_path.glob("part_*.parquet"))
+
+    if parts:
+        cached = (
+            pl.scan_parquet(parts)
+            .join(texts.lazy().select("text_hash"), on="text_hash")
+            .unique("text_hash")
+            .collect()
+        )
+    else:
+        cached = None
+
+    missing = (
+        texts
+        if cached is None
+        else texts.join(cached.select("text_hash"), on="text_hash", how="anti")
+    )
+
+    if not missing.is_empty():
+        missing_abstracts = [abstracts[i] for i in missing.get_column("position")]
+
+        if max_tokens is None:
+            embeddings = model.encode(
+                missing_abstracts,
+                prompt_name=prompt_name,
+                batch_size=64,
+                show_progress_bar=True,
+            )
+        else:
+            embeddings = encode_abstracts(
+                model, missing_abstracts, max_tokens=max_tokens, prompt_name=prompt_name
+            )
+
+        computed = missing.select("text_hash").with_columns(embedding=embeddings)
+
+        # NOTE: random names, so workers writing at the same time never clash
+        part_path = version_path / f"part_{uuid.uuid4().hex}.parquet"
+        temp_path = part_path.with_suffix(".tmp")
+        computed.write_parquet(temp_path)
+        temp_path.replace(part_path)
+
+        cached = computed if cached is None else pl.concat([cached, computed])
+
+    print(
+        f"embedding cache: {len(abstracts) - missing.height} encodes avoided "
+        f"({texts.height - missing.height} cached, "
+        f"{len(abstracts) - texts.height} duplicates), "
+        f"{missing.height} encoded"
+    )
+
+    embeddings = (
+        requested.join(cached, on="text_hash", how="left", maintain_order="left")
+        .get_column("embedding")
+        .to_numpy()
+    )
+
+    return embeddings, missing.height
+
+
+def _encode_shard(
+    model, abstracts_path, rows, file_name, max_tokens, cache_path, backend
+):
+    # NOTE: remaining rows are mostly one contiguous range, so the slice keeps
+    # the scan short and the filter drops rows encoded by an earlier run
+    patents = (
+        pl.scan_parquet(abstracts_path)
+        .with_row_index("row")
+        .slice(int(rows[0]), int(rows[-1] - rows[0]) + 1)
+        .filter(pl.col("row").is_in(rows))
+        .select(pl.exclude("row"))
+        .collect()
+    )
+    abstracts = patents.get_column("patent_abstract").to_list()
+
+    if cache_path is not None:
+        embeddings, encoded = cache_embeddings(
+            model,
+            abstracts,
+            cache_path=cache_path,
+            max_tokens=max_tokens,
+            model_name=_cache_name(backend),
+        )
+    elif max_tokens is None:
+        embeddings = model.encode(
+            abstracts, prompt_name="passage", batch_size=64, show_progress_bar=True
+        )
+        encoded = len(abstracts)
+    else:
+        embeddings = encode_abstracts(model, abstracts, max_tokens=max_tokens)
+        encoded = len(abstracts)
+
+    # NOTE: the shard only becomes visible once it is complete, so every
+    # patent_id on disk has been fully encoded
+    temp_name = file_name.with_suffix(".tmp")
+    patents.select(pl.exclude("patent_abstract")).with_columns(
+        embedding=embeddings
+    ).write_parquet(temp_name)
+    temp_name.replace(file_name)
+
+    return patents.height, encoded
+
+
+def _start_worker(threads, backend):
+    torch.set_num_threads(threads)
+    _worker_state["model"] = load_model(backend)
+
+
+def _encode_worker_shard(*shard):
+    return _encode_shard(_worker_state["model"], *shard)
+
+
+def _remaining_rows(abstracts_path, save_path):
+    patents = pl.scan_parquet(abstracts_path).select("patent_id").with_row_index("row")
+
+    if any(save_path.glob("embedded_abstracts_*.parquet")):
+        encoded = pl.scan_parquet(save_path / "embedded_abstracts_*.parquet").select(
+            "patent_id"
+        )
+        patents = patents.join(encoded, on="patent_id", how="anti")
+
+    return patents.select("row").collect().get_column("row").sort().to_numpy()
 
 
 def make_embeddings(
     abstracts_path=Path("data", "interim", "abstracts.parquet"),
     save_path=Path("data", "processed", "embeddings"),
     batch_size=40000,
+    max_tokens=16384,
+    n_workers=1,
+    cache_path=Path("data", "interim", "embedding_cache"),
+    backend="torch",
 ):
     save_path.mkdir(exist_ok=True, parents=True)
 
+    # NOTE: partial shards left behind by an interrupted run
+    for file_path in save_path.glob("embedded_abstracts_*.tmp"):
+        file_path.unlink()
+
     j = -1
     file_pattern = re.compile(r"embedded_abstracts_(\d+)\.parquet")
     for file_path in save_path.glob("embedded_abstracts_*.parquet"):
@@ -22,32 +295,71 @@ def make_embeddings(
 
     j = j + 1
 
-    model = SentenceTransformer(
-        "nomic-ai/nomic-embed-text-v2-moe", trust_remote_code=True, truncate_dim=256
-    )
+    # NOTE: what is left is decided by the patent_ids already written, file
+    # numbers are only used to name new shards
+    rows = _remaining_rows(abstracts_path, save_path)
 
-    patents = pl.scan_parquet(abstracts_path)
+    total_rows = pl.scan_parquet(abstracts_path).select(pl.len()).collect().item()
+    if len(rows) < total_rows:
+        print(f"resuming embeddings, {total_rows - len(rows)} abstracts done")
 
-    total_rows = patents.select(pl.len()).collect().item(0, 0)
-    total_batches = ceil(total_rows / batch_size)
+    shards = [
+        (
+            abstracts_path,
+            rows[start : start + batch_size],
+            save_path / f"embedded_abstracts_{i + j}.parquet",
+            max_tokens,
+            cache_path,
+            backend,
+        )
+        for i, start in enumerate(range(0, len(rows), batch_size))
+    ]
 
-    for i in range(total_batches):
-        start = i * batch_size
-        length = min(batch_size, total_rows - start)
+    progress = tqdm(total=len(shards), desc="Encoding shards", unit="shard")
+    totals = {"rows": 0, "encoded": 0}
 
-        file_path = save_path / f"embedded_abstracts_{i + j}.parquet"
+    def record(rows, encoded):
+        totals["rows"] += rows
+        totals["encoded"] += encoded
+        progress.update()
 
-        sliced_patents = patents.slice(start, length).collect()
-        abstracts = sliced_patents.get_column("patent_abstract").to_list()
+    if n_workers == 1:
+        model = load_model(backend)
 
-        embeddings = model.encode(
-            abstracts, prompt_name="passage", batch_size=64, show_progress_bar=True
-        )
+        for shard in shards:
+            record(*_encode_shard(model, *shard))
+    else:
+        # NOTE: each worker loads its own model, torch and polars threads are
+        # split between workers instead of oversubscribed
+        threads = max(os.cpu_count() // n_workers, 1)
+        previous_threads = os.environ.get("POLARS_MAX_THREADS")
+        os.environ["POLARS_MAX_THREADS"] = str(threads)
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=get_context("spawn"),
+                initializer=_start_worker,
+                initargs=(threads, backend),
+            ) as executor:
+                futures = [
+                    executor.submit(_encode_worker_shard, *shard) for shard in shards
+                ]
+
+                for future in as_completed(futures):
+                    record(*future.result())
+        finally:
+            if previous_threads is None:
+                os.environ.pop("POLARS_MAX_THREADS")
+            else:
+                os.environ["POLARS_MAX_THREADS"] = previous_threads
 
-        # NOTE: I spot checked and the order is being preserved
-        sliced_patents.select("patent_id").with_columns(
-            embedding=embeddings
-        ).write_parquet(file_path)
+    progress.close()
+
+    print(
+        f"{totals['rows']} abstracts embedded, {totals['encoded']} encoded, "
+        f"{totals['rows'] - totals['encoded']} encodes avoided"
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from math import ceil
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+
+def _manifest_path(path):
+    # NOTE: kept beside the directory so scans of it only see parquet files
+    return path.with_name(f"{path.name}_manifest.json")
+
+
+def _read_manifest(path, parameters):
+    manifest_path = _manifest_path(path)
+
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+
+        if manifest["parameters"] == parameters:
+            return manifest
+
+        print("neighbour parameters changed, discarding previous batches")
+
+    for file_path in path.glob("neighbours_*.parquet"):
+        file_path.unlink()
+
+    return {"parameters": parameters, "batches": []}
+
+
+def _write_manifest(path, manifest):
+    manifest_path = _manifest_path(path)
+    temp_path = manifest_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest, indent=2))
+    temp_path.replace(manifest_path)
+
+
+def index_fingerprint(voyager_index, n_samples=1_000):
+    ids = np.sort(
+        np.fromiter(voyager_index.ids, dtype=np.int64, count=len(voyager_index))
+    )
+
+    # NOTE: the index arrives opened, not as a file, so its contents are
+    # summarised by its ids and the vectors of evenly spaced ones
+    sample = ids[np.linspace(0, len(ids) - 1, min(n_samples, len(ids)), dtype=int)]
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(ids.tobytes())
+    if len(sample):
+        digest.update(
+            np.asarray(
+                voyager_index.get_vectors(sample.tolist()), dtype=np.float32
+            ).tobytes()
+        )
+
+    return {
+        "space": str(voyager_index.space),
+        "num_dimensions": voyager_index.num_dimensions,
+        "M": voyager_index.M,
+        "ef_construction": voyager_index.ef_construction,
+        "storage_data_type": str(voyager_index.storage_data_type),
+        "size": len(voyager_index),
+        "digest": digest.hexdigest(),
+    }
+
+
+def _query_batch(
+    voyager_index, store, start, batch_size, n_neighbours, query_ef, file_name
+):
+    embeddings = np.ascontiguousarray(
+        store.embeddings[start : start + batch_size], dtype=np.float32
+    )
+
+    # NOTE: batches already run in parallel, so each query uses one thread
+    neighbours, distances = voyager_index.query(
+        embeddings, n_neighbours, num_threads=1, query_ef=query_ef
+    )
+
+    n_queries, k = neighbours.shape
+
+    batch = pl.DataFrame(
+        {
+            "query_row": np.repeat(
+                np.arange(start, start + n_queries, dtype=np.uint32), k
+            ),
+            "neighbour_row": neighbours.ravel().astype(np.uint32),
+            "rank": np.tile(np.arange(k, dtype=np.uint16), n_queries),
+            "distance": distances.ravel().astype(np.float32),
+        }
+    )
+
+    temp_name = file_name.with_suffix(".tmp")
+    batch.write_parquet(temp_name)
+    temp_name.replace(file_name)
+
+    return start // batch_size
+
+
+def query_neighbours(
+    voyager_index,
+    store,
+    n_neighbours,
+    save_path=Path("data", "interim", "neighbours"),
+    batch_size=10_000,
+    n_threads=4,
+    query_ef=-1,
+):
+    save_path.mkdir(parents=True, exist_ok=True)
+
+    total_rows = len(store.embeddings)
+    total_batches = ceil(total_rows / batch_size)
+
+    parameters = {
+        "n_neighbours": n_neighbours,
+        "batch_size": batch_size,
+        "query_ef": query_ef,
+        "total_rows": total_rows,
+        # NOTE: a rebuilt index or store gives other neighbours for the same
+        # rows, so batches of the previous ones are not resumed
+        "index": index_fingerprint(voyager_index),
+        "store_hash": str(store.rows.hash_rows(seed=0).sum()),
+    }
+
+    # NOTE: partial files left behind by an interrupted run
+    for file_path in save_path.glob("neighbours_*.tmp"):
+        file_path.unlink()
+
+    manifest = _read_manifest(save_path, parameters)
+
+    remaining = [
+        i
+        for i in range(total_batches)
+        if i not in manifest["batches"]
+        or not (save_path / f"neighbours_{i}.parquet").exists()
+    ]
+
+    if len(remaining) < total_batches:
+        print(f"resuming neighbours, {total_batches - len(remaining)} batches done")
+
+    _write_manifest(save_path, manifest)
+
+    progress = tqdm(total=len(remaining), desc="Querying batches", unit="batch")
+
+    # NOTE: at most n_threads batches are held in memory at any time, results
+    # go straight to disk and only the batch number comes back
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = [
+            executor.submit(
+                _query_batch,
+                voyager_index,
+                store,
+                i * batch_size,
+                batch_size,
+                n_neighbours,
+                query_ef,
+                save_path / f"neighbours_{i}.parquet",
+            )
+            for i in remaining
+        ]
+
+        for future in as_completed(futures):
+            manifest["batches"].append(future.result())
+            _write_manifest(save_path, manifest)
+            progress.update()
+
+    progress.close()
+
+    return pl.scan_parquet(save_path / "neighbours_*.parquet")
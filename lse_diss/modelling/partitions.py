@@ -0,0 +1,255 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+from voyager import Index, Space, StorageDataType
+
+from lse_diss.modelling.store import iter_chunks, open_store
+
+
+class PartitionedIndex(NamedTuple):
+    indexes: dict
+    partitions: pl.DataFrame
+    window_days: int
+    by_section: bool
+
+
+def assign_partitions(
+    store,
+    patents_path=Path("data", "interim", "patents"),
+    classes_path=None,
+    window_days=365,
+):
+    dates = (
+        pl.scan_parquet(patents_path)
+        .select("patent_key", "application_date")
+        .unique("patent_key")
+    )
+
+    partitions = (
+        store.rows.lazy()
+        .select("row", "patent_id", "patent_key")
+        .join(dates, on="patent_key")
+        .with_columns(
+            window=(pl.col("application_date").to_physical() // window_days).cast(
+                pl.Int32
+            )
+        )
+    )
+
+    # NOTE: patents go to the partition of their first listed CPC section
+    if classes_path is not None:
+        sections = (
+            pl.scan_parquet(classes_path)
+            .filter(pl.col("cpc_sequence").cast(pl.Int64) == 0)
+            .select(pl.col("patent_id").cast(pl.String), "cpc_section")
+            .unique("patent_id")
+        )
+        partitions = partitions.join(sections, on="patent_id", how="left").with_columns(
+            pl.col("cpc_section").fill_null("none")
+        )
+    else:
+        partitions = partitions.with_columns(cpc_section=pl.lit("all"))
+
+    return (
+        partitions.with_columns(partition=pl.format("{}_{}", "window", "cpc_section"))
+        .sort("row")
+        .collect()
+    )
+
+
+def _build_partition(
+    store, rows, file_path, M, ef_construction, storage_data_type, num_threads
+):
+    index = Index(
+        Space.Cosine,
+        num_dimensions=store.embeddings.shape[1],
+        M=M,
+        ef_construction=ef_construction,
+        storage_data_type=storage_data_type,
+    )
+
+    for chunk_rows, embeddings in iter_chunks(store, 100_000, rows):
+        index.add_items(embeddings, ids=chunk_rows.tolist(), num_threads=num_threads)
+
+    temp_path = file_path.with_suffix(".tmp")
+    index.save(str(temp_path))
+    temp_path.replace(file_path)
+
+    return len(index)
+
+
+def create_partitioned_index(
+    store_path=Path("data", "interim", "embedding_store"),
+    patents_path=Path("data", "interim", "patents"),
+    save_path=Path("data", "interim", "partitions"),
+    classes_path=None,
+    window_days=365,
+    n_workers=4,
+    M=12,
+    ef_construction=200,
+    storage_data_type=StorageDataType.E4M3,
+):
+    save_path.mkdir(parents=True, exist_ok=True)
+
+    for file_path in save_path.glob("index_*.voy"):
+        file_path.unlink()
+
+    store = open_store(store_path)
+    partitions = assign_partitions(store, patents_path, classes_path, window_days)
+
+    groups = partitions.group_by("partition", maintain_order=True).agg("row")
+
+    print(f"building {groups.height} partitions with {n_workers} workers")
+
+    # NOTE: voyager releases the GIL while inserting, so threads build the
+    # partitions side by side with the cores split between them
+    threads = max(os.cpu_count() // n_workers, 1)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        sizes = list(
+            executor.map(
+                lambda group: _build_partition(
+                    store,
+                    np.asarray(group[1]),
+                    save_path / f"index_{group[0]}.voy",
+                    M,
+                    ef_construction,
+                    storage_data_type,
+                    threads,
+                ),
+                groups.iter_rows(),
+            )
+        )
+
+    partitions.select(
+        "row",
+        "patent_id",
+        "patent_key",
+        "application_date",
+        "cpc_section",
+        "partition",
+    ).write_parquet(save_path / "partitions.parquet")
+
+    (save_path / "settings.json").write_text(
+        json.dumps(
+            {"window_days": window_days, "by_section": classes_path is not None},
+            indent=2,
+        )
+    )
+
+    print(f"partition sizes: min {min(sizes)}, max {max(sizes)}")
+
+
+def open_partitioned_index(path=Path("data", "interim", "partitions")):
+    settings = json.loads((path / "settings.json").read_text())
+    partitions = pl.read_parquet(path / "partitions.parquet")
+
+    indexes = {}
+    for partition in partitions.get_column("partition").unique():
+        with open(path / f"index_{partition}.voy", "rb") as f:
+            indexes[partition] = Index.load(f)
+
+    return PartitionedIndex(
+        indexes=indexes,
+        partitions=partitions,
+        window_days=settings["window_days"],
+        by_section=settings["by_section"],
+    )
+
+
+def query_partitions(
+    partitioned,
+    store,
+    query_rows,
+    n_neighbours,
+    search_range=30,
+    batch_size=10_000,
+    n_threads=4,
+    share=None,
+):
+    window_days = partitioned.window_days
+    sizes = {partition: len(index) for partition, index in partitioned.indexes.items()}
+
+    # NOTE: a query only goes to the windows its +/- search_range can reach,
+    # and with sections only to the partitions of its own section
+    targets = (
+        pl.DataFrame({"query_row": query_rows}, schema={"query_row": pl.UInt32})
+        .join(
+            partitioned.partitions.select(
+                pl.col("row").alias("query_row"),
+                pl.col("application_date").to_physical().alias("day"),
+                "cpc_section",
+            ),
+            on="query_row",
+        )
+        .with_columns(
+            window=pl.int_ranges(
+                (pl.col("day") - search_range) // window_days,
+                (pl.col("day") + search_range) // window_days + 1,
+            )
+        )
+        .explode("window")
+        .with_columns(partition=pl.format("{}_{}", "window", "cpc_section"))
+        .filter(pl.col("partition").is_in(list(partitioned.indexes)))
+        .with_columns(
+            size=pl.col("partition").replace_strict(sizes, return_dtype=pl.Int64)
+        )
+    )
+
+    # NOTE: with a share, each query keeps the same fraction of the patents it
+    # searched as the single index keeps of the corpus
+    if share is None:
+        limits = targets.select("query_row").unique().with_columns(limit=n_neighbours)
+    else:
+        limits = targets.group_by("query_row").agg(
+            limit=(pl.col("size").sum() * share).ceil().cast(pl.Int64)
+        )
+
+    targets = targets.join(limits, on="query_row")
+
+    batches = []
+
+    for (partition,), group in targets.group_by("partition"):
+        index = partitioned.indexes[partition]
+        k = min(group.get_column("limit").max(), len(index))
+        rows = np.sort(group.get_column("query_row").to_numpy())
+
+        for chunk_rows, embeddings in iter_chunks(store, batch_size, rows):
+            neighbours, distances = index.query(embeddings, k, num_threads=n_threads)
+
+            batches.append(
+                pl.DataFrame(
+                    {
+                        "query_row": np.repeat(chunk_rows, k).astype(np.uint32),
+                        "neighbour_row": neighbours.ravel().astype(np.uint32),
+                        "distance": distances.ravel(),
+                    }
+                )
+            )
+
+    if not batches:
+        return pl.DataFrame(
+            schema={
+                "query_row": pl.UInt32,
+                "neighbour_row": pl.UInt32,
+                "rank": pl.UInt32,
+                "distance": pl.Float32,
+            }
+        )
+
+    # NOTE: the top k of the union of partitions is within the top k of each
+    # partition, so merging by distance gives the same ranks as one index
+    # over those partitions would, and a superset of the single index matches
+    return (
+        pl.concat(batches)
+        .sort("query_row", "distance")
+        .with_columns(rank=pl.int_range(pl.len(), dtype=pl.UInt32).over("query_row"))
+        .join(limits, on="query_row")
+        .filter(pl.col("rank") < pl.col("limit"))
+        .select("query_row", "neighbour_row", "rank", "distance")
+    )
@@ -0,0 +1,299 @@
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import torch
+
+# NOTE: onnx and onnxruntime come with the optional "onnx" dependencies and
+# are only imported once the encoder is used. It has only been checked on toy
+# models, the real model could not be downloaded here, so it is not a backend
+# of load_model until `python -m lse_diss.modelling.quantized` has been run
+
+
+class _Pipeline(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        features = self.model(
+            {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+
+        return features["sentence_embedding"]
+
+
+# NOTE: a mixture of experts routes every token to some of its experts, so the
+# graph is checked on texts of other lengths and batch sizes than the one it
+# was exported with, a trace that froze the routing of the example fails here
+VERIFY_SENTENCES = [
+    "A battery electrode.",
+    "A method of forming a gate stack, a spacer and source and drain regions.",
+    "Routing packets in a wireless mesh network based on link quality and load.",
+    "An antibody that binds a tumour antigen.",
+    "A vehicle seat with a lumbar support driven by a motor through a worm gear.",
+    "Polymer blends for packaging films with better barriers to oxygen.",
+    "A turbine blade cooling passage.",
+    "Compressing images with a learned transform, entropy model and quantiser.",
+]
+
+
+def _tokenize(tokenizer, sentences, max_seq_length):
+    # NOTE: same arguments as sentence_transformers' Transformer.tokenize
+    return tokenizer(
+        [sentence.strip() for sentence in sentences],
+        padding=True,
+        truncation="longest_first",
+        return_tensors="np",
+        max_length=max_seq_length,
+    )
+
+
+def _export(model, float_path):
+    features = model.tokenize(VERIFY_SENTENCES[:4])
+
+    # NOTE: the whole pipeline is exported, transformer and pooling, so the
+    # graph returns the same vectors as model.encode before truncation. The
+    # dynamo exporter keeps data dependent routing in the graph, the tracer is
+    # the fallback for models it cannot capture
+    batch = torch.export.Dim("batch")
+    sequence = torch.export.Dim("sequence")
+    shapes = {
+        True: {
+            "dynamic_shapes": {
+                "input_ids": {0: batch, 1: sequence},
+                "attention_mask": {0: batch, 1: sequence},
+            }
+        },
+        False: {
+            "dynamic_axes": {
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "sentence_embedding": {0: "batch"},
+            }
+        },
+    }
+
+    for dynamo in [True, False]:
+        try:
+            torch.onnx.export(
+                _Pipeline(model.cpu().eval()),
+                (features["input_ids"], features["attention_mask"]),
+                float_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["sentence_embedding"],
+                opset_version=18,
+                dynamo=dynamo,
+                **shapes[dynamo],
+            )
+            return
+        except Exception as error:
+            if not dynamo:
+                raise
+            print(f"dynamo export failed, tracing instead: {error}")
+
+
+def verify_export(model, path, tolerance=1e-3):
+    import onnxruntime as ort
+
+    session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    worst = 0.0
+
+    # NOTE: single texts, a reordered pair and the whole list, so batch
+    # size, sequence length and routing all differ from the export example
+    for sentences in [
+        VERIFY_SENTENCES[-1:],
+        VERIFY_SENTENCES[4:6][::-1],
+        VERIFY_SENTENCES,
+    ]:
+        features = _tokenize(model.tokenizer, sentences, model.max_seq_length)
+        exported = session.run(
+            ["sentence_embedding"],
+            {
+                "input_ids": features["input_ids"],
+                "attention_mask": features["attention_mask"],
+            },
+        )[0]
+
+        with torch.no_grad():
+            expected = _Pipeline(model.cpu().eval())(
+                torch.from_numpy(features["input_ids"]),
+                torch.from_numpy(features["attention_mask"]),
+            ).numpy()
+
+        worst = max(worst, float(np.abs(exported - expected).max()))
+
+    if worst > tolerance:
+        raise ValueError(
+            f"exported graph differs from the model by {worst:.2e}, more than "
+            f"{tolerance:.0e}, the export likely froze part of the model"
+        )
+
+    return worst
+
+
+def export_quantized(model, save_path):
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.tools.symbolic_shape_infer import SymbolicShapeInference
+    from onnxruntime.transformers.optimizer import optimize_model
+
+    float_path = save_path / "model.onnx"
+    optimised_path = save_path / "model_optimised.onnx"
+    quantized_path = save_path / "model_int8.onnx"
+
+    if quantized_path.exists():
+        return quantized_path
+
+    save_path.mkdir(parents=True, exist_ok=True)
+
+    _export(model, float_path)
+
+    # NOTE: attention, layer norms and gelu are fused before quantising, the
+    # fused operators have int8 kernels that the unfused subgraphs lack
+    optimised = optimize_model(str(float_path), model_type="bert", opt_level=1)
+    fused = {
+        name: count
+        for name, count in optimised.get_fused_operator_statistics().items()
+        if count
+    }
+    print(f"fused operators: {fused}")
+
+    # NOTE: shapes the exporter annotated no longer hold after fusion, they
+    # are inferred again by onnxruntime, which knows the fused operators
+    optimised.model.graph.ClearField("value_info")
+    onnx.save(
+        SymbolicShapeInference.infer_shapes(optimised.model, auto_merge=True),
+        optimised_path,
+        save_as_external_data=True,
+        location=f"{optimised_path.name}.data",
+    )
+    worst = verify_export(model, optimised_path)
+    print(f"optimised graph within {worst:.2e} of the model on varied inputs")
+
+    temp_path = quantized_path.with_suffix(".tmp")
+    quantize_dynamic(optimised_path, temp_path, weight_type=QuantType.QInt8)
+    temp_path.replace(quantized_path)
+
+    return quantized_path
+
+
+# NOTE: stands in for a SentenceTransformer in encode_abstracts and
+# cache_embeddings once checked, tokenizer, prompts and truncation come from the original,
+# which is not kept so the float32 weights are freed once exported
+class QuantizedEncoder:
+    def __init__(self, model, save_path):
+        import onnxruntime as ort
+
+        self.prompts = model.prompts
+        self.tokenizer = model.tokenizer
+        self.max_seq_length = model.max_seq_length
+        self.truncate_dim = model.truncate_dim
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+
+        self.session = ort.InferenceSession(
+            export_quantized(model, save_path),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+
+    def tokenize(self, sentences):
+        return _tokenize(self.tokenizer, sentences, self.max_seq_length)
+
+    def encode(self, sentences, prompt_name=None, batch_size=32, **kwargs):
+        prompt = self.prompts.get(prompt_name, "") if prompt_name else ""
+        sentences = [prompt + sentence for sentence in sentences]
+
+        # NOTE: sorted by length like model.encode so batches pad little
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        embeddings = None
+
+        for start in range(0, len(sentences), batch_size):
+            batch = order[start : start + batch_size]
+            features = self.tokenize([sentences[k] for k in batch])
+
+            batch_embeddings = self.session.run(
+                ["sentence_embedding"],
+                {
+                    "input_ids": features["input_ids"],
+                    "attention_mask": features["attention_mask"],
+                },
+            )[0][:, : self.truncate_dim]
+
+            if embeddings is None:
+                embeddings = np.empty(
+                    (len(sentences), batch_embeddings.shape[1]), dtype=np.float32
+                )
+
+            embeddings[batch] = batch_embeddings
+
+        return embeddings
+
+
+def check_quantized(
+    model,
+    quantized,
+    abstracts_path=Path("data", "interim", "abstracts.parquet"),
+    sample_size=2000,
+    n_neighbours=10,
+    seed=42,
+):
+    abstracts = pl.scan_parquet(abstracts_path).select("patent_abstract").collect()
+    abstracts = (
+        abstracts.sample(min(sample_size, abstracts.height), seed=seed)
+        .get_column("patent_abstract")
+        .to_list()
+    )
+
+    baseline = model.encode(abstracts, prompt_name="passage", batch_size=64)
+    candidate = quantized.encode(abstracts, prompt_name="passage", batch_size=64)
+
+    baseline = baseline / np.linalg.norm(baseline, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+
+    cosine = (baseline * candidate).sum(axis=1)
+
+    # NOTE: neighbours within the sample, the abstract itself excluded
+    def neighbours(embeddings):
+        similarity = embeddings @ embeddings.T
+        np.fill_diagonal(similarity, -np.inf)
+        return np.argsort(-similarity, axis=1)[:, :n_neighbours]
+
+    baseline_neighbours = neighbours(baseline)
+    candidate_neighbours = neighbours(candidate)
+
+    overlap = np.array(
+        [
+            len(np.intersect1d(a, b)) / n_neighbours
+            for a, b in zip(baseline_neighbours, candidate_neighbours)
+        ]
+    )
+
+    report = {
+        "sample_size": len(abstracts),
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        "p01_cosine": float(np.quantile(cosine, 0.01)),
+        "mean_neighbour_overlap": float(overlap.mean()),
+        "min_neighbour_overlap": float(overlap.min()),
+    }
+
+    print(
+        f"int8 vs float32 on {report['sample_size']} abstracts: "
+        f"cosine mean {report['mean_cosine']:.4f}, "
+        f"1% {report['p01_cosine']:.4f}, min {report['min_cosine']:.4f}; "
+        f"{n_neighbours}-NN overlap mean {report['mean_neighbour_overlap']:.3f}, "
+        f"min {report['min_neighbour_overlap']:.3f}"
+    )
+
+    return report
+
+
+if __name__ == "__main__":
+    from lse_diss.modelling.embeddings import MODEL_NAME, load_model
+
+    # NOTE: exported and quantised on first use, later runs load the file
+    onnx_path = Path("data", "interim", "onnx", MODEL_NAME.replace("/", "__"))
+    check_quantized(load_model(), QuantizedEncoder(load_model(), onnx_path))
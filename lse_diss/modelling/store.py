@@ -0,0 +1,174 @@
+import json
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+
+class EmbeddingStore(NamedTuple):
+    embeddings: np.ndarray
+    rows: pl.DataFrame
+
+
+def _new_rows(embeddings, rows):
+    patents = embeddings.select("patent_id").with_row_index("scan_row")
+
+    if rows is not None:
+        patents = patents.join(
+            rows.lazy().select("patent_id"), on="patent_id", how="anti"
+        )
+
+    return patents.select("scan_row").collect().get_column("scan_row").sort().to_numpy()
+
+
+def _write_rows(save_path, rows, keys_path):
+    # NOTE: shards only identify patents by patent_id, the keys of kept and
+    # new rows alike come from the current mapping and patents outside the
+    # cohort get none
+    rows = rows.select("row", "patent_id").join(
+        pl.read_parquet(keys_path), on="patent_id", how="left", maintain_order="left"
+    )
+
+    temp_rows = save_path / "rows.parquet.tmp"
+    rows.write_parquet(temp_rows)
+    temp_rows.replace(save_path / "rows.parquet")
+
+    return rows
+
+
+def make_store(
+    embeddings_path=Path("data", "processed", "embeddings"),
+    save_path=Path("data", "interim", "embedding_store"),
+    dtype="float32",
+    chunk_size=100_000,
+    keys_path=Path("data", "interim", "patent_keys.parquet"),
+):
+    save_path.mkdir(parents=True, exist_ok=True)
+
+    embeddings = pl.scan_parquet(embeddings_path)
+
+    dimension = (
+        embeddings.select(pl.col("embedding").first())
+        .collect()
+        .get_column("embedding")
+        .to_numpy()
+        .shape[1]
+    )
+
+    # NOTE: rows already in the store keep their offsets, patents embedded
+    # since then are appended after them in scan order
+    if (save_path / "embeddings.npy").exists():
+        store = open_store(save_path)
+        old_rows = store.rows
+
+        if store.embeddings.shape[1] != dimension or store.embeddings.dtype != dtype:
+            raise ValueError(
+                "embedding store has a different shape or dtype, remove "
+                f"{save_path} to rebuild it"
+            )
+    else:
+        store = None
+        old_rows = None
+
+    scan_rows = _new_rows(embeddings, old_rows)
+    n_old = 0 if old_rows is None else old_rows.height
+
+    if len(scan_rows) == 0:
+        _write_rows(save_path, old_rows, keys_path)
+        print(f"embedding store: {n_old} rows, nothing to add")
+        return
+
+    temp_path = save_path / "embeddings.npy.tmp"
+    matrix = np.lib.format.open_memmap(
+        temp_path, mode="w+", dtype=dtype, shape=(n_old + len(scan_rows), dimension)
+    )
+
+    for start in range(0, n_old, chunk_size):
+        matrix[start : start + chunk_size] = store.embeddings[
+            start : start + chunk_size
+        ]
+
+    new_rows = []
+
+    for start in range(0, len(scan_rows), chunk_size):
+        chunk_rows = scan_rows[start : start + chunk_size]
+
+        # NOTE: new patents mostly sit in a few contiguous runs of the scan
+        chunk = (
+            embeddings.with_row_index("scan_row")
+            .slice(int(chunk_rows[0]), int(chunk_rows[-1] - chunk_rows[0]) + 1)
+            .filter(pl.col("scan_row").is_in(chunk_rows))
+            .select(
+                "patent_id",
+                pl.col("embedding").cast(pl.Array(pl.Float32, dimension)),
+            )
+            .collect()
+        )
+
+        matrix[n_old + start : n_old + start + chunk.height] = chunk.get_column(
+            "embedding"
+        ).to_numpy()
+        new_rows.append(chunk.select("patent_id"))
+
+    matrix.flush()
+    del matrix
+    del store
+
+    rows = pl.concat(new_rows).with_row_index("row", offset=n_old)
+    if old_rows is not None:
+        rows = pl.concat([old_rows.select("row", "patent_id"), rows])
+
+    # NOTE: the matrix goes in first, a store whose matrix is longer than its
+    # rows is rebuilt from the first rows on the next run
+    temp_path.replace(save_path / "embeddings.npy")
+
+    rows = _write_rows(save_path, rows, keys_path)
+
+    (save_path / "metadata.json").write_text(
+        json.dumps(
+            {"rows": rows.height, "dimension": dimension, "dtype": dtype}, indent=2
+        )
+    )
+
+    print(
+        f"embedding store: {n_old} rows kept, {len(scan_rows)} added, "
+        f"{rows.height * dimension * np.dtype(dtype).itemsize / 1024**2:.1f} MB"
+    )
+
+
+def open_store(path=Path("data", "interim", "embedding_store")):
+    rows = pl.read_parquet(path / "rows.parquet")
+    embeddings = np.load(path / "embeddings.npy", mmap_mode="r")
+
+    return EmbeddingStore(embeddings=embeddings[: rows.height], rows=rows)
+
+
+def check_keys(store, keys_path=Path("data", "interim", "patent_keys.parquet")):
+    # NOTE: neighbours are joined back to patents through the store keys, so
+    # they must agree with the current key mapping
+    stale = store.rows.join(
+        pl.read_parquet(keys_path).rename({"patent_key": "current_key"}),
+        on="patent_id",
+    ).filter(pl.col("patent_key").ne_missing(pl.col("current_key")))
+
+    if not stale.is_empty():
+        raise ValueError(
+            f"{stale.height} embedding store rows have outdated patent keys, "
+            "run make_store to refresh them"
+        )
+
+
+def iter_chunks(store, chunk_size=100_000, rows=None):
+    # NOTE: views of the memory map, only the chunk being converted is in RAM
+    rows = np.arange(len(store.embeddings)) if rows is None else np.asarray(rows)
+
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start : start + chunk_size]
+
+        if len(chunk_rows) and chunk_rows[-1] - chunk_rows[0] == len(chunk_rows) - 1:
+            chunk = store.embeddings[chunk_rows[0] : chunk_rows[-1] + 1]
+        else:
+            chunk = store.embeddings[chunk_rows]
+
+        yield chunk_rows, np.ascontiguousarray(chunk, dtype=np.float32)
@@ -0,0 +1,410 @@
+import ast
+import hashlib
+import inspect
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from importlib.util import find_spec
+from pathlib import Path
+from typing import NamedTuple
+
+from lse_diss.utils.profiling import profile, summarise_runs
+from lse_diss.utils.validation import gate
+
+# NOTE: bump to rerun every stage, e.g. after changing how fingerprints work
+PIPELINE_VERSION = 2
+
+
+class Stage(NamedTuple):
+    name: str
+    run: object
+    deps: tuple = ()
+    inputs: tuple = ()
+    outputs: tuple = ()
+    parameters: tuple = ()
+    # NOTE: modules the stage depends on without importing them, the ones it
+    # imports are found by stage_modules
+    code: tuple = ()
+    # NOTE: datasets from utils.validation that must pass before the stage runs
+    checks: tuple = ()
+
+
+def _patents():
+    from lse_diss.features.patents import load_patents, save_patents, trim_abstracts
+
+    save_patents(trim_abstracts(load_patents()))
+
+
+def _citations():
+    from lse_diss.features.layout import relayout_tables
+    from lse_diss.features.patents import filter_citations
+
+    filter_citations()
+    relayout_tables()
+
+
+def _citation_graph():
+    from lse_diss.features.graph import make_graph
+
+    make_graph()
+
+
+def _controls(base_year, duration, search_range):
+    from lse_diss.features.controls import make_originating, make_treated, save_controls
+    from lse_diss.features.inventors import encode_inventors
+
+    graph_path = Path("data", "interim", "citation_graph")
+
+    patents = make_originating(base_year=base_year)
+    # NOTE: one encoding serves both the treated pairs and the control search
+    inventor_sets = encode_inventors(patents)
+    pairs = make_treated(
+        patents,
+        base_year=base_year,
+        duration=duration,
+        graph_path=graph_path,
+        inventor_sets=inventor_sets,
+    )
+
+    save_controls(
+        patents,
+        pairs,
+        base_year=base_year,
+        duration=duration,
+        search_range=search_range,
+        graph_path=graph_path,
+        inventor_sets=inventor_sets,
+    )
+
+
+def _abstracts():
+    from lse_diss.features.abstracts import filter_abstracts
+
+    filter_abstracts()
+
+
+def _embeddings():
+    from lse_diss.modelling.embeddings import make_embeddings
+
+    make_embeddings()
+
+
+def _matches():
+    from lse_diss.modelling.ann import create_index, match_controls
+    from lse_diss.modelling.store import make_store
+
+    make_store()
+    match_controls(create_index())
+
+
+def _locations():
+    from lse_diss.features.locations import make_locations
+
+    make_locations()
+
+
+def _distances():
+    from lse_diss.features.locations import make_distances
+
+    make_distances()
+
+
+def _classes():
+    from lse_diss.features.classes import filter_classes
+
+    filter_classes()
+
+
+raw_path = Path("data", "raw")
+interim_path = Path("data", "interim")
+processed_path = Path("data", "processed")
+bulk_path = raw_path / "bulk_downloads"
+
+STAGES = [
+    Stage(
+        "patents",
+        _patents,
+        inputs=(raw_path / "patents",),
+        outputs=(interim_path / "patents", interim_path / "patent_keys.parquet"),
+        checks=("raw_patents",),
+    ),
+    Stage(
+        "citations",
+        _citations,
+        deps=("patents",),
+        inputs=(bulk_path / "g_us_patent_citation.parquet",),
+        outputs=(interim_path / "citations.parquet",),
+        checks=("raw_citations",),
+    ),
+    Stage(
+        "citation_graph",
+        _citation_graph,
+        deps=("citations",),
+        outputs=(interim_path / "citation_graph",),
+    ),
+    Stage(
+        "controls",
+        _controls,
+        deps=("patents", "citation_graph"),
+        outputs=(interim_path / "controls",),
+        parameters=("base_year", "duration", "search_range"),
+        checks=("interim_patents",),
+    ),
+    Stage(
+        "abstracts",
+        _abstracts,
+        deps=("patents", "controls"),
+        outputs=(interim_path / "abstracts.parquet",),
+    ),
+    Stage(
+        "embeddings",
+        _embeddings,
+        deps=("abstracts",),
+        outputs=(processed_path / "embeddings",),
+    ),
+    Stage(
+        "matches",
+        _matches,
+        deps=("embeddings", "controls"),
+        outputs=(processed_path / "controls.parquet",),
+    ),
+    Stage(
+        "locations",
+        _locations,
+        deps=("patents",),
+        inputs=(raw_path / "patents", bulk_path / "g_location_disambiguated.parquet"),
+        outputs=(interim_path / "locations.parquet",),
+    ),
+    Stage(
+        "distances",
+        _distances,
+        deps=("matches", "locations"),
+        outputs=(processed_path / "distances.parquet",),
+    ),
+    Stage(
+        "classes",
+        _classes,
+        deps=("matches",),
+        inputs=(bulk_path / "g_cpc_current.parquet",),
+        outputs=(processed_path / "classes.parquet",),
+    ),
+]
+
+
+def _hash_file(path, file_hashes):
+    stat = path.stat()
+    cached = file_hashes.get(str(path))
+
+    # NOTE: files are only read again when their size or mtime changed
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while data := f.read(2**24):
+            digest.update(data)
+
+    file_hashes[str(path)] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+    return digest.hexdigest()
+
+
+def _hash_input(path, file_hashes):
+    if path.is_dir():
+        files = sorted(
+            file_path for file_path in path.rglob("*") if file_path.is_file()
+        )
+    else:
+        files = [path]
+
+    return {str(file_path): _hash_file(file_path, file_hashes) for file_path in files}
+
+
+def _imports(source):
+    # NOTE: every lse_diss import in the source, including those inside
+    # functions, which is how the stages import their modules
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.ImportFrom) and node.module:
+            names = [node.module]
+            # NOTE: from a package the names can be modules themselves
+            spec = find_spec(node.module)
+            if spec is not None and spec.submodule_search_locations is not None:
+                names += [f"{node.module}.{alias.name}" for alias in node.names]
+        elif isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        else:
+            continue
+
+        for name in names:
+            if name.split(".")[0] == "lse_diss" and find_spec(name) is not None:
+                yield name
+
+
+def stage_modules(stage):
+    modules = set()
+    queue = list(_imports(inspect.getsource(stage.run))) + list(stage.code)
+
+    # NOTE: follows the imports of each module, so a helper module changes the
+    # fingerprint of every stage that ends up running it
+    while queue:
+        module = queue.pop()
+        origin = find_spec(module).origin
+
+        if module in modules or origin is None or not origin.endswith(".py"):
+            continue
+
+        modules.add(module)
+        queue.extend(_imports(Path(origin).read_text()))
+
+    return sorted(modules)
+
+
+def fingerprint(stage, parameters, dep_fingerprints, file_hashes):
+    # NOTE: upstream stages enter through their fingerprints, so only inputs
+    # from outside the pipeline are hashed
+    code = {
+        module: _hash_file(Path(find_spec(module).origin), file_hashes)
+        for module in stage_modules(stage)
+    }
+
+    contents = {
+        "version": PIPELINE_VERSION,
+        "stage": stage.name,
+        "parameters": {name: parameters[name] for name in stage.parameters},
+        "code": code,
+        "inputs": {str(path): _hash_input(path, file_hashes) for path in stage.inputs},
+        "deps": {dep: dep_fingerprints[dep] for dep in stage.deps},
+    }
+
+    return hashlib.blake2b(
+        json.dumps(contents, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+
+def _run_stage(stage, kwargs, inputs, log_path):
+    if stage.checks:
+        gate(stage.checks)
+
+    with profile(
+        stage.name, inputs=inputs, outputs=stage.outputs, tags=kwargs, log_path=log_path
+    ):
+        stage.run(**kwargs)
+
+
+def _write_state(path, state):
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(state, indent=2))
+    temp_path.replace(path)
+
+
+def run_pipeline(
+    parameters=None,
+    stages=None,
+    state_path=Path("data", "interim", "pipeline_state.json"),
+    n_workers=2,
+    force=(),
+    log_path=Path("data", "interim", "run_log"),
+):
+    parameters = {"base_year": 2005, "duration": 3, "search_range": 30} | (
+        parameters or {}
+    )
+    stages = {stage.name: stage for stage in (stages or STAGES)}
+
+    unknown = [name for name in force if name not in stages]
+    if unknown:
+        raise ValueError(f"force must be in {list(stages)}, got {unknown!r}")
+
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    state = (
+        json.loads(state_path.read_text())
+        if state_path.exists()
+        else {"stages": {}, "file_hashes": {}}
+    )
+
+    fingerprints = {}
+    pending = dict(stages)
+    running = {}
+    summary = {}
+
+    # NOTE: a stage starts once all its dependencies are done, stages that do
+    # not depend on each other run side by side, with n_workers=1 every run
+    # log record is the cost of its stage alone
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while pending or running:
+            ready = [
+                stage
+                for stage in pending.values()
+                if all(dep in fingerprints for dep in stage.deps)
+            ]
+
+            for stage in ready:
+                del pending[stage.name]
+
+                current = fingerprint(
+                    stage, parameters, fingerprints, state["file_hashes"]
+                )
+                recorded = state["stages"].get(stage.name, {})
+
+                if (
+                    stage.name not in force
+                    and recorded.get("fingerprint") == current
+                    and all(path.exists() for path in stage.outputs)
+                ):
+                    fingerprints[stage.name] = current
+                    summary[stage.name] = "cached"
+                    continue
+
+                print(f"running {stage.name}")
+                kwargs = {name: parameters[name] for name in stage.parameters}
+                # NOTE: a stage reads its own inputs and its dependencies' outputs
+                inputs = stage.inputs + tuple(
+                    path for dep in stage.deps for path in stages[dep].outputs
+                )
+                future = executor.submit(_run_stage, stage, kwargs, inputs, log_path)
+                running[future] = (stage, current, time.perf_counter())
+
+            if not running:
+                if pending and not ready:
+                    raise ValueError(
+                        f"stages {list(pending)} depend on stages that are not "
+                        "in the pipeline"
+                    )
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, current, start_time = running.pop(future)
+
+                try:
+                    future.result()
+                except Exception:
+                    # NOTE: stages already started finish, nothing new starts
+                    pending.clear()
+                    _write_state(state_path, state)
+                    raise
+
+                seconds = time.perf_counter() - start_time
+                fingerprints[stage.name] = current
+                summary[stage.name] = f"ran in {seconds:.0f}s"
+
+                state["stages"][stage.name] = {
+                    "fingerprint": current,
+                    "parameters": {name: parameters[name] for name in stage.parameters},
+                    "seconds": seconds,
+                }
+                _write_state(state_path, state)
+
+    _write_state(state_path, state)
+
+    for name, outcome in summary.items():
+        print(f"{name}: {outcome}")
+
+    if (log_path / "runs.jsonl").exists():
+        summarise_runs(log_path)
+
+    return summary
+
+
+if __name__ == "__main__":
+    run_pipeline()
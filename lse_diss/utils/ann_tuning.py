@@ -0,0 +1,233 @@
+import json
+import time
+from itertools import product
+from math import ceil
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from voyager import Index, Space, StorageDataType
+
+from lse_diss.modelling.ann import count_neighbours
+from lse_diss.modelling.store import open_store
+
+
+def _normalise(embeddings):
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def sample_corpus(
+    store,
+    controls_path=Path("data", "interim", "controls"),
+    corpus_size=100_000,
+    n_queries=1_000,
+    seed=42,
+):
+    rng = np.random.default_rng(seed)
+    rows = store.rows.unique("patent_key", keep="first").select("patent_key", "row")
+
+    corpus_rows = np.sort(
+        rng.choice(
+            rows.get_column("row").to_numpy(),
+            min(corpus_size, rows.height),
+            replace=False,
+        )
+    )
+    corpus = rows.filter(pl.col("row").is_in(corpus_rows)).with_row_index("position")
+
+    # NOTE: control pairs with both patents in the corpus, so matched counts
+    # can be compared between the exact and the approximate neighbours
+    pairs = (
+        pl.scan_parquet(controls_path)
+        .select("citing_patent_key", "control_patent_key")
+        .unique()
+        .join(
+            corpus.lazy().select(
+                pl.col("patent_key").alias("citing_patent_key"),
+                pl.col("position").alias("citing_position"),
+            ),
+            on="citing_patent_key",
+        )
+        .join(
+            corpus.lazy().select(
+                pl.col("patent_key").alias("control_patent_key"),
+                pl.col("position").alias("control_position"),
+            ),
+            on="control_patent_key",
+        )
+        .collect()
+    )
+
+    citing = pairs.get_column("citing_position").unique().sort().to_numpy()
+    query_positions = np.sort(
+        rng.choice(citing, min(n_queries, len(citing)), replace=False)
+    )
+
+    if len(query_positions) < n_queries:
+        extra = np.setdiff1d(np.arange(corpus.height), query_positions)
+        query_positions = np.sort(
+            np.concatenate(
+                [
+                    query_positions,
+                    rng.choice(
+                        extra,
+                        min(n_queries - len(query_positions), len(extra)),
+                        replace=False,
+                    ),
+                ]
+            )
+        )
+
+    pairs = pairs.filter(pl.col("citing_position").is_in(query_positions))
+
+    embeddings = np.ascontiguousarray(store.embeddings[corpus_rows], dtype=np.float32)
+
+    return embeddings, query_positions, pairs
+
+
+def exact_neighbours(embeddings, query_positions, k, chunk_size=1_000):
+    corpus = _normalise(embeddings)
+    neighbours = np.empty((len(query_positions), k), dtype=np.int64)
+
+    for start in range(0, len(query_positions), chunk_size):
+        queries = corpus[query_positions[start : start + chunk_size]]
+        similarities = queries @ corpus.T
+
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1)
+        neighbours[start : start + chunk_size] = np.take_along_axis(top, order, axis=1)
+
+    return neighbours
+
+
+def _recall(truth, found):
+    return np.mean([len(np.intersect1d(a, b)) / len(a) for a, b in zip(truth, found)])
+
+
+def _matched(pairs, query_positions, neighbours):
+    neighbour_pairs = pl.DataFrame(
+        {
+            "citing_position": np.repeat(query_positions, neighbours.shape[1]).astype(
+                np.uint32
+            ),
+            "control_position": neighbours.ravel().astype(np.uint32),
+        }
+    )
+
+    return pairs.join(
+        neighbour_pairs, on=["citing_position", "control_position"], how="semi"
+    ).height
+
+
+def tune_index(
+    store_path=Path("data", "interim", "embedding_store"),
+    controls_path=Path("data", "interim", "controls"),
+    save_path=Path("data", "interim", "ann_tuning.json"),
+    corpus_size=100_000,
+    n_queries=1_000,
+    match_quality=1000,
+    n_neighbours=None,
+    ms=(12, 24, 48),
+    ef_constructions=(100, 200, 400),
+    query_efs=(1, 2, 4),
+    storage_data_types=("Float32", "Float8", "E4M3"),
+    seed=42,
+):
+    store = open_store(store_path)
+
+    embeddings, query_positions, pairs = sample_corpus(
+        store, controls_path, corpus_size, n_queries, seed
+    )
+
+    # NOTE: the k match_controls queries on the whole store, not a share of the
+    # sample, so recall is measured at the k that matters for matching
+    k = min(
+        count_neighbours(store, match_quality)
+        if n_neighbours is None
+        else n_neighbours,
+        len(embeddings) - 1,
+    )
+    queries = embeddings[query_positions]
+
+    start_time = time.perf_counter()
+    truth = exact_neighbours(embeddings, query_positions, k)
+    exact_time = time.perf_counter() - start_time
+
+    exact_matched = _matched(pairs, query_positions, truth)
+
+    print(
+        f"ground truth: {len(embeddings)} rows, {len(query_positions)} queries, "
+        f"k = {k}, {exact_matched} of {pairs.height} pairs matched"
+    )
+
+    results = []
+
+    for M, ef_construction, storage in product(
+        ms, ef_constructions, storage_data_types
+    ):
+        index = Index(
+            Space.Cosine,
+            num_dimensions=embeddings.shape[1],
+            M=M,
+            ef_construction=ef_construction,
+            random_seed=seed,
+            storage_data_type=getattr(StorageDataType, storage),
+        )
+
+        start_time = time.perf_counter()
+        index.add_items(embeddings)
+        build_time = time.perf_counter() - start_time
+
+        index_bytes = len(index.as_bytes())
+
+        # NOTE: query ef is given as a multiple of k, it can not be below k
+        for ef_multiple in query_efs:
+            query_ef = max(ceil(ef_multiple * k), k)
+
+            start_time = time.perf_counter()
+            neighbours, _ = index.query(queries, k, query_ef=query_ef)
+            query_time = time.perf_counter() - start_time
+
+            matched = _matched(pairs, query_positions, neighbours)
+
+            result = {
+                "M": M,
+                "ef_construction": ef_construction,
+                "storage_data_type": storage,
+                "query_ef": query_ef,
+                "k": k,
+                "recall": float(_recall(truth, neighbours)),
+                "build_seconds": build_time,
+                "queries_per_second": len(queries) / query_time,
+                "index_mb": index_bytes / 1024**2,
+                "matched_pairs": matched,
+                "exact_matched_pairs": exact_matched,
+                "matched_change": matched - exact_matched,
+            }
+            results.append(result)
+
+            print(
+                f"M={M} ef_construction={ef_construction} {storage} "
+                f"query_ef={query_ef}: recall@{k} {result['recall']:.3f}, "
+                f"{result['queries_per_second']:.0f} q/s, "
+                f"build {build_time:.1f}s, {result['index_mb']:.1f} MB, "
+                f"matched {matched - exact_matched:+d}"
+            )
+
+    report = {
+        "corpus_size": len(embeddings),
+        "n_queries": len(query_positions),
+        "k": k,
+        "exact_seconds": exact_time,
+        "control_pairs": pairs.height,
+        "results": results,
+    }
+
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    save_path.write_text(json.dumps(report, indent=2))
+
+    return pl.DataFrame(results)
+
+
+if __name__ == "__main__":
+    tune_index()
@@ -4,7 +4,9 @@ from pathlib import Path
 
 import polars as pl
 import psutil
-from sentence_transformers import SentenceTransformer
+
+from lse_diss.modelling.embeddings import cache_embeddings, load_model
+from lse_diss.utils.profiling import profile, summarise_runs
 
 
 def print_memory_usage():
@@ -19,9 +21,7 @@ print_memory_usage()
 
 size = 5000
 
-model = SentenceTransformer(
-    "nomic-ai/nomic-embed-text-v2-moe", trust_remote_code=True, truncate_dim=256
-)
+model = load_model()
 
 start_time = time.time()
 
@@ -33,10 +33,16 @@ patents = (
 
 abstracts = patents.get_column("patent_abstract").to_list()
 
-embeddings = model.encode(abstracts, prompt_name="passage", show_progress_bar=True)
+# NOTE: abstracts encoded by an earlier run come from the cache, delete
+# data/interim/embedding_cache to time the model alone
+with profile("encode_abstracts", tags={"size": size}) as record:
+    embeddings, n_encoded = cache_embeddings(model, abstracts)
+    record["rows_out"] = n_encoded
 
 finish_time = time.time()
 
 print_memory_usage()
 
 print("total time: ", finish_time - start_time)
+
+summarise_runs()
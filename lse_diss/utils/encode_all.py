@@ -5,41 +5,31 @@ import polars as pl
 from lse_diss.modelling.embeddings import make_embeddings
 
 
-def encode_all():
+def encode_all(n_workers=1):
     patents_path = Path("data", "interim", "patents")
     abstracts_path = Path("data", "misc", "abstracts")
     embeddings_path = Path("data", "misc", "embeddings")
 
     patents = (
-        pl.scan_parquet(patents_path).select(["patent_id", "patent_abstract"]).unique()
+        pl.scan_parquet(patents_path)
+        .select(["patent_key", "patent_id", "patent_abstract"])
+        .unique("patent_key")
+        .sort("patent_key")
     )
 
-    if embeddings_path.exists():
-        print("rewriting abstracts")
-        [file_path.unlink() for file_path in abstracts_path.glob("*")]
+    # NOTE: all abstracts are written every time, make_embeddings skips the
+    # patent_ids that already have an embedding
+    print("writing abstracts")
+    abstracts_path.mkdir(parents=True, exist_ok=True)
+    [file_path.unlink() for file_path in abstracts_path.glob("*")]
 
-        embeddings = pl.scan_parquet(embeddings_path).select("patent_id")
-        patents.join(embeddings, on="patent_id", how="anti").sink_parquet(
-            pl.PartitionMaxSize(
-                abstracts_path / "abstract_{part}.parquet", max_size=512_000
-            )
-        )
-    else:
-        print("filtering abstracts")
-        abstracts_path.mkdir(parents=True, exist_ok=True)
-
-        (
-            pl.scan_parquet(Path("data", "interim", "patents"))
-            .select("patent_id", "patent_abstract")
-            .unique()
-            .sink_parquet(
-                pl.PartitionMaxSize(
-                    abstracts_path / "abstract_{part}.parquet", max_size=512_000
-                )
-            )
+    patents.sink_parquet(
+        pl.PartitionMaxSize(
+            abstracts_path / "abstract_{part}.parquet", max_size=512_000
         )
+    )
 
-    make_embeddings(abstracts_path, embeddings_path)
+    make_embeddings(abstracts_path, embeddings_path, n_workers=n_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,337 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import UTC, datetime
+from functools import wraps
+from pathlib import Path
+
+import polars as pl
+import psutil
+
+# NOTE: one id per python process, so records of a single run can be grouped
+RUN_ID = f"{datetime.now(UTC):%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:8]}"
+
+_active = ContextVar("active_profile", default=None)
+_log_lock = threading.Lock()
+_running_lock = threading.Lock()
+_running = {}
+_hooks_lock = threading.Lock()
+_hooks = {}
+_hook_users = [0]
+
+
+def _count_rows(path):
+    path = Path(path)
+
+    if path.is_dir():
+        files = sorted(path.rglob("*.parquet"))
+    elif path.suffix == ".parquet" and path.exists():
+        files = [path]
+    else:
+        files = []
+
+    if not files:
+        return None
+
+    # NOTE: counts come from the parquet metadata, no data is read
+    return pl.scan_parquet(files).select(pl.len()).collect().item()
+
+
+def _size(path):
+    path = Path(path)
+
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+    return path.stat().st_size if path.exists() else None
+
+
+def _total(values):
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+def _install_hooks():
+    # NOTE: collect and sink_parquet record their optimised plan while a
+    # profile capturing plans is open, calls outside one are untouched. The
+    # hooks are shared by nested and concurrent profiles, the last to close
+    # puts the original methods back
+    with _hooks_lock:
+        _hook_users[0] += 1
+        if _hooks:
+            return
+
+        for name in ["collect", "sink_parquet"]:
+            method = getattr(pl.LazyFrame, name)
+            _hooks[name] = method
+
+            def hooked(self, *args, _method=method, _name=name, **kwargs):
+                record = _active.get()
+
+                if record is not None:
+                    try:
+                        plan = self.explain(optimized=True)
+                    except pl.exceptions.PolarsError as e:
+                        plan = f"plan not available: {e!r}"
+
+                    record["plans"].append({"call": _name, "plan": plan})
+
+                return _method(self, *args, **kwargs)
+
+            setattr(pl.LazyFrame, name, wraps(method)(hooked))
+
+
+def _remove_hooks():
+    with _hooks_lock:
+        _hook_users[0] -= 1
+        if _hook_users[0]:
+            return
+
+        for name, method in _hooks.items():
+            setattr(pl.LazyFrame, name, method)
+        _hooks.clear()
+
+
+def _sample_memory(process, peak, stop, interval):
+    while not stop.wait(interval):
+        try:
+            rss = process.memory_info().rss + sum(
+                child.memory_info().rss for child in process.children(recursive=True)
+            )
+        except psutil.Error:
+            continue
+
+        peak[0] = max(peak[0], rss)
+
+
+def _write_record(log_path, record):
+    log_path.mkdir(parents=True, exist_ok=True)
+
+    with _log_lock, open(log_path / "runs.jsonl", "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextmanager
+def profile(
+    name,
+    inputs=(),
+    outputs=(),
+    tags=None,
+    log_path=Path("data", "interim", "run_log"),
+    capture_plans=True,
+    interval=0.05,
+    run_id=None,
+):
+    process = psutil.Process(os.getpid())
+
+    record = {
+        "run_id": run_id or RUN_ID,
+        "stage": name,
+        "started": datetime.now(UTC).isoformat(),
+        "tags": json.dumps(tags or {}, sort_keys=True, default=str),
+        "rows_in": _total(_count_rows(path) for path in inputs),
+        "bytes_in": _total(_size(path) for path in inputs),
+        "plans": [],
+    }
+
+    # NOTE: peak RSS is sampled in the background and includes child
+    # processes, the workers of the process pools count towards their stage.
+    # RSS at the start is kept, memory left by earlier work is not the stage's
+    start_rss = process.memory_info().rss
+    peak = [start_rss]
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=_sample_memory, args=(process, peak, stop, interval), daemon=True
+    )
+
+    # NOTE: io counters are missing on macOS, bytes read and written are None
+    counters = getattr(process, "io_counters", lambda: None)
+
+    cpu_start = process.cpu_times()
+    io_start = counters()
+    wall_start = time.perf_counter()
+
+    # NOTE: memory, cpu and io are sampled for the whole process, profiles
+    # running at the same time in other threads share them, so each record
+    # lists the stages it overlapped with and only exclusive records are
+    # costs of a single stage
+    thread = threading.get_ident()
+    overlapped_by = set()
+    with _running_lock:
+        for other_thread, other_name, other_overlaps in _running.values():
+            if other_thread != thread:
+                other_overlaps.add(name)
+                overlapped_by.add(other_name)
+        _running[id(record)] = (thread, name, overlapped_by)
+
+    if capture_plans:
+        _install_hooks()
+
+    token = _active.set(record if capture_plans else None)
+    sampler.start()
+
+    try:
+        yield record
+        record["status"] = "ok"
+    except BaseException as e:
+        record["status"] = f"error: {e!r}"
+        raise
+    finally:
+        wall = time.perf_counter() - wall_start
+        stop.set()
+        sampler.join()
+        _active.reset(token)
+
+        if capture_plans:
+            _remove_hooks()
+
+        cpu_end = process.cpu_times()
+        io_end = counters()
+
+        with _running_lock:
+            del _running[id(record)]
+
+        record.update(
+            {
+                "wall_seconds": wall,
+                "cpu_seconds": sum(cpu_end[:4]) - sum(cpu_start[:4]),
+                "peak_rss_mb": peak[0] / 1024**2,
+                "start_rss_mb": start_rss / 1024**2,
+                "peak_rss_delta_mb": (peak[0] - start_rss) / 1024**2,
+                "read_mb": (io_end.read_chars - io_start.read_chars) / 1024**2
+                if io_end is not None
+                else None,
+                "written_mb": (io_end.write_chars - io_start.write_chars) / 1024**2
+                if io_end is not None
+                else None,
+                "rows_out": record.get("rows_out")
+                or _total(_count_rows(path) for path in outputs),
+                "bytes_out": _total(_size(path) for path in outputs),
+                "overlapped_by": sorted(overlapped_by),
+                "exclusive": not overlapped_by,
+            }
+        )
+
+        _write_record(log_path, record)
+
+
+def profiled(name=None, inputs=(), outputs=(), **kwargs):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **function_kwargs):
+            with profile(
+                name or function.__name__, inputs, outputs, **kwargs
+            ) as record:
+                result = function(*args, **function_kwargs)
+
+                # NOTE: a lazy result is only planned, not run, to keep the
+                # function's cost unchanged
+                if isinstance(result, pl.DataFrame):
+                    record["rows_out"] = result.height
+                elif isinstance(result, pl.LazyFrame):
+                    record["plans"].append(
+                        {"call": "return", "plan": result.explain(optimized=True)}
+                    )
+
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def summarise_runs(log_path=Path("data", "interim", "run_log"), run_ids=None):
+    runs = pl.read_ndjson(log_path / "runs.jsonl", infer_schema_length=None)
+
+    if run_ids is not None:
+        runs = runs.filter(pl.col("run_id").is_in(run_ids))
+
+    # NOTE: logs written before overlaps were recorded have neither column,
+    # and logs without any overlap infer overlapped_by as a list of nulls
+    for column, dtype in [
+        ("exclusive", pl.Boolean),
+        ("overlapped_by", pl.List(pl.String)),
+    ]:
+        if column not in runs.columns:
+            runs = runs.with_columns(pl.lit(None, dtype).alias(column))
+        else:
+            runs = runs.with_columns(pl.col(column).cast(dtype))
+
+    summary = runs.select(
+        "run_id",
+        "stage",
+        "started",
+        "status",
+        "wall_seconds",
+        "cpu_seconds",
+        "peak_rss_mb",
+        "read_mb",
+        "written_mb",
+        "rows_in",
+        "rows_out",
+        "bytes_in",
+        "bytes_out",
+        pl.col("exclusive").fill_null(True),
+        pl.col("overlapped_by").fill_null([]).list.join(","),
+        pl.col("plans").list.len().alias("n_plans"),
+        "tags",
+    ).sort("started")
+
+    temp_path = log_path / "runs.parquet.tmp"
+    summary.write_parquet(temp_path)
+    temp_path.replace(log_path / "runs.parquet")
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        print(
+            summary.select(
+                "run_id",
+                "stage",
+                "status",
+                pl.col("wall_seconds", "cpu_seconds", "peak_rss_mb").round(1),
+                "rows_in",
+                "rows_out",
+                "exclusive",
+            )
+        )
+
+    shared = summary.filter(~pl.col("exclusive")).height
+    if shared:
+        print(
+            f"{shared} records overlapped with other stages, their cpu, memory "
+            "and io are shared and not per stage costs"
+        )
+
+    return summary
+
+
+def compare_runs(baseline, candidate, log_path=Path("data", "interim", "run_log")):
+    runs = pl.read_parquet(log_path / "runs.parquet")
+
+    def stage_totals(run_id):
+        return (
+            runs.filter(pl.col("run_id") == run_id)
+            .group_by("stage")
+            .agg(pl.col("wall_seconds", "cpu_seconds", "peak_rss_mb").max())
+        )
+
+    # NOTE: records that overlapped other stages carry their costs too, only
+    # exclusive records are compared
+    runs = runs.filter(pl.col("exclusive"))
+
+    # NOTE: ratios above one are regressions of the candidate run
+    comparison = stage_totals(baseline).join(
+        stage_totals(candidate), on="stage", suffix="_candidate"
+    )
+
+    return comparison.with_columns(
+        (pl.col(f"{column}_candidate") / pl.col(column)).alias(f"{column}_ratio")
+        for column in ["wall_seconds", "cpu_seconds", "peak_rss_mb"]
+    ).sort("wall_seconds_ratio", descending=True)
+
+
+if __name__ == "__main__":
+    summarise_runs()
@@ -0,0 +1,142 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import polars as pl
+
+from lse_diss.pipeline import STAGES
+from lse_diss.utils.profiling import RUN_ID, profile
+from lse_diss.utils.synthetic import make_synthetic, make_synthetic_embeddings
+
+
+def _embeddings():
+    make_synthetic_embeddings()
+
+
+def _run_stage(stage, kwargs, n_patents, root, log_path, run_id):
+    # NOTE: stages read and write relative to the working directory, so each
+    # size runs inside its own synthetic tree
+    os.chdir(root)
+
+    with profile(
+        stage.name,
+        outputs=stage.outputs,
+        tags={"n_patents": n_patents, **kwargs},
+        log_path=log_path,
+        capture_plans=False,
+        run_id=run_id,
+    ):
+        stage.run(**kwargs)
+
+
+def scaling_exponents(runs):
+    # NOTE: slope of log time and log memory against log N, one is linear.
+    # Stages that grow memory by less than the sampler sees have a delta of
+    # zero, those sizes are left out of the fit
+    def slope(column):
+        positive = pl.col(column) > 0
+        n_patents = pl.col("n_patents").filter(positive).log()
+
+        return (
+            pl.cov(pl.col(column).filter(positive).log(), n_patents) / n_patents.var()
+        ).alias(f"{column}_exponent")
+
+    return (
+        runs.filter(pl.col("status") == "ok")
+        .group_by("stage", maintain_order=True)
+        .agg(
+            pl.col("n_patents").n_unique().alias("sizes"),
+            slope("wall_seconds"),
+            slope("peak_rss_delta_mb"),
+        )
+        .filter(pl.col("sizes") > 1)
+    )
+
+
+def run_scaling(
+    sizes=(10_000, 100_000, 1_000_000),
+    parameters=None,
+    stages=None,
+    data_path=Path("data", "synthetic"),
+    save_path=Path("data", "processed", "scaling"),
+    seed=42,
+):
+    parameters = {"base_year": 2005, "duration": 3, "search_range": 30} | (
+        parameters or {}
+    )
+    stages = [
+        stage._replace(run=_embeddings) if stage.name == "embeddings" else stage
+        for stage in STAGES
+        if stages is None or stage.name in stages
+    ]
+
+    data_path = data_path.resolve()
+    log_path = save_path.resolve() / "run_log"
+
+    for n_patents in sizes:
+        root = data_path / f"n{n_patents}"
+        metadata_path = root / "synthetic.json"
+
+        # NOTE: generated once per size and seed, later runs reuse the tree
+        if (
+            not metadata_path.exists()
+            or json.loads(metadata_path.read_text())["seed"] != seed
+        ):
+            make_synthetic(n_patents, root, seed=seed)
+
+        # NOTE: each stage runs in a fresh process, one at a time in
+        # dependency order, so its peak memory holds nothing of earlier stages
+        # or sizes, and the delta over its start RSS drops the imports
+        for stage in stages:
+            print(f"n = {n_patents}: running {stage.name}")
+            kwargs = {name: parameters[name] for name in stage.parameters}
+
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                pool.submit(
+                    _run_stage, stage, kwargs, n_patents, root, log_path, RUN_ID
+                ).result()
+
+    runs = (
+        pl.read_ndjson(log_path / "runs.jsonl", infer_schema_length=None)
+        .filter(pl.col("run_id") == RUN_ID)
+        .with_columns(
+            n_patents=pl.col("tags").str.json_path_match("$.n_patents").cast(pl.Int64)
+        )
+        .select(
+            "stage",
+            "n_patents",
+            "status",
+            "wall_seconds",
+            "cpu_seconds",
+            "peak_rss_mb",
+            "peak_rss_delta_mb",
+            "rows_out",
+            "bytes_out",
+        )
+    )
+
+    exponents = scaling_exponents(runs)
+
+    for name, table in [("runs", runs), ("exponents", exponents)]:
+        temp_path = save_path / f"scaling_{name}.tmp"
+        table.write_parquet(temp_path)
+        temp_path.replace(save_path / f"scaling_{name}.parquet")
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        print(
+            runs.pivot(
+                "n_patents",
+                index="stage",
+                values=["wall_seconds", "peak_rss_delta_mb"],
+                maintain_order=True,
+            ).with_columns(pl.selectors.float().round(1))
+        )
+        print(exponents.with_columns(pl.selectors.float().round(2)))
+
+    return runs, exponents
+
+
+if __name__ == "__main__":
+    run_scaling()
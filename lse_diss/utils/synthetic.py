@@ -0,0 +1,491 @@
+import json
+import shutil
+from datetime import date
+from itertools import pairwise
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from lse_diss.data.schemas import get_schema
+
+# NOTE: rough shares of US utility grants by primary CPC section
+SECTIONS = ["A", "B", "C", "D", "E", "F", "G", "H", "Y"]
+SECTION_SHARES = [0.12, 0.13, 0.08, 0.01, 0.02, 0.06, 0.30, 0.25, 0.03]
+
+# NOTE: the spellings filter_citations keeps, plus one category it drops
+CATEGORIES = ["cited by applicant", "cite by examiner", "cited by other", "other"]
+CATEGORY_SHARES = [0.55, 0.35, 0.08, 0.02]
+
+SYLLABLES = [
+    "al", "an", "ar", "be", "ca", "co", "de", "di", "el", "en", "er", "fa",
+    "ga", "in", "is", "ka", "la", "li", "ma", "me", "mi", "na", "ne", "no",
+    "or", "pa", "pe", "po", "ra", "re", "ri", "ro", "sa", "se", "si", "ta",
+    "te", "ti", "to", "tra", "un", "va", "ve", "vi", "xo", "ze",
+]  # fmt: skip
+
+FIRST_GRANT = date(2005, 1, 4)
+VOCAB_SIZE = 20_000
+N_TOPICS = 200
+TOPIC_WORDS = 300
+
+
+def make_vocabulary(seed=42):
+    rng = np.random.default_rng(seed)
+    syllables = np.array(SYLLABLES)
+
+    # NOTE: pseudo words of two to four syllables, deduplicated in order
+    words = []
+    seen = set()
+    while len(words) < VOCAB_SIZE:
+        length = rng.integers(2, 5)
+        word = "".join(rng.choice(syllables, length))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+
+    topics = rng.integers(0, VOCAB_SIZE, (N_TOPICS, TOPIC_WORDS))
+
+    return pl.Series("word", words), topics
+
+
+def _patent_frame(n_patents, rng):
+    # NOTE: grants happen on Tuesdays, ids rise with the grant date and skip
+    # numbers that belong to patents outside the cohort
+    n_weeks = (date(2025, 1, 1) - FIRST_GRANT).days // 7
+    grant_day = (
+        np.sort(rng.integers(0, n_weeks, n_patents)) * 7
+        + (FIRST_GRANT - date(1970, 1, 1)).days
+    )
+    number = 6_850_000 + np.cumsum(1 + (rng.random(n_patents) < 0.6))
+
+    lag = np.maximum(rng.lognormal(np.log(850), 0.45, n_patents), 180).astype(np.int64)
+
+    topic = rng.integers(0, N_TOPICS, n_patents)
+    topic_section = rng.choice(len(SECTIONS), N_TOPICS, p=SECTION_SHARES)
+
+    return {
+        "number": number,
+        "grant_day": grant_day,
+        "application_day": grant_day - lag,
+        "topic": topic,
+        "section": topic_section[topic],
+    }
+
+
+def _locations(n_patents, rng):
+    n_locations = max(n_patents // 100, 2_000)
+    n_cities = 100
+
+    # NOTE: locations cluster around a heavy tailed set of cities
+    city_lat = rng.uniform(26, 48, n_cities)
+    city_lon = rng.uniform(-123, -70, n_cities)
+    city_weight = 1 / np.arange(1, n_cities + 1)
+    city = rng.choice(n_cities, n_locations, p=city_weight / city_weight.sum())
+
+    locations = pl.DataFrame(
+        {
+            "location_id": rng.integers(0, 2**63, n_locations),
+            "city": city,
+            "latitude": city_lat[city] + rng.normal(0, 0.3, n_locations),
+            "longitude": city_lon[city] + rng.normal(0, 0.3, n_locations),
+        }
+    ).select(
+        location_id=pl.col("location_id").cast(pl.String).str.zfill(32),
+        disambig_city=pl.format("City {}", "city"),
+        disambig_state=pl.format(
+            "S{}", (pl.col("city") % 50).cast(pl.String).str.zfill(2)
+        ),
+        disambig_country=pl.lit("US"),
+        latitude="latitude",
+        longitude="longitude",
+        county=pl.format("County {}", "city"),
+        state_fips=(pl.col("city") % 50 + 1).cast(pl.String).str.zfill(2),
+        county_fips=pl.col("city").cast(pl.String).str.zfill(5),
+    )
+
+    columns = get_schema("g_location_disambiguated").columns
+    locations = locations.select(list(columns)).cast(columns)
+
+    return locations, city_weight[city] / city_weight[city].sum()
+
+
+def _citations(patents, start, stop, n_patents, fitness, rng, mean_citations=15):
+    citing = np.arange(start, stop)
+    degree = rng.negative_binomial(2, 2 / (2 + mean_citations), len(citing))
+    citing = np.repeat(citing, degree)
+
+    # NOTE: most citations go back an exponentially distributed time, the
+    # rest follow a heavy tailed fitness so a few patents collect many cites
+    per_day = n_patents / max(patents["grant_day"][-1] - patents["grant_day"][0], 1)
+    cited = citing - 1 - rng.exponential(2_900 * per_day, len(citing)).astype(np.int64)
+
+    hub = rng.random(len(citing)) < 0.3
+    hub_cited = np.searchsorted(fitness, rng.random(hub.sum()))
+    earlier = hub_cited < citing[hub]
+    cited[np.flatnonzero(hub)[earlier]] = hub_cited[earlier]
+
+    edges = (
+        pl.DataFrame({"citing": citing, "cited": cited})
+        .unique(maintain_order=True)
+        .filter(pl.col("citing") != pl.col("cited"))
+    )
+    citing = edges.get_column("citing").to_numpy()
+    cited = edges.get_column("cited").to_numpy()
+
+    inside = cited >= 0
+    numbers = patents["number"]
+    days = patents["grant_day"]
+
+    # NOTE: citations before the cohort point at older patent numbers, a few
+    # at design patents, neither of which is in the cohort
+    design = rng.random(len(cited)) < 0.02
+
+    frame = pl.DataFrame(
+        {
+            "patent_id": numbers[citing],
+            "cited_number": np.where(
+                inside, numbers[np.maximum(cited, 0)], numbers[0] - 1 + cited
+            ),
+            "design": design,
+            "cited_day": np.where(
+                inside,
+                days[np.maximum(cited, 0)],
+                days[0] + (cited / per_day).astype(np.int64),
+            ).astype(np.int32),
+            "wipo_kind": rng.choice(3, len(cited), p=[0.7, 0.2, 0.1]),
+            "citation_category": rng.choice(
+                len(CATEGORIES), len(cited), p=CATEGORY_SHARES
+            ),
+        }
+    ).select(
+        pl.col("patent_id").cast(pl.String),
+        citation_sequence=pl.int_range(pl.len()).over("patent_id"),
+        citation_patent_id=pl.when("design")
+        .then(pl.format("D{}", "cited_number"))
+        .otherwise(pl.col("cited_number").cast(pl.String)),
+        citation_date=pl.col("cited_day").cast(pl.Date).cast(pl.String),
+        record_name=pl.lit(""),
+        wipo_kind=pl.lit(pl.Series(["B2", "B1", "A"])).gather("wipo_kind"),
+        citation_category=pl.lit(pl.Series(CATEGORIES)).gather("citation_category"),
+    )
+
+    columns = get_schema("g_us_patent_citation").columns
+
+    return frame.select(list(columns)).cast(columns), cited[inside & ~design]
+
+
+def _abstracts(topics, words, topic_words, rng):
+    lengths = np.clip(rng.normal(115, 35, len(topics)), 20, 300).astype(np.int64)
+    owner = np.repeat(np.arange(len(topics)), lengths)
+
+    # NOTE: words come from the patent's topic or from a zipf general pool,
+    # so abstracts in the same topic share vocabulary
+    from_topic = rng.random(len(owner)) < 0.6
+    index = (rng.zipf(1.3, len(owner)) - 1) % VOCAB_SIZE
+    index[from_topic] = topic_words[
+        topics[owner[from_topic]], rng.integers(0, TOPIC_WORDS, from_topic.sum())
+    ]
+
+    text = (
+        pl.DataFrame({"owner": owner, "word": words.gather(index)})
+        .group_by("owner", maintain_order=True)
+        .agg(pl.col("word").str.join(" "))
+        .get_column("word")
+    )
+
+    return text.str.slice(0, 1).str.to_uppercase() + text.str.slice(1) + "."
+
+
+def _cpc(patents, start, stop, rng):
+    n = stop - start
+    counts = 1 + rng.poisson(1.8, n)
+    owner = np.repeat(np.arange(start, stop), counts)
+    sequence = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    primary = patents["section"][owner]
+    other = rng.choice(len(SECTIONS), len(owner), p=SECTION_SHARES)
+    section = np.where((sequence == 0) | (rng.random(len(owner)) < 0.7), primary, other)
+    topic = patents["topic"][owner]
+
+    frame = (
+        pl.DataFrame(
+            {
+                "patent_id": patents["number"][owner],
+                "cpc_sequence": sequence,
+                "section": section,
+                "topic": topic,
+                "additional": (sequence > 0) & (rng.random(len(owner)) < 0.5),
+            }
+        )
+        .select(
+            pl.col("patent_id").cast(pl.String),
+            "cpc_sequence",
+            cpc_section=pl.lit(pl.Series(SECTIONS)).gather("section"),
+            cpc_class=pl.format(
+                "{}{}",
+                pl.lit(pl.Series(SECTIONS)).gather("section"),
+                (pl.col("topic") % 90 + 1).cast(pl.String).str.zfill(2),
+            ),
+            subclass=pl.lit(pl.Series(list("ABCDFGHJ"))).gather(pl.col("topic") % 8),
+            cpc_group=pl.format("{}/00", pl.col("cpc_sequence") + 1),
+            cpc_type=pl.when("additional")
+            .then(pl.lit("additional"))
+            .otherwise(pl.lit("inventional")),
+        )
+        .with_columns(
+            cpc_subclass=pl.format("{}{}", "cpc_class", "subclass"),
+        )
+        .with_columns(
+            cpc_group=pl.format("{}{}", "cpc_subclass", "cpc_group"),
+        )
+    )
+
+    columns = get_schema("g_cpc_current").columns
+
+    return frame.select(list(columns)).cast(columns)
+
+
+def _inventor_rows(patents, start, stop, assignee, n_inventors, rng):
+    n = stop - start
+
+    # NOTE: about 2.5 inventors per patent with a long tail, drawn mostly from
+    # a team tied to the assignee so inventors recur across patents
+    counts = np.minimum(1 + rng.negative_binomial(1.2, 0.45, n), 30)
+    owner = np.repeat(np.arange(start, stop), counts)
+    team = assignee[owner].astype(np.int64) * 37
+    inventor = (team + rng.zipf(1.6, len(owner))) % n_inventors
+
+    rows = (
+        pl.DataFrame({"owner": owner, "inventor": inventor})
+        .unique(maintain_order=True)
+        .with_columns(
+            inventor_sequence=pl.int_range(pl.len()).over("owner").cast(pl.Int32)
+        )
+    )
+
+    return rows
+
+
+def make_synthetic(
+    n_patents,
+    save_path=None,
+    seed=42,
+    chunk_size=100_000,
+    mean_citations=15,
+):
+    save_path = save_path or Path("data", "synthetic", f"n{n_patents}")
+    rng = np.random.default_rng(seed)
+
+    raw_path = save_path / "data" / "raw"
+    patents_path = raw_path / "patents"
+    bulk_path = raw_path / "bulk_downloads"
+
+    if patents_path.exists():
+        shutil.rmtree(patents_path)
+    patents_path.mkdir(parents=True)
+    bulk_path.mkdir(parents=True, exist_ok=True)
+
+    words, topic_words = make_vocabulary(seed)
+    patents = _patent_frame(n_patents, rng)
+
+    locations, location_weight = _locations(n_patents, rng)
+    locations.write_parquet(bulk_path / "g_location_disambiguated.parquet")
+    location_ids = locations.get_column("location_id")
+
+    n_assignees = max(n_patents // 20, 10)
+    assignee_weight = 1 / np.arange(1, n_assignees + 1) ** 0.9
+    assignee = rng.choice(
+        n_assignees, n_patents, p=assignee_weight / assignee_weight.sum()
+    )
+    assignee_location = rng.choice(len(location_ids), n_assignees, p=location_weight)
+
+    n_inventors = max(int(n_patents * 0.7), 100)
+    inventor_location = rng.choice(len(location_ids), n_inventors, p=location_weight)
+    inventor_country = pl.Series(["US", "CA", "GB", "DE", "JP"]).gather(
+        rng.choice(5, n_inventors, p=[0.93, 0.02, 0.02, 0.015, 0.015])
+    )
+
+    fitness = np.cumsum(rng.pareto(1.5, n_patents) + 1)
+    fitness /= fitness[-1]
+
+    times_cited = np.zeros(n_patents, dtype=np.int64)
+    parts_path = bulk_path / "parts"
+    parts_path.mkdir(exist_ok=True)
+
+    for i, start in enumerate(range(0, n_patents, chunk_size)):
+        stop = min(start + chunk_size, n_patents)
+
+        citations, cited = _citations(
+            patents, start, stop, n_patents, fitness, rng, mean_citations
+        )
+        times_cited += np.bincount(cited, minlength=n_patents)
+        citations.write_parquet(parts_path / f"citations_{i}.parquet")
+
+        _cpc(patents, start, stop, rng).write_parquet(parts_path / f"cpc_{i}.parquet")
+
+    # NOTE: parts are streamed into the single files the pipeline reads
+    for name, prefix in [
+        ("g_us_patent_citation", "citations"),
+        ("g_cpc_current", "cpc"),
+    ]:
+        pl.scan_parquet(parts_path / f"{prefix}_*.parquet").sink_parquet(
+            bulk_path / f"{name}.parquet"
+        )
+    shutil.rmtree(parts_path)
+
+    # NOTE: one file per two year window like make_data, in parts of chunk_size
+    windows = (
+        pl.Series(patents["grant_day"]).cast(pl.Date).dt.year().to_numpy() - 2005
+    ) // 2
+
+    for start in range(0, n_patents, chunk_size):
+        stop = min(start + chunk_size, n_patents)
+        rows = _inventor_rows(patents, start, stop, assignee, n_inventors, rng)
+
+        owner = rows.get_column("owner").to_numpy()
+        inventor = rows.get_column("inventor").to_numpy()
+        abstracts = _abstracts(patents["topic"][start:stop], words, topic_words, rng)
+
+        # NOTE: a few missing values, load_patents drops those patents
+        frame = pl.DataFrame(
+            {
+                "patent_id": patents["number"][owner],
+                "grant_day": patents["grant_day"][owner].astype(np.int32),
+                "application_day": patents["application_day"][owner].astype(np.int32),
+                "patent_abstract": abstracts.gather(owner - start),
+                "patent_num_times_cited_by_us_patents": times_cited[owner].astype(
+                    np.int32
+                ),
+                "inventor": inventor,
+                "inventor_location_id": location_ids.gather(
+                    inventor_location[inventor]
+                ),
+                "inventor_sequence": rows.get_column("inventor_sequence"),
+                "inventor_country": inventor_country.gather(inventor),
+                "assignee": assignee[owner],
+                "missing": rng.random(len(owner)) < 0.002,
+                "assignee_location_id": location_ids.gather(
+                    assignee_location[assignee[owner]]
+                ),
+                "window": windows[owner],
+            }
+        ).select(
+            pl.col("patent_id").cast(pl.String),
+            patent_date=pl.col("grant_day").cast(pl.Date).cast(pl.String),
+            patent_abstract="patent_abstract",
+            patent_earliest_application_date=pl.col("application_day")
+            .cast(pl.Date)
+            .cast(pl.String),
+            patent_num_times_cited_by_us_patents="patent_num_times_cited_by_us_patents",
+            inventor_id=pl.format("fl:{}", "inventor"),
+            inventor_location_id="inventor_location_id",
+            inventor_sequence="inventor_sequence",
+            inventor_country="inventor_country",
+            assignee_id=pl.format("as:{}", "assignee"),
+            assignee_organization=pl.when(~pl.col("missing")).then(
+                pl.format("Assignee {}", "assignee")
+            ),
+            assignee_location_id="assignee_location_id",
+            window="window",
+        )
+
+        for (window,), part in frame.partition_by("window", as_dict=True).items():
+            first = date(2005 + 2 * window, 1, 1)
+            last = date(2006 + 2 * window, 12, 31)
+            part.drop("window").write_parquet(
+                patents_path / f"{first}_to_{last}_{start // chunk_size}.parquet"
+            )
+
+    (save_path / "synthetic.json").write_text(
+        json.dumps(
+            {"n_patents": n_patents, "seed": seed, "mean_citations": mean_citations},
+            indent=2,
+        )
+    )
+
+    print(
+        f"synthetic data: {n_patents} patents, "
+        f"{pl.scan_parquet(bulk_path / 'g_us_patent_citation.parquet').select(pl.len()).collect().item()} "
+        f"citations in {save_path}"
+    )
+
+    return save_path
+
+
+def make_synthetic_embeddings(
+    abstracts_path=Path("data", "interim", "abstracts.parquet"),
+    save_path=Path("data", "processed", "embeddings"),
+    dimension=256,
+    seed=42,
+    chunk_size=50_000,
+    block_size=2_000,
+):
+    # NOTE: stands in for the sentence model offline, an abstract is the mean
+    # of fixed random word vectors so abstracts sharing words end up close
+    words, _ = make_vocabulary(seed)
+    vectors = (
+        np.random.default_rng(seed)
+        .normal(size=(VOCAB_SIZE, dimension))
+        .astype(np.float32)
+    )
+    vocabulary = pl.DataFrame({"word": words}).with_row_index("word_index")
+
+    save_path.mkdir(parents=True, exist_ok=True)
+    for file_path in save_path.glob("*.parquet"):
+        file_path.unlink()
+
+    abstracts = pl.scan_parquet(abstracts_path)
+    n_rows = abstracts.select(pl.len()).collect().item()
+
+    for i, start in enumerate(range(0, n_rows, chunk_size)):
+        chunk = abstracts.slice(start, chunk_size).collect().with_row_index("owner")
+
+        counts = (
+            chunk.select(
+                "owner",
+                pl.col("patent_abstract")
+                .str.to_lowercase()
+                .str.replace_all(r"[^a-z ]", "")
+                .str.split(" ")
+                .alias("word"),
+            )
+            .explode("word")
+            .join(vocabulary, on="word")
+            .group_by("owner", "word_index")
+            .len()
+            .sort("owner")
+        )
+
+        owner = counts.get_column("owner").to_numpy()
+        word_index = counts.get_column("word_index").to_numpy()
+        weight = counts.get_column("len").to_numpy().astype(np.float32)
+
+        embeddings = np.zeros((chunk.height, dimension), dtype=np.float32)
+
+        # NOTE: summed a block of abstracts at a time to bound the gather
+        bounds = np.searchsorted(
+            owner, np.arange(0, chunk.height + block_size, block_size)
+        )
+        for low, high in pairwise(bounds):
+            if low == high:
+                continue
+
+            starts = low + np.flatnonzero(
+                np.r_[True, owner[low + 1 : high] != owner[low : high - 1]]
+            )
+            sums = np.add.reduceat(
+                vectors[word_index[low:high]] * weight[low:high, None],
+                starts - low,
+            )
+            embeddings[owner[starts]] = (
+                sums / np.add.reduceat(weight[low:high], starts - low)[:, None]
+            )
+
+        chunk.select("patent_key", "patent_id").with_columns(
+            embedding=embeddings
+        ).write_parquet(save_path / f"embeddings_{i}.parquet")
+
+
+if __name__ == "__main__":
+    make_synthetic(10_000)
@@ -1,10 +1,8 @@
 from pathlib import Path
+from typing import NamedTuple
 
 import polars as pl
 
-data_path = Path("data")
-raw_patents_path = data_path / "raw" / "patents"
-
 # TODO:
 # check uniqueness of patent and abstract pairs
 
@@ -14,122 +12,264 @@ raw_patents_path = data_path / "raw" / "patents"
 # patent_id, patent_date, patent_abstract, inventor_id, inventor_location_id,
 # inventor_sequence, assignee_id, and assignee location_id should never be missing
 
+CHECK_KINDS = ["nulls", "sentinels", "dates", "unique", "file_range", "categories"]
 
-def tally_citations(
-    path=Path("data", "raw", "bulk_downloads", "g_us_patent_citation.parquet"),
-):
-    df = pl.scan_parquet(path).group_by("citation_category").agg(pl.len()).collect()
+SENTINELS = ("null", "na", "n/a", "none", "nan", "missing", "unknown")
+DATE_FORMAT = r"^\d{4}-\d{2}-\d{2}$"
+FILE_RANGE = r"(\d{4}-\d{2}-\d{2})_to_(\d{4}-\d{2}-\d{2})"
 
-    return df
 
+REPORT_SCHEMA = {
+    "dataset": pl.String,
+    "check": pl.String,
+    "column": pl.String,
+    "rows": pl.Int64,
+    "failures": pl.Int64,
+    "share": pl.Float64,
+    "threshold": pl.Float64,
+}
 
-def count_rows(path):
-    df = pl.scan_parquet(path)
 
-    count = df.select(pl.len()).collect()
-    return count
+class Check(NamedTuple):
+    kind: str
+    columns: tuple
+    # NOTE: largest share of failing rows that still passes, None only
+    # reports the failures without gating on them
+    threshold: float | None = 0.0
+    values: tuple = ()
 
 
-def count_null(path):
-    df = pl.scan_parquet(path)
+def _failures(check):
+    if check.kind not in CHECK_KINDS:
+        raise ValueError(f"kind must be one of {CHECK_KINDS}, got {check.kind!r}")
 
-    nulls_count = df.null_count().collect()
-    null_columns = nulls_count.select(
-        col for col in nulls_count.iter_columns() if col.item(0) > 0
+    # NOTE: every check is an aggregation over the whole table, counting the
+    # rows that fail it, so all checks of a dataset share one scan
+    if check.kind == "unique":
+        yield (
+            ",".join(check.columns),
+            pl.len() - pl.struct(check.columns).n_unique(),
+        )
+        return
+
+    for column in check.columns:
+        if check.kind == "nulls":
+            failures = pl.col(column).null_count()
+        elif check.kind == "sentinels":
+            failures = (
+                pl.col(column)
+                .cast(pl.String)
+                .str.to_lowercase()
+                .is_in(check.values)
+                .sum()
+            )
+        elif check.kind == "dates":
+            failures = (~pl.col(column).str.contains(DATE_FORMAT)).sum()
+        elif check.kind == "file_range":
+            dates = pl.col(column).str.to_date(strict=False)
+            failures = (
+                (dates < pl.col("file_name").str.extract(FILE_RANGE, 1).str.to_date())
+                | (dates > pl.col("file_name").str.extract(FILE_RANGE, 2).str.to_date())
+            ).sum()
+        else:
+            failures = (~pl.col(column).is_in(check.values)).sum()
+
+        yield column, failures
+
+
+def _tallies(check):
+    # NOTE: the categories are also counted one by one for the report
+    for value in check.values:
+        yield f"{check.columns[0]}={value}", (pl.col(check.columns[0]) == value).sum()
+
+
+def validate_dataset(name, path, checks):
+    labels = []
+    expressions = [pl.len().alias("rows")]
+
+    for check in checks:
+        for column, failures in _failures(check):
+            labels.append((check, column, False))
+            expressions.append(failures.alias(str(len(labels))))
+
+        if check.kind == "categories":
+            for column, count in _tallies(check):
+                labels.append((check, column, True))
+                expressions.append(count.alias(str(len(labels))))
+
+    file_name = (
+        "file_name" if any(check.kind == "file_range" for check in checks) else None
     )
 
-    print("null values: ", null_columns)
-
-
-def count_other(path):
-    df = pl.scan_parquet(path)
-
-    missing_values = ["null", "na", "n/a", "none", "nan", "missing", "unknown"]
-    missing_columns = (
-        df.select(["patent_id", "patent_abstract"])
-        .drop_nulls()
-        .with_columns(pl.col("*").cast(pl.Utf8).str.to_lowercase())
-        .filter(pl.any_horizontal(pl.col("*").is_in(missing_values)))
-        .select(pl.len())
-        .collect()
+    # NOTE: one streaming pass over the files for all the checks
+    totals = (
+        pl.scan_parquet(path, include_file_paths=file_name)
+        .select(expressions)
+        .collect(engine="streaming")
+        .row(0)
     )
-
-    print("missing values: ", missing_columns)
-
-
-def check_dates(path):
-    date_format = r"^\d{4}-\d{2}-\d{2}$"
-
-    df = pl.scan_parquet(path)
-
-    dates = (
-        df.select(["patent_date", "patent_earliest_application_date"])
-        .filter(~pl.any_horizontal(pl.col("*").str.contains(date_format)))
-        .collect()
+    rows = totals[0]
+
+    report = pl.DataFrame(
+        [
+            {
+                "dataset": name,
+                "check": check.kind,
+                "column": column,
+                "rows": rows,
+                "failures": count,
+                "share": count / rows if rows else 0.0,
+                # NOTE: tallies are only reported, they have no threshold
+                "threshold": None if tally else check.threshold,
+            }
+            for (check, column, tally), count in zip(labels, totals[1:], strict=True)
+        ],
+        schema=REPORT_SCHEMA,
     )
 
-    print(dates)
-
-
-def check_range(path):
-    df = pl.scan_parquet(path, include_file_paths="file_name")
-
-    dates = (
-        df.select("patent_date", "patent_id", "file_name")
-        .unique()
-        .group_by(pl.col("file_name"))
-        .agg(
-            pl.len(),
-            pl.min("patent_date").alias("actual_min"),
-            pl.max("patent_date").alias("actual_max"),
-        )
-        .with_columns(
-            pl.col("file_name")
-            .str.extract(r"(\d{4}-\d{2}-\d{2})_to_(\d{4}-\d{2}-\d{2})", 1)
-            .alias("expected_min"),
-            pl.col("file_name")
-            .str.extract(r"(\d{4}-\d{2}-\d{2})_to_(\d{4}-\d{2}-\d{2})", 2)
-            .alias("expected_max"),
-        )
-        .with_columns(
-            pl.col(
-                ["actual_min", "actual_max", "expected_min", "expected_max"]
-            ).str.to_date()
-        )
-        .with_columns(
-            pl.col("expected_min").le(pl.col("actual_min")).alias("min_test"),
-            pl.col("expected_max").ge(pl.col("actual_max")).alias("max_test"),
-        )
-        .collect()
+    return report.with_columns(passed=pl.col("share") <= pl.col("threshold"))
+
+
+raw_path = Path("data", "raw")
+interim_path = Path("data", "interim")
+
+# NOTE: raw tables come as downloaded and load_patents and filter_citations
+# clean them, so most of their checks only report, derived tables are gated
+DATASETS = {
+    "raw_patents": (
+        raw_path / "patents",
+        [
+            Check("nulls", ("patent_id",)),
+            Check(
+                "nulls",
+                (
+                    "patent_date",
+                    "patent_abstract",
+                    "inventor_id",
+                    "inventor_location_id",
+                    "inventor_sequence",
+                    "assignee_id",
+                    "assignee_location_id",
+                ),
+                threshold=None,
+            ),
+            Check(
+                "sentinels",
+                ("patent_id", "patent_abstract"),
+                threshold=None,
+                values=SENTINELS,
+            ),
+            # NOTE: load_patents parses both dates and fails on other formats
+            Check("dates", ("patent_date", "patent_earliest_application_date")),
+            Check(
+                "unique",
+                (
+                    "patent_id",
+                    "inventor_id",
+                    "inventor_location_id",
+                    "inventor_sequence",
+                ),
+                threshold=None,
+            ),
+            Check("file_range", ("patent_date",), threshold=None),
+        ],
+    ),
+    "interim_patents": (
+        interim_path / "patents",
+        [
+            Check(
+                "nulls",
+                (
+                    "patent_id",
+                    "grant_date",
+                    "application_date",
+                    "patent_abstract",
+                    "inventor_id",
+                    "assignee_id",
+                    "patent_key",
+                ),
+            ),
+            Check("sentinels", ("patent_id", "patent_abstract"), values=SENTINELS),
+            Check("unique", ("patent_id", "inventor_id")),
+        ],
+    ),
+    "raw_citations": (
+        raw_path / "bulk_downloads" / "g_us_patent_citation.parquet",
+        [
+            Check(
+                "nulls",
+                ("patent_id", "citation_patent_id", "citation_category"),
+                threshold=None,
+            ),
+            # NOTE: the categories filter_citations keeps, the rest are dropped
+            Check(
+                "categories",
+                ("citation_category",),
+                threshold=None,
+                values=("cite by examiner", "cited by applicant", "cited by other"),
+            ),
+        ],
+    ),
+}
+
+
+def validate(datasets=None, save_path=Path("data", "interim", "validation")):
+    datasets = list(DATASETS) if datasets is None else datasets
+
+    unknown = [name for name in datasets if name not in DATASETS]
+    if unknown:
+        raise ValueError(f"datasets must be in {list(DATASETS)}, got {unknown!r}")
+
+    save_path.mkdir(parents=True, exist_ok=True)
+    reports = []
+
+    # NOTE: one report per dataset, so gates of stages running side by side
+    # do not write the same file
+    for name in datasets:
+        if not DATASETS[name][0].exists():
+            continue
+
+        report = validate_dataset(name, *DATASETS[name])
+        temp_path = save_path / f"{name}.tmp"
+        report.write_parquet(temp_path)
+        temp_path.replace(save_path / f"{name}.parquet")
+        reports.append(report)
+
+    report = (
+        pl.concat(reports)
+        if reports
+        else pl.DataFrame(schema=REPORT_SCHEMA | {"passed": pl.Boolean})
     )
 
-    print(dates)
+    with pl.Config(tbl_rows=-1, tbl_width_chars=200):
+        print(report.with_columns(pl.col("share").round(4)))
 
+    return report
 
-def check_uniqueness(path):
-    df = pl.scan_parquet(path)
 
-    all_size = df.select(pl.len()).collect()
+def gate(datasets, save_path=Path("data", "interim", "validation")):
+    missing = [
+        name for name in datasets if name in DATASETS and not DATASETS[name][0].exists()
+    ]
+    if missing:
+        raise ValueError(f"datasets {missing!r} have no data to validate")
 
-    unique_size = (
-        df.unique(
-            ["patent_id", "inventor_id", "inventor_location_id", "inventor_sequence"]
-        )
-        .select(pl.len())
-        .collect()
-    )
-
-    print("unique? ", all_size == unique_size)
+    report = validate(datasets, save_path)
+    failed = report.filter(~pl.col("passed"))
 
+    if not failed.is_empty():
+        raise ValueError(
+            f"validation failed for {failed.height} checks:\n"
+            + "\n".join(
+                f"{dataset} {check} {column}: {failures} of {rows} rows"
+                for dataset, check, column, rows, failures in failed.select(
+                    "dataset", "check", "column", "rows", "failures"
+                ).rows()
+            )
+        )
 
-count_null("data/raw/patents")
-count_other("data/processed/patents")
-check_dates("data/raw/patents")
-check_uniqueness("data/raw/patents")
-check_range("data/raw/patents")
+    return report
 
-count_rows("data/raw/patents")
-count_rows("data/interim/patents")
-count_rows("data/processed/patents")
 
-tally_citations()
+if __name__ == "__main__":
+    validate()
@@ -0,0 +1,58 @@
+import numpy as np
+import polars as pl
+
+from lse_diss.modelling.ann import _targeted_matches, count_neighbours
+from lse_diss.modelling.store import EmbeddingStore
+
+
+def _store(n_rows=3000, n_dimensions=768, n_outside=500, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((n_rows + n_outside, n_dimensions)).astype(
+        np.float32
+    )
+
+    # NOTE: the last rows are patents outside the cohort, they have no key
+    rows = pl.DataFrame(
+        {
+            "row": np.arange(n_rows + n_outside),
+            "patent_id": [str(row) for row in range(n_rows + n_outside)],
+            "patent_key": pl.Series(
+                list(range(n_rows)) + [None] * n_outside, dtype=pl.UInt32
+            ),
+        }
+    )
+
+    return EmbeddingStore(embeddings=embeddings, rows=rows)
+
+
+def test_targeted_matches_keep_the_kth_neighbour():
+    store = _store()
+    n_neighbours = count_neighbours(store, match_quality=100)
+    queries = np.arange(100)
+
+    cohort = store.embeddings[: store.rows.get_column("patent_key").count()]
+    cohort = cohort.astype(np.float64)
+    cohort /= np.linalg.norm(cohort, axis=1, keepdims=True)
+    ranked = np.argsort(-(cohort[queries] @ cohort.T), axis=1)
+
+    # NOTE: the exact top k and the next ten, which must not match
+    controls = pl.DataFrame(
+        {
+            "citing_patent_key": np.repeat(queries, n_neighbours + 10),
+            "cited_patent_key": np.repeat(queries, n_neighbours + 10),
+            "control_patent_key": ranked[:, : n_neighbours + 10].ravel(),
+        },
+        schema=dict.fromkeys(
+            ["citing_patent_key", "cited_patent_key", "control_patent_key"],
+            pl.UInt32,
+        ),
+    )
+    expected = controls.filter(
+        pl.int_range(pl.len()).over("citing_patent_key") < n_neighbours
+    )
+
+    matched = _targeted_matches(
+        store, controls.lazy(), n_neighbours, sample_size=10**7, seed=0
+    ).collect()
+
+    assert matched.sort(pl.all()).equals(expected.sort(pl.all()))
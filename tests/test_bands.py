@@ -0,0 +1,17 @@
+from pathlib import Path
+
+import pytest
+
+from lse_diss.modelling.bands import check_reference
+
+# NOTE: written by make_reference in bands_reference.R, R is needed to make it
+REFERENCE_PATH = (
+    Path(__file__).parents[1] / "data" / "interim" / "bands_reference.parquet"
+)
+
+
+@pytest.mark.skipif(
+    not REFERENCE_PATH.exists(), reason="run make_reference() in R first"
+)
+def test_bands_match_r():
+    assert check_reference(REFERENCE_PATH)